@@ -0,0 +1,85 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import json
+import zlib
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.six import string_types
+from ansible.plugins.action import ActionBase
+
+
+# This action plugin serves both the koji_tag and koji_tag_packages modules
+# (action_plugins/koji_tag_packages.py is a symlink to this file).
+#
+# It reads the packages_file and blocked_packages_file options on the
+# controller, so Ansible does not template these large lists, and sends them
+# to the module in the compact "*_data" encoding that
+# common_koji.decode_package_data() reads.
+
+FILE_OPTIONS = (
+    ('packages_file', 'packages', dict),
+    ('blocked_packages_file', 'blocked_packages', list),
+)
+
+
+def encode_package_data(value):
+    """
+    Encode a packages dict or blocked_packages list for the module.
+
+    :param value: dict or list
+    :returns: str, base64-encoded zlib-compressed JSON
+    """
+    text = json.dumps(value, separators=(',', ':'), sort_keys=True)
+    compressed = zlib.compress(text.encode('utf-8'), 9)
+    return base64.b64encode(compressed).decode('ascii')
+
+
+def validate_package_data(option, value, expected_type):
+    """
+    Ensure that the data we read from a file has the right shape.
+
+    :raises: AnsibleError if not.
+    """
+    if not isinstance(value, expected_type):
+        raise AnsibleError('%s must contain a %s' %
+                           (option, expected_type.__name__))
+    if expected_type is dict:
+        lists = value.values()
+    else:
+        lists = [value]
+    for names in lists:
+        if not isinstance(names, list) or \
+                not all(isinstance(name, string_types) for name in names):
+            raise AnsibleError('%s must contain lists of package names'
+                               % option)
+
+
+class ActionModule(ActionBase):
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        module_args = self._task.args.copy()
+        try:
+            for option, setting, expected_type in FILE_OPTIONS:
+                path = module_args.pop(option, None)
+                if path is None:
+                    continue
+                if module_args.get(setting) is not None:
+                    raise AnsibleError('you cannot set both %s and %s' %
+                                       (setting, option))
+                path = self._find_needle('files', path)
+                value = self._loader.load_from_file(path)
+                validate_package_data(option, value, expected_type)
+                module_args[setting + '_data'] = encode_package_data(value)
+        except AnsibleError as e:
+            result['failed'] = True
+            result['msg'] = str(e)
+            return result
+
+        result.update(self._execute_module(module_args=module_args,
+                                           task_vars=task_vars))
+        return result
@@ -0,0 +1 @@
+koji_tag.py
\ No newline at end of file
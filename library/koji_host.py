@@ -104,6 +104,9 @@ def ensure_channels(session, host_id, host_name, check_mode, desired_channels):
     """
     Ensure that given host belongs to given channels (and only them).
 
+    We only log in if we need to change the channels, and then we send all
+    the changes in one multicall.
+
     :param session: Koji client session
     :param int host_id: Koji host ID
     :param str host_name: Koji host name
@@ -111,21 +114,16 @@ def ensure_channels(session, host_id, host_name, check_mode, desired_channels):
     :param list desired_channels: channels that the host should belong to
     """
     result = {'changed': False, 'stdout_lines': []}
-    common_koji.ensure_logged_in(session)
     current_channels = session.listChannels(host_id)
     current_channels = [channel['name'] for channel in current_channels]
-    for channel in current_channels:
-        if channel not in desired_channels:
-            if not check_mode:
-                session.removeHostFromChannel(host_name, channel)
-            result['stdout_lines'].append('removed host from channel %s' % channel)
-            result['changed'] = True
-    for channel in desired_channels:
-        if channel not in current_channels:
-            if not check_mode:
-                session.addHostToChannel(host_name, channel, create=True)
-            result['stdout_lines'].append('added host to channel %s' % channel)
-            result['changed'] = True
+    changes, calls = common_koji.get_channel_changes(
+        host_name, current_channels, desired_channels)
+    if changes:
+        result['changed'] = True
+        result['stdout_lines'].extend(changes)
+        if not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, calls)
     return result
 
 
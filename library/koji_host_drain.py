@@ -0,0 +1,317 @@
+#!/usr/bin/python
+import sys
+import time
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import common_koji
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: koji_host_drain
+
+short_description: Drain Koji build hosts for maintenance
+description:
+   - 'Take a group of Koji build hosts out of service and wait for their
+     tasks to finish ("state: drained"), or put them back into service
+     ("state: enabled").'
+   - To update a large fleet in rolling waves, run this module on each
+     wave of hosts, for example with Ansible's C(serial) keyword. Drain the
+     wave, do the maintenance, and enable the wave again. See the example
+     below.
+   - This module checks all the hosts for open tasks with one multicall on
+     each poll. It polls often while tasks are finishing, and backs off
+     (up to I(max_poll_interval)) while nothing changes, so it does not load
+     the hub during long tasks.
+   - If the hosts still have open tasks after I(timeout) seconds, this
+     module fails and leaves the hosts disabled.
+   - The drain returns the hosts that it disabled in C(disabled_hosts).
+     Pass that list to I(disabled_hosts) with "state: enabled" so that you
+     only enable those hosts again, and hosts that an administrator had
+     already disabled stay disabled.
+options:
+   hosts:
+     description:
+       - The names of the Koji build hosts.
+     required: true
+   state:
+     description:
+       - '"drained" disables the hosts and waits until they have no open
+         tasks. "enabled" enables the hosts again.'
+     choices: [drained, enabled]
+     default: drained
+   disabled_hosts:
+     description:
+       - 'With "state: enabled", only enable the hosts in this list. Use the
+         C(disabled_hosts) value that "state: drained" returned. Ansible
+         leaves the other hosts in I(hosts) alone.'
+       - If you do not set this, Ansible enables all the hosts.
+   timeout:
+     description:
+       - Number of seconds to wait for the hosts' open tasks to finish.
+     default: 3600
+   poll_interval:
+     description:
+       - Number of seconds to wait between checks while tasks are
+         finishing.
+     default: 10
+   max_poll_interval:
+     description:
+       - When no tasks finish between two checks, this module doubles the
+         time between checks, up to this many seconds.
+     default: 300
+requirements:
+  - "python >= 2.7"
+  - "koji"
+'''
+
+EXAMPLES = '''
+- name: Update builder kernels, ten builders at a time
+  hosts: builders
+  serial: 10
+  tasks:
+    - name: Drain this wave of builders
+      koji_host_drain:
+        hosts: "{{ ansible_play_batch }}"
+        state: drained
+      delegate_to: localhost
+      run_once: true
+      register: drain
+
+    - name: Update the kernel
+      package:
+        name: kernel
+        state: latest
+      notify: reboot
+
+    - meta: flush_handlers
+
+    - name: Enable the builders that we drained
+      koji_host_drain:
+        hosts: "{{ ansible_play_batch }}"
+        state: enabled
+        disabled_hosts: "{{ drain.disabled_hosts }}"
+      delegate_to: localhost
+      run_once: true
+'''
+
+RETURN = '''
+polls:
+  description: number of times we checked the hosts for open tasks.
+  returned: when state is drained
+  type: int
+  sample: 12
+disabled_hosts:
+  description: names of the hosts that this task disabled. This does not
+               include hosts that were already disabled.
+  returned: when state is drained, also when the task fails because the
+            hosts still have open tasks at the timeout
+  type: list
+  sample:
+    - builder1.example.com
+'''
+
+
+class DrainTimeoutError(ValueError):
+    """ Hosts still have open tasks when we stop waiting. """
+
+    def __init__(self, msg, disabled_hosts=()):
+        super(DrainTimeoutError, self).__init__(msg)
+        # names of the hosts that this task disabled
+        self.disabled_hosts = list(disabled_hosts)
+
+
+def get_hosts(session, names):
+    """
+    Read these hosts in one multicall.
+
+    :param session: Koji client session
+    :param list names: Koji host names
+    :returns: list of getHost dicts, in the same order as names.
+    :raises: ValueError if a host does not exist.
+    """
+    calls = [('getHost', (name,), {}) for name in names]
+    hosts = common_koji.multicall(session, calls)
+    for name, host in zip(names, hosts):
+        if not host:
+            raise ValueError('host %s does not exist' % name)
+    return hosts
+
+
+def set_enabled(session, check_mode, hosts, enabled):
+    """
+    Enable or disable these hosts in one multicall.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param list hosts: getHost dicts
+    :param bool enabled: True to enable the hosts, False to disable them.
+    :returns: a result dict for Ansible
+    """
+    result = {'changed': False, 'stdout_lines': []}
+    method = 'enableHost' if enabled else 'disableHost'
+    change = 'enabled host' if enabled else 'disabled host'
+    calls = []
+    for host in hosts:
+        if bool(host['enabled']) == enabled:
+            continue
+        result['stdout_lines'].append('%s: %s' % (host['name'], change))
+        calls.append((method, (host['name'],), {}))
+    if calls:
+        result['changed'] = True
+        if not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, calls)
+    return result
+
+
+def count_open_tasks(session, hosts):
+    """
+    Count the open tasks on each of these hosts, with one multicall.
+
+    :param session: Koji client session
+    :param list hosts: getHost dicts
+    :returns: list of task counts, in the same order as hosts.
+    """
+    koji_profile = sys.modules[session.__module__]
+    states = [koji_profile.TASK_STATES['OPEN'],
+              koji_profile.TASK_STATES['ASSIGNED']]
+    calls = [('listTasks', (), {'opts': {'host_id': host['id'],
+                                         'state': states},
+                                'queryOpts': {'countOnly': True}})
+             for host in hosts]
+    return common_koji.multicall(session, calls)
+
+
+def wait_for_idle(session, hosts, timeout, poll_interval, max_poll_interval):
+    """
+    Wait until none of these hosts have open tasks.
+
+    We wait poll_interval seconds between checks while the number of open
+    tasks goes down, and double the wait (up to max_poll_interval) each
+    time it does not. We stop checking each host once it is idle.
+
+    :param session: Koji client session
+    :param list hosts: getHost dicts
+    :param int timeout: give up after this many seconds.
+    :param int poll_interval: shortest wait between checks, in seconds
+    :param int max_poll_interval: longest wait between checks, in seconds
+    :returns: number of times we checked the hosts.
+    :raises: DrainTimeoutError if the hosts still have open tasks at the
+             timeout.
+    """
+    deadline = time.time() + timeout
+    interval = poll_interval
+    busy = list(hosts)
+    previous = None
+    polls = 0
+    while True:
+        counts = count_open_tasks(session, busy)
+        polls += 1
+        busy = [host for host, count in zip(busy, counts) if count]
+        if not busy:
+            return polls
+        total = sum(counts)
+        if previous is not None:
+            if total < previous:
+                interval = poll_interval
+            else:
+                interval = min(interval * 2, max_poll_interval)
+        previous = total
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            names = ', '.join(host['name'] for host in busy)
+            raise DrainTimeoutError('timed out waiting for %d open tasks '
+                                    'on %s' % (total, names))
+        time.sleep(min(interval, remaining))
+
+
+def drain_hosts(session, check_mode, names, timeout=3600, poll_interval=10,
+                max_poll_interval=300):
+    """
+    Disable these hosts and wait until they have no open tasks.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes, and don't wait.
+    :param list names: Koji host names
+    :param int timeout: give up after this many seconds.
+    :param int poll_interval: shortest wait between checks, in seconds
+    :param int max_poll_interval: longest wait between checks, in seconds
+    :returns: a result dict for Ansible, with the names of the hosts that
+              we disabled in "disabled_hosts".
+    :raises: DrainTimeoutError with the names of the hosts that we disabled,
+             if the hosts still have open tasks at the timeout.
+    """
+    hosts = get_hosts(session, names)
+    disabled_hosts = [host['name'] for host in hosts if host['enabled']]
+    result = set_enabled(session, check_mode, hosts, False)
+    result['disabled_hosts'] = disabled_hosts
+    result['polls'] = 0
+    if check_mode:
+        return result
+    try:
+        result['polls'] = wait_for_idle(session, hosts, timeout,
+                                        poll_interval, max_poll_interval)
+    except DrainTimeoutError as e:
+        raise DrainTimeoutError(str(e), disabled_hosts)
+    return result
+
+
+def run_module():
+    module_args = dict(
+        koji=dict(),
+        hosts=dict(type='list', required=True),
+        state=dict(choices=['drained', 'enabled'], default='drained'),
+        disabled_hosts=dict(type='list'),
+        timeout=dict(type='int', default=3600),
+        poll_interval=dict(type='int', default=10),
+        max_poll_interval=dict(type='int', default=300),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not common_koji.HAS_KOJI:
+        module.fail_json(msg='koji is required for this module')
+
+    check_mode = module.check_mode
+    params = module.params
+    profile = params['koji']
+
+    session = common_koji.get_session(profile)
+
+    try:
+        if params['state'] == 'drained':
+            result = drain_hosts(session, check_mode, params['hosts'],
+                                 params['timeout'], params['poll_interval'],
+                                 params['max_poll_interval'])
+        else:
+            names = params['hosts']
+            if params['disabled_hosts'] is not None:
+                disabled = set(params['disabled_hosts'])
+                names = [name for name in names if name in disabled]
+            hosts = get_hosts(session, names)
+            result = set_enabled(session, check_mode, hosts, True)
+    except DrainTimeoutError as e:
+        # The caller must re-enable the hosts that we disabled.
+        module.fail_json(msg=str(e), changed=bool(e.disabled_hosts),
+                         disabled_hosts=e.disabled_hosts)
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
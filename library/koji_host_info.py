@@ -0,0 +1,166 @@
+#!/usr/bin/python
+import sys
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import common_koji
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: koji_host_info
+
+short_description: Gather facts about Koji build hosts
+description:
+   - Read every Koji build host's settings, channels and krb principals.
+   - This module reads the hosts with one listHosts query, and all their
+     channels and user accounts with one more multicall, so it gathers facts
+     for a whole fleet in a single task.
+   - This module never changes anything in Koji.
+options:
+   arches:
+     description:
+       - Only return hosts that support any of these arches.
+       - 'Example: [x86_64, i686]'
+   channel:
+     description:
+       - Only return hosts that belong to this channel.
+       - 'Example: createrepo'
+requirements:
+  - "python >= 2.7"
+  - "koji"
+'''
+
+EXAMPLES = '''
+- name: Check our builder capacity
+  hosts: localhost
+  tasks:
+    - name: Read the createrepo builders
+      koji_host_info:
+        channel: createrepo
+      register: createrepo_info
+
+    - name: Make sure at least two createrepo builders are ready
+      assert:
+        that:
+          - createrepo_info.hosts | selectattr('ready') | list | length >= 2
+'''
+
+RETURN = '''
+hosts:
+  description: the hosts' listHosts information, sorted by name, with their
+               channels and krb principals.
+  returned: always
+  type: list
+  sample:
+    - name: builder1.example.com
+      id: 1
+      user_id: 2
+      arches: x86_64
+      capacity: 2.0
+      task_load: 0.0
+      description: null
+      comment: null
+      enabled: true
+      ready: true
+      channels:
+        - createrepo
+        - default
+      krb_principals:
+        - compile/builder1.example.com@EXAMPLE.COM
+'''
+
+
+READ_BATCH_SIZE = 1000
+
+
+def get_krb_principals(user):
+    """
+    Return a user's krb principals as a list.
+
+    Koji Hubs before v1.19 only have a single "krb_principal" value.
+
+    :param dict user: getUser information, or None
+    """
+    if not user:
+        return []
+    if 'krb_principals' in user:
+        return user['krb_principals']
+    if user.get('krb_principal'):
+        return [user['krb_principal']]
+    return []
+
+
+def get_hosts_info(session, arches=None, channel=None):
+    """
+    Read all the information about these hosts.
+
+    :param session: Koji client session
+    :param list arches: only return hosts that support any of these arches.
+    :param str channel: only return hosts in this channel.
+    :returns: list of host dicts, sorted by name.
+    :raises: ValueError if the channel does not exist.
+    """
+    kwargs = {}
+    if arches:
+        kwargs['arches'] = arches
+    if channel:
+        kwargs['channelID'] = channel
+    koji_profile = sys.modules[session.__module__]
+    try:
+        hosts = session.listHosts(**kwargs)
+    except koji_profile.GenericError:
+        # The hub looks up the channel strictly.
+        if not channel:
+            raise
+        raise ValueError('channel %s does not exist' % channel)
+    hosts = sorted(hosts, key=lambda h: h['name'])
+    calls = []
+    for host in hosts:
+        calls.append(('listChannels', (), {'hostID': host['id']}))
+        calls.append(('getUser', (host['user_id'],), {}))
+    results = common_koji.multicall(session, calls, batch=READ_BATCH_SIZE)
+    for i, host in enumerate(hosts):
+        channels, user = results[2 * i:2 * i + 2]
+        host['channels'] = sorted(c['name'] for c in channels)
+        host['krb_principals'] = get_krb_principals(user)
+    return hosts
+
+
+def run_module():
+    module_args = dict(
+        koji=dict(),
+        arches=dict(type='list'),
+        channel=dict(),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not common_koji.HAS_KOJI:
+        module.fail_json(msg='koji is required for this module')
+
+    params = module.params
+    profile = params['koji']
+
+    session = common_koji.get_session(profile)
+
+    try:
+        hosts = get_hosts_info(session, params['arches'], params['channel'])
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+    module.exit_json(changed=False, hosts=hosts)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import common_koji
+from ansible.module_utils.six import string_types
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: koji_hosts
+
+short_description: Create and manage many Koji build hosts at once
+description:
+   - This module manages a whole fleet of Koji build hosts in one task. Each
+     item in I(hosts) takes the same settings as the koji_host module.
+   - Instead of reading and editing each host separately, this module reads
+     every host with one listHosts query, reads the hosts' channels (and
+     users, for I(krb_principals)) in one multicall, compares everything
+     locally, and sends all the changes in multicall batches.
+   - This module only logs in to the hub when it has changes to send.
+   - 'Koji only supports adding new hosts, not deleting them. Once they are
+     defined, you can enable or disable the hosts with "state: enabled" or
+     "state: disabled".'
+options:
+   hosts:
+     description:
+       - A list of host settings dicts. Each dict must have a C(name) and
+         C(arches), and may have C(channels), C(state), C(krb_principal),
+         C(krb_principals), C(capacity), C(description) and C(comment). See
+         the koji_host module for the meaning of each setting.
+       - C(arches), C(channels) and C(krb_principals) are lists. Like the
+         koji_host module, this module also accepts a comma-separated
+         string for each of them.
+     required: true
+requirements:
+  - "python >= 2.7"
+  - "koji"
+'''
+
+EXAMPLES = '''
+- name: configure our koji builders
+  hosts: localhost
+  tasks:
+    - name: Manage all x86_64 builders
+      koji_hosts:
+        hosts:
+          - name: builder1.example.com
+            arches: [x86_64]
+            channels: [default, createrepo]
+          - name: builder2.example.com
+            arches: [x86_64]
+            channels: [default]
+            state: disabled
+            comment: waiting for a new disk
+'''
+
+
+HOST_SETTINGS = {
+    'arches': None,
+    'channels': None,
+    'state': 'enabled',
+    'krb_principal': None,
+    'krb_principals': None,
+    'capacity': None,
+    'description': None,
+    'comment': None,
+}
+
+EDIT_SETTINGS = ('capacity', 'description', 'comment')
+
+# Settings that koji_host declares with type='list'.
+LIST_SETTINGS = ('arches', 'channels', 'krb_principals')
+
+WRITE_BATCH_SIZE = 500
+
+
+def normalize_hosts(hosts):
+    """
+    Check each item of the "hosts" list and fill in default settings.
+
+    :param list hosts: list of host setting dicts
+    :returns: list of host setting dicts, with a "krb_principals" list (or
+              None) instead of any "krb_principal" setting.
+    :raises: ValueError if a host dict is invalid.
+    """
+    specs = []
+    seen = set()
+    for host in hosts:
+        if not isinstance(host, dict) or 'name' not in host \
+                or 'arches' not in host:
+            raise ValueError('each item in hosts must be a dict with a name '
+                             'and arches')
+        name = host['name']
+        if name in seen:
+            raise ValueError('host %s is listed more than once' % name)
+        seen.add(name)
+        unknown = set(host) - set(HOST_SETTINGS) - set(['name'])
+        if unknown:
+            raise ValueError('unsupported settings for host %s: %s'
+                             % (name, ', '.join(sorted(unknown))))
+        spec = dict(HOST_SETTINGS)
+        spec.update(host)
+        if spec['state'] not in ('enabled', 'disabled'):
+            raise ValueError('state must be enabled or disabled')
+        for key in LIST_SETTINGS:
+            # Split strings on commas, like AnsibleModule's "list" type.
+            if isinstance(spec[key], string_types):
+                spec[key] = [value.strip() for value in spec[key].split(',')]
+            elif spec[key] is not None and not isinstance(spec[key], list):
+                raise ValueError('host %s: %s must be a list' % (name, key))
+        if spec['capacity'] is not None:
+            # The hub returns capacity as a float.
+            try:
+                spec['capacity'] = float(spec['capacity'])
+            except (TypeError, ValueError):
+                raise ValueError('host %s: capacity must be a number' % name)
+        if spec['krb_principal'] is not None:
+            if spec['krb_principals'] is not None:
+                raise ValueError('host %s: krb_principal and krb_principals '
+                                 'are mutually exclusive' % name)
+            spec['krb_principals'] = [spec['krb_principal']]
+        del spec['krb_principal']
+        specs.append(spec)
+    return specs
+
+
+def diff_host(spec, host, channels, user):
+    """
+    Compare one host's settings to the hub's data.
+
+    :param dict spec: normalized host settings
+    :param dict host: the hub's listHosts data for this host
+    :param list channels: names of the host's current channels, or None if
+                          we do not manage this host's channels.
+    :param dict user: the hub's getUser data for this host, or None if we do
+                      not manage this host's krb principals.
+    :returns: two-element tuple: a list of human-readable changes, and a
+              list of (method name, args, kwargs) calls for multicall().
+    """
+    name = spec['name']
+    changes = []
+    calls = []
+    if spec['state'] == 'enabled' and not host['enabled']:
+        changes.append('enabled host')
+        calls.append(('enableHost', (name,), {}))
+    elif spec['state'] == 'disabled' and host['enabled']:
+        changes.append('disabled host')
+        calls.append(('disableHost', (name,), {}))
+    edits = {}
+    if ' '.join(spec['arches']) != host['arches']:
+        edits['arches'] = ' '.join(spec['arches'])
+    for key in EDIT_SETTINGS:
+        if spec[key] is None:
+            continue  # Ansible did not set this parameter.
+        if key in host and spec[key] != host[key]:
+            edits[key] = spec[key]
+    if edits:
+        for edit in edits.keys():
+            changes.append('edited host %s' % edit)
+        calls.append(('editHost', (name,), edits))
+    if channels is not None:
+        channel_changes, channel_calls = common_koji.get_channel_changes(
+            name, channels, spec['channels'])
+        changes.extend(channel_changes)
+        calls.extend(channel_calls)
+    if user is not None:
+        krb_changes, mappings = common_koji.get_krb_principal_changes(
+            user, spec['krb_principals'])
+        if krb_changes:
+            changes.extend(krb_changes)
+            calls.append(('editUser', (user['id'],),
+                          {'krb_principal_mappings': mappings}))
+    return changes, calls
+
+
+def send_writes(session, calls):
+    """ Log in and send these calls in multicall batches. """
+    common_koji.ensure_logged_in(session)
+    for start in range(0, len(calls), WRITE_BATCH_SIZE):
+        common_koji.multicall(session, calls[start:start + WRITE_BATCH_SIZE])
+
+
+def read_host_details(session, specs, current):
+    """
+    Read the channels and users for these hosts in one multicall.
+
+    :param session: Koji client session
+    :param list specs: normalized host settings for existing hosts
+    :param dict current: host names to the hub's listHosts data
+    :returns: dict of host names to (channel names, user) tuples. Each item
+              is None if that host's settings do not manage it.
+    """
+    calls = []
+    for spec in specs:
+        host = current[spec['name']]
+        if spec['channels'] not in (None, ''):
+            calls.append(('listChannels', (), {'hostID': host['id']}))
+        if spec['krb_principals'] is not None:
+            calls.append(('getUser', (host['user_id'],), {}))
+    results = iter(common_koji.multicall(session, calls))
+    details = {}
+    for spec in specs:
+        channels = None
+        user = None
+        if spec['channels'] not in (None, ''):
+            channels = [channel['name'] for channel in next(results)]
+        if spec['krb_principals'] is not None:
+            user = next(results)
+        details[spec['name']] = (channels, user)
+    return details
+
+
+def ensure_hosts(session, check_mode, hosts):
+    """
+    Ensure that many hosts are configured in Koji.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param list hosts: list of host setting dicts
+    :return: result (dict)
+    """
+    specs = normalize_hosts(hosts)
+    result = {'changed': False, 'stdout_lines': []}
+    current = dict((host['name'], host) for host in session.listHosts())
+    missing = [spec for spec in specs if spec['name'] not in current]
+    if missing:
+        result['changed'] = True
+        for spec in missing:
+            result['stdout_lines'].append('%s: created host' % spec['name'])
+        if check_mode:
+            # We cannot compare the settings of hosts that do not exist.
+            specs = [spec for spec in specs if spec['name'] in current]
+        else:
+            calls = []
+            for spec in missing:
+                krb_principal = None
+                if spec['krb_principals']:
+                    krb_principal = spec['krb_principals'][0]
+                calls.append(('addHost', (spec['name'], spec['arches'],
+                                          krb_principal), {}))
+            send_writes(session, calls)
+            calls = [('getHost', (spec['name'],), {}) for spec in missing]
+            for host in common_koji.multicall(session, calls):
+                current[host['name']] = host
+    details = read_host_details(session, specs, current)
+    writes = []
+    for spec in specs:
+        channels, user = details[spec['name']]
+        changes, calls = diff_host(spec, current[spec['name']], channels,
+                                   user)
+        if not changes:
+            continue
+        result['changed'] = True
+        result['stdout_lines'].extend('%s: %s' % (spec['name'], change)
+                                      for change in changes)
+        writes.extend(calls)
+    if writes and not check_mode:
+        send_writes(session, writes)
+    return result
+
+
+def run_module():
+    module_args = dict(
+        koji=dict(),
+        hosts=dict(type='list', required=True),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not common_koji.HAS_KOJI:
+        module.fail_json(msg='koji is required for this module')
+
+    check_mode = module.check_mode
+    params = module.params
+    profile = params['koji']
+
+    session = common_koji.get_session(profile)
+
+    try:
+        result = ensure_hosts(session, check_mode, params['hosts'])
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+from collections import defaultdict
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import common_koji
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: koji_package_owner
+
+short_description: Transfer ownership of Koji packages to a new user
+description:
+   - Find every package that a user owns in any Koji tag and make another
+     user the owner instead.
+   - This module reads all the user's packages with a single listPackages
+     query, so it does not need to read each tag's full package list. It
+     sends the ownership changes to the hub in multicall batches.
+   - Koji tracks package ownership on each tag's package list. Tags that
+     inherit a package from a parent tag will show the parent's owner.
+options:
+   from_owner:
+     description:
+       - The name of the Koji user that currently owns the packages.
+     required: true
+   to_owner:
+     description:
+       - The name of the Koji user that should own these packages instead.
+       - This user account must already exist in Koji's database.
+     required: true
+   tags:
+     description:
+       - Only transfer ownership of packages on these Koji tags.
+       - If you omit this setting, this module transfers ownership on every
+         tag.
+   packages:
+     description:
+       - Only transfer ownership of these package names.
+       - If you omit this setting, this module transfers ownership of every
+         package that I(from_owner) owns.
+requirements:
+  - "python >= 2.7"
+  - "koji"
+'''
+
+EXAMPLES = '''
+- name: Reassign a departing maintainer's packages
+  hosts: localhost
+  tasks:
+    - name: Make bob own all of alice's packages
+      koji_package_owner:
+        from_owner: alice
+        to_owner: bob
+
+    - name: Make carol own alice's ceph packages in the ceph tags
+      koji_package_owner:
+        from_owner: alice
+        to_owner: carol
+        tags:
+          - ceph-3.1-rhel-7
+          - ceph-3.2-rhel-7
+        packages:
+          - ceph
+          - ceph-ansible
+'''
+
+RETURN = '''
+transferred:
+  description: number of (tag, package) entries that changed owners.
+  returned: always
+  type: int
+  sample: 1200
+tags:
+  description: number of entries that changed owners, for each tag name.
+  returned: always
+  type: dict
+  sample: {"ceph-3.1-rhel-7": 200, "ceph-3.2-rhel-7": 1000}
+'''
+
+
+WRITE_BATCH_SIZE = 1000
+
+
+def get_owned_packages(session, owner, tags=None, packages=None):
+    """
+    Find every tag's package entry that this user owns.
+
+    :param session: Koji client session
+    :param str owner: Koji user name
+    :param list tags: if set, only return entries for these tag names.
+    :param list packages: if set, only return entries for these package
+                          names.
+    :returns: a list of (tag ID, tag name, package name) tuples, sorted by
+              tag name and package name.
+    """
+    # One query for all tags. with_dups returns an entry for every tag
+    # instead of one entry per package.
+    entries = session.listPackages(userID=owner, with_dups=True)
+    owned = []
+    for entry in entries:
+        if tags is not None and entry['tag_name'] not in tags:
+            continue
+        if packages is not None and entry['package_name'] not in packages:
+            continue
+        owned.append((entry['tag_id'], entry['tag_name'],
+                      entry['package_name']))
+    return sorted(owned, key=lambda item: (item[1], item[2]))
+
+
+def transfer_owner(session, check_mode, from_owner, to_owner, tags=None,
+                   packages=None):
+    """
+    Ensure that to_owner owns every package entry that from_owner owns.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param str from_owner: Koji user name that owns the packages now
+    :param str to_owner: Koji user name that should own the packages
+    :param list tags: if set, only change package entries on these tags.
+    :param list packages: if set, only change these package names.
+    :returns: a result dict for Ansible
+    """
+    result = {'changed': False, 'stdout_lines': [], 'transferred': 0,
+              'tags': {}}
+    # listPackages() raises a GenericError for an unknown user, so check
+    # both users first, in one multicall.
+    calls = [('getUser', (user,), {}) for user in (from_owner, to_owner)]
+    for user, userinfo in zip((from_owner, to_owner),
+                              common_koji.multicall(session, calls)):
+        if not userinfo:
+            raise ValueError('user %s does not exist' % user)
+    owned = get_owned_packages(session, from_owner, tags, packages)
+    if not owned:
+        return result
+    counts = defaultdict(int)
+    for _, tag_name, _ in owned:
+        counts[tag_name] += 1
+    result['changed'] = True
+    result['transferred'] = len(owned)
+    result['tags'] = dict(counts)
+    for tag_name in sorted(counts):
+        result['stdout_lines'].append('%s: set owner %s on %d packages'
+                                      % (tag_name, to_owner,
+                                         counts[tag_name]))
+    if check_mode:
+        return result
+    common_koji.ensure_logged_in(session)
+    total = len(owned)
+    for start in range(0, total, WRITE_BATCH_SIZE):
+        batch = owned[start:start + WRITE_BATCH_SIZE]
+        calls = [('packageListSetOwner', (tag_id, package, to_owner), {})
+                 for tag_id, _, package in batch]
+        common_koji.multicall(session, calls)
+        result['stdout_lines'].append('transferred %d of %d packages'
+                                      % (start + len(batch), total))
+    return result
+
+
+def run_module():
+    module_args = dict(
+        koji=dict(),
+        from_owner=dict(required=True),
+        to_owner=dict(required=True),
+        tags=dict(type='list'),
+        packages=dict(type='list'),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not common_koji.HAS_KOJI:
+        module.fail_json(msg='koji is required for this module')
+
+    check_mode = module.check_mode
+    params = module.params
+    profile = params['koji']
+
+    session = common_koji.get_session(profile)
+
+    try:
+        result = transfer_owner(session, check_mode, params['from_owner'],
+                                params['to_owner'], params['tags'],
+                                params['packages'])
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 #!/usr/bin/python
 import copy
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 import sys
+import threading
 from ansible.module_utils.basic import AnsibleModule
-from collections import defaultdict
 from ansible.module_utils import common_koji
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.module_utils.six import string_types
 
 
@@ -21,11 +25,44 @@ module: koji_tag
 short_description: Create and manage Koji tags
 description:
    - Create and manage Koji tags
+   - In check mode, Ansible also returns C(descendants), the number of other
+     tags that inherit from each tag it would change. Koji regenerates the
+     repositories for those tags too, so you can use this to schedule large
+     changes.
 options:
    name:
      description:
        - The name of the Koji tag to create and manage.
-     required: true
+       - You must set either I(name) or I(tags).
+   tags:
+     description:
+       - A list of tags to create and manage in one task, instead of a
+         single I(name). Each list item is a dict with a "name" and any of
+         the per-tag settings of this module (I(inheritance),
+         I(external_repos), I(packages), I(groups), I(inherit_groups),
+         I(blocked_packages), I(prune_inherited), I(arches), I(perm),
+         I(locked), I(maven_support), I(maven_include_all), I(extra)).
+       - Ansible orders the tags so that it creates every parent in this
+         list before the children that inherit from it. It processes the
+         tags in "waves". Each wave contains the tags whose parents are all
+         done, and Ansible processes the tags in a wave concurrently.
+       - With I(state=absent), each list item may also be a plain tag
+         name. Ansible deletes all the tags in one task, children before
+         parents. It refuses to delete any tag if a tag outside this list
+         inherits from it, or if a build target uses it.
+       - Ansible checks the type of each setting like it does for the
+         top-level options, so for example C(locked: "yes") works.
+       - You cannot combine this with the top-level per-tag settings (set
+         them in each list item instead), or with I(packages_file),
+         I(blocked_packages_file), I(single_event), I(fingerprint_file) or
+         I(plan_file).
+     type: list
+   workers:
+     description:
+       - With I(tags), the number of tags to process at the same time. Each
+         worker opens its own Koji session.
+     type: int
+     default: 4
    inheritance:
      description:
        - A list of parents for this tag. Each parent list item must have a
@@ -46,6 +83,9 @@ options:
          you do not set a "merge_mode" and the external repository already
          exists at the given priority, then Ansible will not edit the existing
          merge mode.
+       - If your Koji Hub supports the editTagExternalRepo RPC, Ansible will
+         edit an existing repository's priority or merge mode in place.
+         Otherwise Ansible will remove the repository and add it back.
    packages:
      description:
        - dict of package owners and the a lists of packages each owner
@@ -59,6 +99,16 @@ options:
          tags.
        - If you explicitly set "packages" to an empty dict, Ansible will
          remove all the packages defined on this tag.
+   packages_file:
+     description:
+       - Path to a YAML or JSON file on the Ansible controller with the
+         I(packages) dict. Use this instead of I(packages) for very large
+         package lists. Ansible reads the file without templating it, and
+         sends the list to the module in a compressed form.
+       - Relative paths are relative to the "files" directory of the role
+         or playbook.
+       - This requires the koji_tag action plugin from this project's
+         "action_plugins" directory.
    groups:
      description:
        - A tag's "groups" tell Koji what packages will be present in the
@@ -80,6 +130,17 @@ options:
          configuring extra options on groups, or blocking packages in groups.
          If you need that level of control over comps groups, you will need
          to import a full comps XML file, outside of this Ansible module.
+   inherit_groups:
+     description:
+       - Whether to read the inherited comps groups along with this tag's own
+         groups when comparing the "groups" setting.
+       - Set this to false to fetch only the groups defined directly on this
+         tag. This makes the hub's response much smaller for tags with many
+         inherited groups. Only do this if none of your "groups" or their
+         packages are inherited, otherwise Ansible will try to add them on
+         every run.
+     choices: [true, false]
+     default: true
    blocked_packages:
      description:
        - The list of packages to block in this tag. Each blocked package must
@@ -92,6 +153,10 @@ options:
          list of already-blocked packages in Ansible.
        - If you explicitly set "blocked_packages" to an empty list, Ansible
          will remove all the package blocks for this tag.
+   blocked_packages_file:
+     description:
+       - Path to a YAML or JSON file on the Ansible controller with the
+         I(blocked_packages) list. See I(packages_file).
    arches:
      description:
        - space-separated string of arches this Koji tag supports.
@@ -122,6 +187,86 @@ options:
    extra:
      description:
        - set any extra parameters on this tag.
+   prune_inherited:
+     description:
+       - Do not list packages on this tag when the tag already inherits them
+         from a parent with the same owner, and do not block packages that
+         no parent offers. Ansible removes these redundant entries if they
+         are already on the tag.
+       - Ansible reads each parent's inherited package list and inheritance
+         links once to decide this. It does not skip packages that come
+         through an inheritance rule with a I(pkg_filter) setting, or
+         through a parent's intransitive links.
+       - Ansible reports the number of entries it skipped in
+         C(avoided_rows).
+     type: bool
+     default: false
+   single_event:
+     description:
+       - Send all the changes to this tag in a single multicall request.
+         The Koji hub commits the request in one transaction, so kojira
+         sees all the changes at once and regenerates the repositories for
+         this tag and its descendants once, instead of once for each change.
+       - The hub still records a separate event for each change in the
+         request.
+       - Ansible reads the tag first and records the changes, then sends
+         them together. If the tag does not exist yet, Ansible creates it
+         first, so a new tag takes two requests.
+       - Ansible reports the number of write requests in C(requests).
+     type: bool
+     default: false
+   fingerprint_file:
+     description:
+       - Path to a JSON file where Ansible records a fingerprint of this
+         task's settings, and the Koji event at which it last read this tag.
+         Ansible creates the file if it does not exist. Many koji_tag tasks
+         can share one file.
+       - On later runs, if the settings have the same fingerprint and Koji's
+         history shows no changes to the tag's configuration since that
+         event, Ansible skips reading and comparing the tag entirely. This
+         makes runs that change nothing much faster.
+       - With I(prune_inherited), or with I(groups) and I(inherit_groups),
+         the result also depends on the tag's ancestors, so Ansible checks
+         the history of every ancestor too, with one more multicall.
+       - This is a path on the host that runs the module. koji-ansible tasks
+         normally run on the Ansible controller (localhost).
+       - Only use this when Ansible is the only tool that changes these tags.
+         Changes that do not appear in the tag's history (for example, editing
+         an external repo's URL) will not trigger a full comparison.
+       - You cannot combine this with I(plan_file).
+   plan_file:
+     description:
+       - Path to a JSON file of change plans. Ansible creates the file if it
+         does not exist. Many koji_tag tasks can share one file.
+       - In check mode, Ansible records the exact Koji RPCs that would change
+         this tag, along with the Koji event at which it read the tag.
+       - When I(apply_plan) is true, Ansible sends the recorded RPCs instead
+         of reading and comparing the tag again. It fails without changing
+         anything if the task's settings differ from the settings in the
+         plan, or if Koji's history shows changes to the tag since the plan's
+         event.
+       - Outside of check mode, Ansible ignores this file unless
+         I(apply_plan) is true.
+       - This is a path on the host that runs the module.
+   apply_plan:
+     description:
+       - Send the RPCs that a previous check mode run recorded in
+         I(plan_file), then remove the plan from the file.
+       - If the tag did not exist when Ansible made the plan, Ansible creates
+         and configures the tag normally.
+     type: bool
+     default: false
+   tag_cache_file:
+     description:
+       - Path to a JSON file where Ansible saves the names and IDs of all
+         Koji tags. When you set this, Ansible looks up parent tag IDs in
+         this file instead of asking the hub for each parent. It updates
+         the file from the hub's history of created, edited and deleted
+         tags, and only reads all the tags again with one listTags call
+         when that history is not enough.
+       - Koji does not record tag renames in its history. Delete this file
+         after you rename a tag.
+     type: path
 requirements:
   - "python >= 2.7"
   - "koji"
@@ -168,6 +313,46 @@ EXAMPLES = '''
           srpm-build:
             - rpm-build
             - fedpkg
+
+    - name: Skip reading this tag if nothing changed since the last run
+      koji_tag:
+        name: foo-el7-build
+        fingerprint_file: /var/lib/koji-ansible/fingerprints.json
+        packages:
+          kdreyer:
+            - ceph
+
+    - name: Create a product's tags in dependency order
+      koji_tag:
+        tags:
+          - name: foo-el7-build
+            inheritance:
+            - parent: foo-el7
+              priority: 0
+          - name: foo-el7
+            arches: x86_64
+            packages:
+              kdreyer:
+                - ceph
+
+    - name: Retire a product's tags
+      koji_tag:
+        state: absent
+        tags:
+          - foo-el7
+          - foo-el7-build
+          - foo-el7-candidate
+
+    # Run this once with --check to review the changes, and again without
+    # --check to send exactly those changes.
+    - name: Plan and apply changes to a tag
+      koji_tag:
+        name: foo-el7-build
+        plan_file: /var/lib/koji-ansible/plans.json
+        apply_plan: "{{ not ansible_check_mode }}"
+        packages:
+          kdreyer:
+            - ceph
 '''
 
 RETURN = ''' # '''
@@ -183,6 +368,11 @@ class DuplicatePriorityError(Exception):
     pass
 
 
+class PlanError(Exception):
+    """ We cannot safely apply a change plan. """
+    pass
+
+
 def validate_repos(repos):
     """Ensure that each external repository has unique name and priority
     values.
@@ -255,18 +445,20 @@ def ensure_inheritance(session, tag_name, tag_id, check_mode, inheritance):
 
     # resolve parent tag IDs
     rules = []
-    for rule in normalize_inheritance(inheritance):
+    normalized = normalize_inheritance(inheritance)
+    parent_ids = common_koji.get_tag_ids(
+        session, [rule['name'] for rule in normalized])
+    for rule in normalized:
         parent_name = rule['name']
-        parent_taginfo = session.getTag(parent_name)
-        if not parent_taginfo:
+        parent_id = parent_ids[parent_name]
+        if not parent_id:
             msg = "parent tag '%s' not found" % parent_name
             if check_mode:
                 result['stdout_lines'].append(msg)
                 # spoof to allow continuation
-                parent_taginfo = {'id': 0}
+                parent_id = 0
             else:
                 raise ValueError(msg)
-        parent_id = parent_taginfo['id']
         rules.append(dict(rule, child_id=tag_id, parent_id=parent_id))
 
     current_inheritance = session.getInheritanceData(tag_name)
@@ -282,41 +474,18 @@ def ensure_inheritance(session, tag_name, tag_id, check_mode, inheritance):
         differences = common_koji.task_diff_data(
             current_settings, new_settings, tag_name, 'tag')
         result['diff'] = differences
+        # Parents that do not exist (in check mode) cannot form a loop.
+        graph = common_koji.InheritanceGraph()
+        graph.names[tag_id] = tag_name
+        common_koji.check_inheritance_changes(
+            session, {tag_id: [rule for rule in rules if rule['parent_id']]},
+            graph)
         if not check_mode:
             common_koji.ensure_logged_in(session)
             session.setInheritanceData(tag_name, rules, clear=True)
     return result
 
 
-def remove_external_repos(session, tag_name, repos):
-    """
-    Remove all these external repos from this Koji tag.
-
-    :param session: Koji client session
-    :param str tag_name: Koji tag name
-    :param list repos: list of repository names (str) to remove.
-    """
-    # TODO: refactor this loop to one single multicall.
-    common_koji.ensure_logged_in(session)
-    for name in repos:
-        session.removeExternalRepoFromTag(tag_name, name)
-
-
-def add_external_repos(session, tag_name, repos):
-    """
-    Add all these external repos to this Koji tag.
-
-    :param session: Koji client session
-    :param str tag_name: Koji tag name
-    :param list repos: list of dicts, one for each repository to add. These
-                       dicts are kwargs to the addExternalRepoToTag RPC.
-    """
-    # TODO: refactor this loop to one single multicall.
-    common_koji.ensure_logged_in(session)
-    for repo in repos:
-        session.addExternalRepoToTag(tag_name, **repo)
-
-
 def format_external_repos(repo_list):
     """
     Format external repo list.
@@ -338,6 +507,11 @@ def ensure_external_repos(session, tag_name, check_mode, repos):
     """
     Ensure that these external repos are configured on this Koji tag.
 
+    If only the priority or merge mode of an existing repo differs, and the
+    hub supports the editTagExternalRepo RPC, we edit the repo in place.
+    Otherwise we remove the repo and add it back. We send all the changes to
+    the hub in one multicall.
+
     :param session: Koji client session
     :param str tag_name: Koji tag name
     :param bool check_mode: don't make any changes
@@ -349,45 +523,74 @@ def ensure_external_repos(session, tag_name, check_mode, repos):
     current = session.getTagExternalRepos(tag_name)
     current_repos = {repo['external_repo_name']: repo for repo in current}
     desired_repos = {repo['repo']: repo for repo in repos}
-    # Remove all the incorrect repos first.
+    # Find all the repos to remove entirely, and the repos that differ.
     repos_to_remove = set()
+    repos_to_change = []
     for name, repo in current_repos.items():
         if name not in desired_repos:
             msg = 'Removing %s repo from tag %s' % (name, tag_name)
             result['stdout_lines'].append(msg)
             repos_to_remove.add(name)
             continue
-        priority = repo['priority']
-        desired_priority = desired_repos[name]['priority']
-        if priority != desired_priority:
+        desired_repo = desired_repos[name]
+        if repo['priority'] != desired_repo['priority']:
+            repos_to_change.append(name)
+            continue
+        if 'merge_mode' in desired_repo:
+            if repo['merge_mode'] != desired_repo['merge_mode']:
+                repos_to_change.append(name)
+    # We can edit a repo in place if its new priority does not collide with
+    # another repo that will remain on this tag.
+    repos_to_edit = []
+    if repos_to_change and \
+            common_koji.hub_has_method(session, 'editTagExternalRepo'):
+        for name in repos_to_change:
+            priority = desired_repos[name]['priority']
+            collisions = [other for other, repo in current_repos.items()
+                          if other != name
+                          and other not in repos_to_remove
+                          and repo['priority'] == priority]
+            if not collisions:
+                repos_to_edit.append(name)
+    # Remove and re-add the changed repos that we cannot edit in place.
+    for name in repos_to_change:
+        if name in repos_to_edit:
+            continue
+        repo = current_repos[name]
+        if repo['priority'] != desired_repos[name]['priority']:
             msg = 'Removing %s repo at priority %d from tag %s' \
-                  % (name, priority, tag_name)
+                  % (name, repo['priority'], tag_name)
+        else:
+            msg = 'Removing %s repo with merge mode "%s" from tag %s' \
+                  % (name, repo['merge_mode'], tag_name)
+        result['stdout_lines'].append(msg)
+        repos_to_remove.add(name)
+    calls = [('removeExternalRepoFromTag', (tag_name, name), {})
+             for name in repos_to_remove]
+    # Next, find all the repos to edit in place.
+    for name in repos_to_edit:
+        current_repo = current_repos[name]
+        desired_repo = desired_repos[name]
+        edits = {}
+        if desired_repo['priority'] != current_repo['priority']:
+            edits['priority'] = desired_repo['priority']
+            msg = 'Changing %s repo priority from %d to %d on tag %s' \
+                  % (name, current_repo['priority'],
+                     desired_repo['priority'], tag_name)
             result['stdout_lines'].append(msg)
-            repos_to_remove.add(name)
-            continue
-        if 'merge_mode' in desired_repos[name]:
-            merge_mode = repo['merge_mode']
-            desired_merge_mode = desired_repos[name]['merge_mode']
-            if merge_mode != desired_merge_mode:
-                msg = 'Removing %s repo with merge mode "%s" from tag %s' \
-                      % (name, merge_mode, tag_name)
-                result['stdout_lines'].append(msg)
-                repos_to_remove.add(name)
-    # Perform the removals.
-    if repos_to_remove and not check_mode:
-        remove_external_repos(session, tag_name, repos_to_remove)
+        if 'merge_mode' in desired_repo and \
+                desired_repo['merge_mode'] != current_repo['merge_mode']:
+            edits['merge_mode'] = desired_repo['merge_mode']
+            msg = 'Changing %s repo merge mode from "%s" to "%s" on tag %s' \
+                  % (name, current_repo['merge_mode'],
+                     desired_repo['merge_mode'], tag_name)
+            result['stdout_lines'].append(msg)
+        calls.append(('editTagExternalRepo', (tag_name, name), edits))
     # Next, find all the repos to add.
-    repos_to_add = []
     for name, desired_repo in desired_repos.items():
-        if name in current_repos:
-            current_repo = current_repos[name]
-            if desired_repo['priority'] == current_repo['priority']:
-                if 'merge_mode' not in desired_repo:
-                    # This repo is currently correct. Move on to the next one.
-                    continue
-                if desired_repo['merge_mode'] == current_repo['merge_mode']:
-                    # This repo is currently correct. Move on to the next one.
-                    continue
+        if name in current_repos and name not in repos_to_remove:
+            # This repo is currently correct, or we edit it in place.
+            continue
         msg = 'Adding %s repo with prio %d to tag %s' \
               % (name, desired_repo['priority'], tag_name)
         new_repo = {'repo_info': name, 'priority': desired_repo['priority']}
@@ -395,10 +598,11 @@ def ensure_external_repos(session, tag_name, check_mode, repos):
             new_repo['merge_mode'] = desired_repo['merge_mode']
             msg += ' with merge mode "%s"' % desired_repo['merge_mode']
         result['stdout_lines'].append(msg)
-        repos_to_add.append(new_repo)
-    # Perform the additions.
-    if repos_to_add and not check_mode:
-        add_external_repos(session, tag_name, repos_to_add)
+        calls.append(('addExternalRepoToTag', (tag_name,), new_repo))
+    # Perform all the changes at once.
+    if calls and not check_mode:
+        common_koji.ensure_logged_in(session)
+        common_koji.multicall(session, calls)
     if result['stdout_lines']:
         result['changed'] = True
         current_repos = common_koji.clean_data(
@@ -413,7 +617,8 @@ def ensure_external_repos(session, tag_name, check_mode, repos):
     return result
 
 
-def ensure_packages(session, tag_name, tag_id, check_mode, packages):
+def ensure_packages(session, tag_name, tag_id, check_mode, packages,
+                    blocked=None, current_pkgs=None, calls=None):
     """
     Ensure that these packages are configured on this Koji tag.
 
@@ -423,65 +628,69 @@ def ensure_packages(session, tag_name, tag_id, check_mode, packages):
     :param bool check_mode: don't make any changes
     :param dict packages: Ensure that these owners and package names are
                           configured for this tag.
+    :param list blocked: package names that should remain blocked on this
+                         tag. We leave these entries alone instead of
+                         removing them (and blocking them again later).
+    :param dict current_pkgs: the tag's package index, if the caller
+                              already read it with get_package_index().
+    :param list calls: if set, append the write RPCs to this list instead of
+                       sending them.
     :returns: result
     """
     result = {'changed': False, 'stdout_lines': []}
-    # Note: this in particular could really benefit from koji's
-    # multicalls...
-    current_pkgs = session.listPackages(tagID=tag_id)
-    current_names = set([pkg['package_name'] for pkg in current_pkgs])
-    # Create a "current_owned" dict to compare with what's in Ansible.
-    current_owned = defaultdict(set)
-    # Get the list of and owner package name
-    clean_current_pkgs = common_koji.clean_data(
-        copy.copy(current_pkgs), ['owner_name', 'package_name'])
-    current_settings = {
-        'packages': clean_current_pkgs} if clean_current_pkgs else {}
-    new_settings = {'packages': []}
-    for pkg in current_pkgs:
-        owner = pkg['owner_name']
-        pkg_name = pkg['package_name']
-        current_owned[owner].add(pkg_name)
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_id)
+    changes = []
+    desired_names = set()
     for owner, owned in packages.items():
         for package in owned:
-            new_settings['packages'].append(
-                {'owner_name': owner, 'package_name': package})
-            if package not in current_names:
+            desired_names.add(package)
+            if package not in current_pkgs:
                 # The package was missing from the tag entirely.
-                if not check_mode:
-                    common_koji.ensure_logged_in(session)
-                    session.packageListAdd(tag_name, package, owner)
+                changes.append(('packageListAdd',
+                                (tag_name, package, owner), {}))
                 result['stdout_lines'].append('added pkg %s' % package)
-                result['changed'] = True
-            else:
-                # The package is already in this tag.
-                # Verify ownership.
-                if package not in current_owned.get(owner, []):
-                    if not check_mode:
-                        common_koji.ensure_logged_in(session)
-                        session.packageListSetOwner(tag_name, package, owner)
-                    result['stdout_lines'].append('set %s owner %s' %
-                                                  (package, owner))
-                    result['changed'] = True
+            elif current_pkgs.owner(package) != owner:
+                # The package is already in this tag with another owner.
+                changes.append(('packageListSetOwner',
+                                (tag_name, package, owner), {}))
+                result['stdout_lines'].append('set %s owner %s' %
+                                              (package, owner))
     # Delete any packages not in Ansible.
-    all_names = [name for names in packages.values() for name in names]
-    delete_names = set(current_names) - set(all_names)
-    for package in delete_names:
+    keep_blocked = set(blocked or [])
+    for package in current_pkgs:
+        if package in desired_names:
+            continue
+        if package in keep_blocked and current_pkgs.is_blocked(package):
+            continue
         result['stdout_lines'].append('remove pkg %s' % package)
-        result['changed'] = True
-        if not check_mode:
-            common_koji.ensure_logged_in(session)
-            session.packageListRemove(tag_name, package)
+        changes.append(('packageListRemove', (tag_name, package), {}))
 
-    if result['changed']:
+    if changes:
+        result['changed'] = True
+        current_settings = {'packages': [
+            {'owner_name': owner, 'package_name': package}
+            for package, (owner, _) in current_pkgs.items()
+        ]} if current_pkgs else {}
+        new_settings = {'packages': [
+            {'owner_name': owner, 'package_name': package}
+            for owner, owned in packages.items()
+            for package in owned
+        ]}
         differences = common_koji.task_diff_data(
             current_settings, new_settings, tag_name, 'tag')
         result['diff'] = differences
+        if calls is not None:
+            calls.extend(changes)
+        elif not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, changes)
 
     return result
 
 
-def ensure_groups(session, tag_id, check_mode, desired_groups):
+def ensure_groups(session, tag_id, check_mode, desired_groups,
+                  inherit=True):
     """
     Ensure that these groups are configured on this Koji tag.
 
@@ -490,62 +699,64 @@ def ensure_groups(session, tag_id, check_mode, desired_groups):
     :param bool check_mode: don't make any changes
     :param dict desired_groups: Ensure that these group names and packages are
                                 configured for this tag.
+    :param bool inherit: read inherited groups as well as the groups defined
+                         directly on this tag. If False, the hub returns a
+                         smaller payload, but Ansible cannot tell that a
+                         desired group or package is already inherited.
     :returns: result
     """
     result = {'changed': False, 'stdout_lines': []}
-    current_groups = session.getTagGroups(tag_id)
-    current_settings = {'groups': copy.copy(
-        current_groups)} if current_groups else {}
+    current_groups = session.getTagGroups(tag_id, inherit=inherit)
     new_settings = {'groups': []}
+    groups_by_name = {group['name']: group for group in current_groups}
+    calls = []
     for group in current_groups:
         if group['tag_id'] == tag_id and group['name'] not in desired_groups:
-            if not check_mode:
-                common_koji.ensure_logged_in(session)
-                session.groupListRemove(tag_id, group['name'])
+            calls.append(('groupListRemove', (tag_id, group['name']), {}))
             result['stdout_lines'].append('removed group %s' % group['name'])
-            result['changed'] = True
     for group_name, desired_pkgs in desired_groups.items():
         new_group = {'tag_id': tag_id, 'name': group_name,
                      'packagelist': desired_pkgs}
         new_settings['groups'].append(new_group)
-        for group in current_groups:
-            if group['name'] == group_name:
-                current_pkgs = {entry['package']: entry['tag_id']
-                                for entry in group['packagelist']}
-                break
+        group = groups_by_name.get(group_name)
+        if group:
+            current_pkgs = {entry['package']: entry['tag_id']
+                            for entry in group['packagelist']}
         else:
             current_pkgs = {}
-            if not check_mode:
-                common_koji.ensure_logged_in(session)
-                session.groupListAdd(tag_id, group_name)
+            calls.append(('groupListAdd', (tag_id, group_name), {}))
             result['stdout_lines'].append('added group %s' % group_name)
-            result['changed'] = True
 
+        desired_set = set(desired_pkgs)
         for package, pkg_tag_id in current_pkgs.items():
-            if pkg_tag_id == tag_id and package not in desired_pkgs:
-                if not check_mode:
-                    common_koji.ensure_logged_in(session)
-                    session.groupPackageListRemove(tag_id, group_name, package)
+            if pkg_tag_id == tag_id and package not in desired_set:
+                calls.append(('groupPackageListRemove',
+                              (tag_id, group_name, package), {}))
                 result['stdout_lines'].append(
                     'removed pkg %s from group %s' % (package, group_name))
-                result['changed'] = True
         for package in desired_pkgs:
             if package not in current_pkgs:
-                if not check_mode:
-                    common_koji.ensure_logged_in(session)
-                    session.groupPackageListAdd(tag_id, group_name, package)
+                calls.append(('groupPackageListAdd',
+                              (tag_id, group_name, package), {}))
                 result['stdout_lines'].append(
                     'added pkg %s to group %s' % (package, group_name))
-                result['changed'] = True
-    if result['changed']:
+    if calls:
+        result['changed'] = True
+        current_settings = {'groups': copy.copy(
+            current_groups)} if current_groups else {}
         differences = common_koji.task_diff_data(
             current_settings, new_settings, tag_id, 'tag')
         result['diff'] = differences
+        if not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, calls)
 
     return result
 
 
-def ensure_blocked_packages(session, tag_id, check_mode, packages):
+def ensure_blocked_packages(session, tag_id, check_mode, packages,
+                            whitelist=None, current_pkgs=None, calls=None,
+                            unneeded=()):
     """
     Ensure that these packages are blocked on this Koji tag.
 
@@ -553,53 +764,58 @@ def ensure_blocked_packages(session, tag_id, check_mode, packages):
     :param int tag_id: Koji tag ID
     :param bool check_mode: don't make any changes
     :param list packages: package names to block.
+    :param whitelist: if ensure_packages() manages this tag's package list,
+                      the package names it keeps. ensure_packages() removes
+                      every other blocked entry, so we don't unblock those.
+    :param dict current_pkgs: the tag's package index, if the caller
+                              already read it with get_package_index().
+    :param list calls: if set, append the write RPCs to this list instead of
+                       sending them.
+    :param unneeded: package names whose blocks no parent needs. We remove
+                     these entries instead of unblocking them, because an
+                     unblock would leave the package listed on this tag.
     :returns: result
     """
-    # TODO: move this to common_koji and share with koji_tag_packages.py
     result = {'changed': False, 'stdout_lines': []}
-    koji_profile = sys.modules[session.__module__]
-    try:
-        current_pkgs = session.listPackages(tagID=tag_id, with_owners=False)
-    except koji_profile.ParameterError as e:
-        # Koji Hubs before v1.25 do not have with_owners performance
-        # optimization
-        if "unexpected keyword argument 'with_owners'" in str(e):
-            current_pkgs = session.listPackages(tagID=tag_id)
-        else:
-            raise
-    current_blocked = set(pkg['package_name']
-                          for pkg in current_pkgs if pkg['blocked'])
-    to_block = set()
-    to_unblock = set()
-    current_settings = {'blocked_packages': list(
-        current_blocked)} if current_blocked else {}
-    new_settings = {'blocked_packages': packages}
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_id,
+                                                     with_owners=False)
+    current_blocked = current_pkgs.blocked()
+    changes = []
     for package in packages:
-        if package not in current_blocked:
-            to_block.add(package)
+        if not current_pkgs.is_blocked(package):
+            changes.append(('packageListBlock', (tag_id, package), {}))
             result['stdout_lines'].append('blocked pkg %s' % package)
-            result['changed'] = True
+    desired_blocked = set(packages)
     for package in current_blocked:
-        if package not in packages:
-            to_unblock.add(package)
+        if package not in desired_blocked:
+            if whitelist is not None and package not in whitelist:
+                continue
+            if package in unneeded:
+                changes.append(('packageListRemove', (tag_id, package), {}))
+                result['stdout_lines'].append('remove pkg %s' % package)
+                continue
+            changes.append(('packageListUnblock', (tag_id, package), {}))
             result['stdout_lines'].append('unblocked pkg %s' % package)
-            result['changed'] = True
-    if result['changed']:
+    if changes:
+        result['changed'] = True
+        current_settings = {'blocked_packages': current_blocked} \
+            if current_blocked else {}
+        new_settings = {'blocked_packages': packages}
         differences = common_koji.task_diff_data(
             current_settings, new_settings, tag_id, 'tag')
         result['diff'] = differences
-        if not check_mode:
+        if calls is not None:
+            calls.extend(changes)
+        elif not check_mode:
             common_koji.ensure_logged_in(session)
-            # TODO: use koji multicalls here
-            for package in to_block:
-                session.packageListBlock(tag_id, package)
-            for package in to_unblock:
-                session.packageListUnblock(tag_id, package)
+            common_koji.multicall(session, changes)
     return result
 
 
 def ensure_tag(session, name, check_mode, inheritance, external_repos,
-               packages, groups, blocked_packages, **kwargs):
+               packages, groups, blocked_packages, inherit_groups=True,
+               prune_inherited=False, **kwargs):
     """
     Ensure that this tag exists in Koji.
 
@@ -614,6 +830,11 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
                      for this tag.
     :param groups: dict of comps groups to set for this tag.
     :param blocked_packages: list of packages to block in this tag.
+    :param inherit_groups: read inherited comps groups when comparing
+                           "groups".
+    :param prune_inherited: skip packages that this tag inherits with the
+                            same owner, and blocks of packages that no parent
+                            offers.
     :param **kwargs: Pass remaining kwargs directly into Koji's createTag and
                      editTag2 RPCs.
     :returns: result
@@ -635,6 +856,7 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
         if 'perm' in kwargs and kwargs['perm']:
             kwargs['perm'] = common_koji.get_perm_id(session, kwargs['perm'])
         id_ = session.createTag(name, parent=None, **kwargs)
+        common_koji.tag_id_cache[name] = id_
         result['stdout_lines'].append('created tag id %d' % id_)
         result['changed'] = True
         taginfo = {'id': id_}  # populate for inheritance management below
@@ -698,12 +920,44 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
             )
         result['stdout_lines'].extend(repos_result['stdout_lines'])
 
+    if packages not in (None, '') and not isinstance(packages, dict):
+        raise ValueError('packages must be a dict')
+
+    # Skip packages and blocks that inheritance makes redundant.
+    unneeded = set()
+    if prune_inherited and (packages or blocked_packages):
+        if inheritance not in (None, ['']):
+            rules = normalize_inheritance(inheritance)
+        else:
+            rules = session.getInheritanceData(name)
+        inherited, provided = common_koji.get_inherited_packages(session,
+                                                                 rules)
+        packages, redundant, blocked_packages, unneeded = \
+            common_koji.prune_package_lists(packages, blocked_packages,
+                                            inherited, provided)
+        if redundant:
+            result['stdout_lines'].append(
+                'skipped %d packages inherited from parents' % len(redundant))
+        if unneeded:
+            result['stdout_lines'].append(
+                'skipped %d blocks of packages that no parent offers'
+                % len(unneeded))
+        result['avoided_rows'] = len(redundant) + len(unneeded)
+
+    # Read the package list once for both the packages and blocked_packages
+    # settings, and send all their changes in one batch at the end.
+    current_pkgs = None
+    package_calls = []
+    if packages not in (None, '') or blocked_packages not in (None, ''):
+        current_pkgs = common_koji.get_package_index(
+            session, taginfo['id'], with_owners=packages not in (None, ''))
+
     # Ensure package list.
     if packages not in (None, ''):
-        if not isinstance(packages, dict):
-            raise ValueError('packages must be a dict')
         packages_result = ensure_packages(session, name, taginfo['id'],
-                                          check_mode, packages)
+                                          check_mode, packages,
+                                          blocked_packages, current_pkgs,
+                                          package_calls)
         if packages_result['changed']:
             result['changed'] = True
             result['diff'] = common_koji.combine_diff_data(
@@ -716,7 +970,7 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
         if not isinstance(groups, dict):
             raise ValueError('groups must be a dict')
         groups_result = ensure_groups(session, taginfo['id'],
-                                      check_mode, groups)
+                                      check_mode, groups, inherit_groups)
         if groups_result['changed']:
             result['changed'] = True
             result['diff'] = common_koji.combine_diff_data(
@@ -726,11 +980,19 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
 
     # Ensure blocked package list.
     if blocked_packages not in (None, ''):
+        whitelist = None
+        if packages not in (None, ''):
+            whitelist = set(package for owned in packages.values()
+                            for package in owned)
         blocked_packages_result = ensure_blocked_packages(
             session,
             taginfo['id'],
             check_mode,
             blocked_packages,
+            whitelist,
+            current_pkgs,
+            package_calls,
+            unneeded,
         )
         if blocked_packages_result['changed']:
             result['changed'] = True
@@ -739,6 +1001,513 @@ def ensure_tag(session, name, check_mode, inheritance, external_repos,
             )
         result['stdout_lines'].extend(blocked_packages_result['stdout_lines'])
 
+    if package_calls and not check_mode:
+        common_koji.ensure_logged_in(session)
+        common_koji.multicall(session, package_calls)
+
+    return result
+
+
+# Koji's history tables that describe a tag's configuration. We never ask
+# for the tag_listing table, because a busy build tag has a huge history
+# of tagged builds.
+CONFIG_HISTORY_TABLES = ('tag_config', 'tag_extra', 'tag_inheritance',
+                         'tag_packages', 'tag_external_repos', 'group_config',
+                         'group_req_listing', 'group_package_listing')
+
+# Newer hubs keep package owner changes in their own table. Older hubs
+# record them in tag_packages, and reject this table name.
+OWNER_HISTORY_TABLE = 'tag_package_owners'
+
+
+def get_fingerprint(name, **kwargs):
+    """
+    Return a hash of the normalized desired settings for this tag.
+
+    Two sets of settings that mean the same thing to Koji (for example, the
+    same packages in a different order) have the same fingerprint.
+
+    :param str name: Koji tag name
+    :param **kwargs: all the other ensure_tag() settings.
+    :returns: str, a hex digest
+    """
+    spec = dict(kwargs, name=name)
+    if spec.get('inheritance') not in (None, ['']):
+        spec['inheritance'] = normalize_inheritance(spec['inheritance'])
+    if spec.get('external_repos') not in (None, ['']):
+        spec['external_repos'] = sorted(spec['external_repos'],
+                                        key=lambda r: r['priority'])
+    if isinstance(spec.get('packages'), dict):
+        spec['packages'] = {owner: sorted(owned)
+                            for owner, owned in spec['packages'].items()}
+    if isinstance(spec.get('groups'), dict):
+        spec['groups'] = {group: sorted(pkgs)
+                          for group, pkgs in spec['groups'].items()}
+    if isinstance(spec.get('blocked_packages'), list):
+        spec['blocked_packages'] = sorted(spec['blocked_packages'])
+    text = json.dumps(spec, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def tag_changed_since(session, name, event_id, ancestors=False):
+    """
+    Return True if anyone changed this tag's configuration after this event.
+
+    :param session: Koji client session
+    :param str name: Koji tag name
+    :param int event_id: Koji event ID
+    :param bool ancestors: also return True if anyone changed the
+                           configuration of any tag that this tag inherits
+                           from. We read all the ancestors' history in one
+                           multicall.
+    """
+    tags = [name]
+    if ancestors:
+        links = session.getFullInheritance(name)
+        tags.extend(sorted(set(link['parent_id'] for link in links)))
+    koji_profile = sys.modules[session.__module__]
+    tables = list(CONFIG_HISTORY_TABLES) + [OWNER_HISTORY_TABLE]
+    try:
+        histories = query_tag_histories(session, tags, event_id, tables)
+    except koji_profile.GenericError:
+        histories = query_tag_histories(session, tags, event_id,
+                                        list(CONFIG_HISTORY_TABLES))
+    for history in histories:
+        for entries in history.values():
+            if entries:
+                return True
+    return False
+
+
+def query_tag_histories(session, tags, event_id, tables):
+    """ Read these tags' history of these tables in one multicall. """
+    calls = [('queryHistory', (), {'tables': tables, 'tag': tag,
+                                   'afterEvent': event_id})
+             for tag in tags]
+    return common_koji.multicall(session, calls)
+
+
+def ensure_tag_fingerprint(session, profile, name, check_mode,
+                           fingerprint_file, single_event=False, **kwargs):
+    """
+    Ensure that this tag exists in Koji, skipping the work if nothing changed.
+
+    We store a fingerprint of the desired settings and the Koji event ID at
+    which we last read the tag in fingerprint_file. If the fingerprint
+    matches, and Koji's history shows no changes to the tag since that event,
+    the tag must still match, and we skip reading it entirely. When the
+    result depends on inherited packages or groups, we also check the
+    history of the tag's ancestors.
+
+    :param session: Koji client session
+    :param str profile: Koji profile name
+    :param str name: Koji tag name
+    :param bool check_mode: don't make any changes
+    :param str fingerprint_file: path to the JSON state file
+    :param bool single_event: send all changes in one multicall request.
+    :param **kwargs: Pass remaining kwargs directly into ensure_tag().
+    :returns: result
+    """
+    fingerprint = get_fingerprint(name, **kwargs)
+    state = common_koji.load_state(fingerprint_file)
+    saved = state.get(profile, {}).get(name)
+    if saved and saved['fingerprint'] == fingerprint:
+        event_id = saved['event_id']
+        ancestors = uses_inherited_data(**kwargs)
+        if not tag_changed_since(session, name, event_id, ancestors):
+            msg = 'tag %s unchanged since event %d' % (name, event_id)
+            return {'changed': False, 'stdout_lines': [msg]}
+    # Record the event before we read the tag. If anyone (including us)
+    # changes the tag after this point, the next run will read it again.
+    event_id = session.getLastEvent()['id']
+    if single_event:
+        result = ensure_tag_single_event(session, name, check_mode, **kwargs)
+    else:
+        result = ensure_tag(session, name, check_mode, **kwargs)
+    if not check_mode:
+        value = {'fingerprint': fingerprint, 'event_id': event_id}
+        common_koji.update_state(fingerprint_file, profile, name, value)
+    return result
+
+
+def uses_inherited_data(**kwargs):
+    """
+    Return True if ensure_tag()'s changes depend on the tag's ancestors.
+
+    :param **kwargs: ensure_tag() settings
+    """
+    if kwargs.get('prune_inherited'):
+        return True
+    return bool(kwargs.get('groups') and kwargs.get('inherit_groups', True))
+
+
+# Read-only RPCs that ensure_tag() sends while we record a change plan.
+PLAN_READ_METHODS = (
+    'getAllPerms',
+    'getInheritanceData',
+    'getLastEvent',
+    'getTag',
+    'getTagExternalRepos',
+    'getTagGroups',
+    'listPackages',
+)
+
+# Number of recorded RPCs to send in each multicall request.
+PLAN_BATCH_SIZE = 500
+
+
+def record_tag_changes(session, name, check_mode, **kwargs):
+    """
+    Record the write RPCs that ensure_tag() would send for this tag.
+
+    :param session: Koji client session
+    :param str name: Koji tag name
+    :param bool check_mode: the task runs in check mode
+    :param **kwargs: Pass remaining kwargs directly into ensure_tag().
+    :returns: two-element tuple: the ensure_tag() result, and a list of
+              recorded (method, args, kwargs) tuples. The list is None if we
+              could not record the changes, for example because a parent tag
+              does not exist. In check mode we report that like ensure_tag()
+              does, and outside check mode we raise the error.
+    """
+    recorder = common_koji.RecordingSession(session, PLAN_READ_METHODS)
+    try:
+        return ensure_tag(recorder, name, False, **kwargs), recorder.calls
+    except ValueError:
+        if not check_mode:
+            raise
+    return ensure_tag(session, name, True, **kwargs), None
+
+
+def plan_tag(session, profile, name, plan_file, **kwargs):
+    """
+    Record the RPCs that would make this tag match these settings.
+
+    We read the tag normally, but record each write RPC in plan_file instead
+    of sending it to the hub. Planning is always a check-mode run: if we
+    cannot record the changes (for example because a parent tag does not
+    exist), we report that and remove any old plan for this tag.
+
+    :param session: Koji client session
+    :param str profile: Koji profile name
+    :param str name: Koji tag name
+    :param str plan_file: path to the JSON plan file
+    :param **kwargs: Pass remaining kwargs directly into ensure_tag().
+    :returns: result
+    """
+    # Record the event before we read the tag. apply_tag_plan() refuses to
+    # send our RPCs if anyone changes the tag after this point.
+    event_id = session.getLastEvent()['id']
+    create = not session.getTag(name)
+    if create:
+        # Later RPCs need the new tag's ID, so we can't record them yet.
+        result = ensure_tag(session, name, True, **kwargs)
+        calls = []
+    else:
+        result, recorded = record_tag_changes(session, name, True, **kwargs)
+        if recorded is None:
+            # There is nothing we could safely apply later.
+            common_koji.update_state(plan_file, profile, name, None)
+            return result
+        calls = [[method, list(args), kwargs_]
+                 for method, args, kwargs_ in recorded]
+    plan = {
+        'fingerprint': get_fingerprint(name, **kwargs),
+        'event_id': event_id,
+        'create': create,
+        'calls': calls,
+        'stdout_lines': result['stdout_lines'],
+    }
+    common_koji.update_state(plan_file, profile, name, plan)
+    return result
+
+
+def apply_tag_plan(session, profile, name, check_mode, plan_file, **kwargs):
+    """
+    Send the RPCs that plan_tag() recorded for this tag.
+
+    :param session: Koji client session
+    :param str profile: Koji profile name
+    :param str name: Koji tag name
+    :param bool check_mode: check the plan, but don't make any changes
+    :param str plan_file: path to the JSON plan file
+    :param **kwargs: the ensure_tag() settings for this task. These must
+                     match the settings that we planned.
+    :raises: PlanError if we cannot safely apply the plan.
+    :returns: result
+    """
+    state = common_koji.load_state(plan_file)
+    plan = state.get(profile, {}).get(name)
+    if not plan:
+        raise PlanError('no plan for tag %s in %s' % (name, plan_file))
+    if plan['fingerprint'] != get_fingerprint(name, **kwargs):
+        msg = 'settings for tag %s differ from the plan in %s'
+        raise PlanError(msg % (name, plan_file))
+    event_id = plan['event_id']
+    if plan['create']:
+        if session.getTag(name):
+            msg = 'tag %s was created after event %d'
+            raise PlanError(msg % (name, event_id))
+        result = ensure_tag(session, name, check_mode, **kwargs)
+    else:
+        ancestors = uses_inherited_data(**kwargs)
+        if tag_changed_since(session, name, event_id, ancestors):
+            msg = 'tag %s changed after event %d'
+            if ancestors:
+                msg = 'tag %s or its parents changed after event %d'
+            raise PlanError(msg % (name, event_id))
+        calls = [(method, args, kwargs_)
+                 for method, args, kwargs_ in plan['calls']]
+        if calls and not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, calls, batch=PLAN_BATCH_SIZE)
+        result = {'changed': bool(calls),
+                  'stdout_lines': plan['stdout_lines']}
+    if not check_mode:
+        common_koji.update_state(plan_file, profile, name, None)
+    return result
+
+
+# ensure_tag() settings that configure a tag after we create it.
+TAG_LIST_SETTINGS = ('inheritance', 'external_repos', 'packages', 'groups',
+                     'blocked_packages')
+
+
+def ensure_tag_single_event(session, name, check_mode, **kwargs):
+    """
+    Ensure that this tag exists in Koji, with one request for all changes.
+
+    We record the write RPCs that ensure_tag() would send, and then send
+    them all in one multicall. The hub commits each multicall in one
+    transaction, but it still records a separate event for each write.
+
+    :param session: Koji client session
+    :param str name: Koji tag name
+    :param bool check_mode: don't make any changes
+    :param **kwargs: Pass remaining kwargs directly into ensure_tag().
+    :returns: result, with the number of write requests in "requests".
+    """
+    if not session.getTag(name):
+        result = ensure_tag(session, name, check_mode,
+                            **dict(kwargs, **dict.fromkeys(TAG_LIST_SETTINGS)))
+        if check_mode:
+            # We can't read the rest of the changes before the tag exists.
+            result['requests'] = 1
+            return result
+        requests = 1
+    else:
+        result = {'changed': False, 'stdout_lines': []}
+        requests = 0
+    settings_result, calls = record_tag_changes(session, name, check_mode,
+                                                **kwargs)
+    if calls:
+        requests += 1
+        if not check_mode:
+            common_koji.ensure_logged_in(session)
+            common_koji.multicall(session, calls)
+    if settings_result['changed']:
+        result['changed'] = True
+        result['diff'] = common_koji.combine_diff_data(
+            'tag', name, result, settings_result)
+    result['stdout_lines'].extend(settings_result['stdout_lines'])
+    if 'avoided_rows' in settings_result:
+        result['avoided_rows'] = settings_result['avoided_rows']
+    result['requests'] = requests
+    return result
+
+
+# Argument spec for the settings of one tag. We accept these settings as
+# top-level options, or in each item of the "tags" list.
+TAG_ARGUMENT_SPEC = dict(
+    inheritance=dict(type='list'),
+    external_repos=dict(type='list'),
+    packages=dict(type='raw'),
+    groups=dict(type='raw'),
+    inherit_groups=dict(type='bool', default=True),
+    prune_inherited=dict(type='bool', default=False),
+    blocked_packages=dict(type='list'),
+    arches=dict(),
+    perm=dict(),
+    locked=dict(type='bool', default=False),
+    maven_support=dict(type='bool', default=False),
+    maven_include_all=dict(type='bool', default=False),
+    extra=dict(type='dict'),
+)
+
+# Per-tag settings that we accept in each item of the "tags" list, and their
+# defaults.
+TAG_SETTINGS = dict((key, spec.get('default'))
+                    for key, spec in TAG_ARGUMENT_SPEC.items())
+
+# Top-level options that only apply to a single "name" tag.
+SINGLE_TAG_OPTIONS = tuple(sorted(TAG_ARGUMENT_SPEC)) + (
+    'packages_file', 'blocked_packages_file', 'packages_data',
+    'blocked_packages_data', 'single_event', 'fingerprint_file', 'plan_file',
+    'apply_plan')
+
+
+def check_tag_setting(name, key, value):
+    """
+    Check the type of one tag setting, like AnsibleModule does for the
+    top-level options.
+
+    :param str name: Koji tag name
+    :param str key: setting name, a key in TAG_ARGUMENT_SPEC
+    :param value: setting value
+    :returns: the value, converted to the setting's type.
+    :raises: ValueError if we cannot convert the value.
+    """
+    kind = TAG_ARGUMENT_SPEC[key].get('type', 'str')
+    if value is None or kind == 'raw':
+        return value
+    if kind == 'bool':
+        try:
+            return boolean(value, strict=True)
+        except TypeError:
+            pass
+    elif kind == 'list':
+        if isinstance(value, string_types):
+            return value.split(',')
+        if isinstance(value, list):
+            return value
+    elif kind == 'dict':
+        if isinstance(value, dict):
+            return value
+    elif isinstance(value, string_types):
+        return value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError('tag %s: %s must be a %s' % (name, key, kind))
+
+
+def normalize_tags(tags):
+    """
+    Check each item of the "tags" list and fill in default settings.
+
+    :param list tags: list of tag setting dicts
+    :returns: dict of tag names to ensure_tag() settings
+    :raises: ValueError if a tag dict is invalid.
+    """
+    normalized = {}
+    for tag in tags:
+        if not isinstance(tag, dict) or 'name' not in tag:
+            raise ValueError('each item in tags must be a dict with a name')
+        name = tag['name']
+        if name in normalized:
+            raise ValueError('tag %s is listed more than once' % name)
+        unknown = set(tag) - set(TAG_SETTINGS) - set(['name'])
+        if unknown:
+            raise ValueError('unsupported settings for tag %s: %s'
+                             % (name, ', '.join(sorted(unknown))))
+        settings = dict(TAG_SETTINGS)
+        settings.update((key, check_tag_setting(name, key, value))
+                        for key, value in tag.items() if key != 'name')
+        settings['perm'] = settings['perm'] or None
+        normalized[name] = settings
+    return normalized
+
+
+def get_tag_waves(tags):
+    """
+    Sort tags into "waves" so that parents come before their children.
+
+    Each wave contains the tags whose parents (within these tags) are all in
+    earlier waves. We ignore parents that are not in this set of tags.
+
+    :param dict tags: tag names to ensure_tag() settings
+    :returns: list of lists of tag names
+    :raises: ValueError if the inheritance settings contain a cycle.
+    """
+    parents = {}
+    for name, settings in tags.items():
+        inheritance = settings['inheritance'] or []
+        parents[name] = set(rule['parent'] for rule in inheritance
+                            if isinstance(rule, dict)
+                            and rule.get('parent') in tags)
+    waves = []
+    done = set()
+    while len(done) < len(tags):
+        wave = sorted(name for name in tags
+                      if name not in done and parents[name] <= done)
+        if not wave:
+            remaining = sorted(set(tags) - done)
+            raise ValueError('inheritance cycle among tags: %s'
+                             % ', '.join(remaining))
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+
+def get_descendant_counts(session, names, graph=None):
+    """
+    Count the tags that inherit from each of these tags.
+
+    This tells how many other tags a change to each tag affects, and so how
+    many repositories Koji will regenerate.
+
+    :param session: Koji client session
+    :param list names: Koji tag names
+    :param graph: InheritanceGraph that holds every link on the hub. If you
+                  do not pass one, we read all the links with one RPC and
+                  count every tag's descendants locally.
+    :returns: dict of tag names to numbers of descendant tags. Tags that do
+              not exist yet have no descendants.
+    """
+    ids = common_koji.get_tag_ids(session, names)
+    if graph is None:
+        graph = common_koji.InheritanceGraph.from_hub(session)
+    counts = {}
+    for name in names:
+        counts[name] = len(graph.descendants(ids[name])) if ids[name] else 0
+    return counts
+
+
+def ensure_tags(profile, check_mode, tags, workers):
+    """
+    Ensure that many tags exist in Koji, creating parents before children.
+
+    We process the tags in each wave concurrently, with one Koji session per
+    worker thread.
+
+    :param str profile: Koji profile name
+    :param bool check_mode: don't make any changes
+    :param list tags: list of tag setting dicts
+    :param int workers: number of worker threads
+    :returns: result
+    """
+    tags = normalize_tags(tags)
+    waves = get_tag_waves(tags)
+    local = threading.local()
+
+    def ensure_one(name):
+        if not hasattr(local, 'session'):
+            local.session = common_koji.get_session(profile)
+        return ensure_tag(local.session, name, check_mode, **tags[name])
+
+    result = {'changed': False, 'stdout_lines': [], 'waves': waves}
+    diffs = []
+    changed = []
+    pool = ThreadPool(max(1, min(workers, len(tags))))
+    try:
+        for wave in waves:
+            for name, tag_result in zip(wave, pool.map(ensure_one, wave)):
+                if tag_result['changed']:
+                    result['changed'] = True
+                    changed.append(name)
+                result['stdout_lines'].extend(
+                    '%s: %s' % (name, line)
+                    for line in tag_result['stdout_lines'])
+                if 'diff' in tag_result:
+                    diffs.append(tag_result['diff'])
+    finally:
+        pool.close()
+        pool.join()
+    if diffs:
+        result['diff'] = diffs
+    if check_mode and changed:
+        # Read every inheritance link once, and count locally.
+        session = common_koji.get_session(profile)
+        result['descendants'] = get_descendant_counts(session, changed)
     return result
 
 
@@ -757,28 +1526,152 @@ def delete_tag(session, name, check_mode):
         if not check_mode:
             common_koji.ensure_logged_in(session)
             session.deleteTag(name)
+            common_koji.tag_id_cache.pop(name, None)
+    return result
+
+
+DELETE_BATCH_SIZE = 500
+
+
+def get_tag_names(tags):
+    """
+    Return the tag names from a "tags" list for state=absent.
+
+    :param list tags: tag name strings, or dicts with a "name"
+    :returns: list of tag names, without duplicates, in order.
+    :raises: ValueError if an item has no name.
+    """
+    names = []
+    for tag in tags:
+        if isinstance(tag, dict):
+            tag = tag.get('name')
+        if not isinstance(tag, string_types):
+            raise ValueError('each item in tags must be a name or a dict '
+                             'with a name')
+        if tag not in names:
+            names.append(tag)
+    return names
+
+
+def get_deletion_waves(taginfos, children):
+    """
+    Sort tags into "waves" so that children come before their parents.
+
+    :param dict taginfos: tag names to getTag() results, for the tags we will
+                          delete.
+    :param dict children: tag names to sets of child tag names
+    :returns: list of lists of tag names
+    :raises: ValueError if the inheritance links contain a cycle.
+    """
+    waves = []
+    done = set()
+    while len(done) < len(taginfos):
+        wave = sorted(name for name in taginfos if name not in done
+                      and (children[name] & set(taginfos)) <= done)
+        if not wave:
+            remaining = sorted(set(taginfos) - done)
+            raise ValueError('inheritance cycle among tags: %s'
+                             % ', '.join(remaining))
+        waves.append(wave)
+        done.update(wave)
+    return waves
+
+
+def delete_tags(session, check_mode, tags):
+    """
+    Ensure that many tags are deleted from Koji, children first.
+
+    We read all the tags in one multicall, and every tag's children in a
+    second multicall. We read the build targets once. We refuse to delete a
+    tag if a tag outside this list inherits from it, or if a build target
+    uses it.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param list tags: tag names, or dicts with a "name"
+    :returns: result
+    :raises: ValueError if we cannot safely delete these tags.
+    """
+    names = get_tag_names(tags)
+    calls = [('getTag', (name,), {}) for name in names]
+    taginfos = dict((name, taginfo) for name, taginfo
+                    in zip(names, common_koji.multicall(session, calls))
+                    if taginfo)
+    result = {'changed': False, 'stdout_lines': [], 'waves': []}
+    if not taginfos:
+        return result
+    existing = sorted(taginfos)
+    calls = [('getFullInheritance', (taginfos[name]['id'],),
+              {'reverse': True}) for name in existing]
+    descendants = common_koji.multicall(session, calls)
+    children = {}
+    for name, links in zip(existing, descendants):
+        tag_id = taginfos[name]['id']
+        children[name] = set(link['name'] for link in links
+                             if link['parent_id'] == tag_id)
+    problems = []
+    for name in existing:
+        for child in sorted(children[name] - set(taginfos)):
+            problems.append('tag %s inherits from %s' % (child, name))
+    for target in session.getBuildTargets():
+        for key in ('build_tag_name', 'dest_tag_name'):
+            if target[key] in taginfos:
+                problems.append('build target %s uses %s'
+                                % (target['name'], target[key]))
+    if problems:
+        raise ValueError('cannot delete tags: %s' % '; '.join(problems))
+    waves = get_deletion_waves(taginfos, children)
+    result['changed'] = True
+    result['waves'] = waves
+    result['diff'] = [common_koji.task_diff_data(taginfos[name], None, name,
+                                                 'tag') for name in existing]
+    for wave in waves:
+        result['stdout_lines'].extend('deleted tag %s' % name
+                                      for name in wave)
+    if not check_mode:
+        common_koji.ensure_logged_in(session)
+        for wave in waves:
+            calls = [('deleteTag', (taginfos[name]['id'],), {})
+                     for name in wave]
+            common_koji.multicall(session, calls, batch=DELETE_BATCH_SIZE)
+            for name in wave:
+                common_koji.tag_id_cache.pop(name, None)
     return result
 
 
 def run_module():
     module_args = dict(
         koji=dict(),
-        name=dict(required=True),
+        name=dict(),
+        tags=dict(type='list'),
+        workers=dict(type='int', default=4),
         state=dict(choices=['present', 'absent'], default='present'),
-        inheritance=dict(type='list'),
-        external_repos=dict(type='list'),
-        packages=dict(type='raw'),
-        groups=dict(type='raw'),
-        blocked_packages=dict(type='list'),
-        arches=dict(),
-        perm=dict(),
-        locked=dict(type='bool', default=False),
-        maven_support=dict(type='bool', default=False),
-        maven_include_all=dict(type='bool', default=False),
-        extra=dict(type='dict'),
+        packages_file=dict(type='path'),
+        blocked_packages_file=dict(type='path'),
+        # The action plugin reads packages_file and blocked_packages_file and
+        # sends their contents in these options.
+        packages_data=dict(),
+        blocked_packages_data=dict(),
+        single_event=dict(type='bool', default=False),
+        fingerprint_file=dict(type='path'),
+        plan_file=dict(type='path'),
+        apply_plan=dict(type='bool', default=False),
+        tag_cache_file=dict(type='path'),
     )
+    module_args.update((key, dict(spec))
+                       for key, spec in TAG_ARGUMENT_SPEC.items())
+    mutually_exclusive = [('fingerprint_file', 'plan_file'),
+                          ('packages', 'packages_data'),
+                          ('blocked_packages', 'blocked_packages_data'),
+                          ('name', 'tags')]
+    # Each item in "tags" has its own settings.
+    mutually_exclusive.extend(('tags', option)
+                              for option in SINGLE_TAG_OPTIONS)
     module = AnsibleModule(
         argument_spec=module_args,
+        mutually_exclusive=mutually_exclusive,
+        required_one_of=[('name', 'tags')],
+        required_if=[('apply_plan', True, ['plan_file'])],
         supports_check_mode=True
     )
 
@@ -791,22 +1684,77 @@ def run_module():
     name = params['name']
     state = params['state']
 
-    session = common_koji.get_session(profile)
+    fingerprint_file = params['fingerprint_file']
+    plan_file = params['plan_file']
+
+    try:
+        packages, blocked_packages = common_koji.get_package_params(params)
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    session = None
+    if params['tag_cache_file']:
+        session = common_koji.get_session(profile)
+        common_koji.load_tag_ids(session,
+                                 common_koji.get_profile_name(profile),
+                                 params['tag_cache_file'])
+
+    if params['tags'] and state == 'absent':
+        session = session or common_koji.get_session(profile)
+        try:
+            result = delete_tags(session, check_mode, params['tags'])
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        module.exit_json(**result)
+
+    if params['tags']:
+        try:
+            result = ensure_tags(profile, check_mode, params['tags'],
+                                 params['workers'])
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        module.exit_json(**result)
+
+    session = session or common_koji.get_session(profile)
 
     if state == 'present':
-        result = ensure_tag(session, name,
-                            check_mode,
-                            inheritance=params['inheritance'],
+        tag_settings = dict(inheritance=params['inheritance'],
                             external_repos=params['external_repos'],
-                            packages=params['packages'],
+                            packages=packages,
                             groups=params['groups'],
-                            blocked_packages=params['blocked_packages'],
+                            blocked_packages=blocked_packages,
+                            inherit_groups=params['inherit_groups'],
+                            prune_inherited=params['prune_inherited'],
                             arches=params['arches'],
                             perm=params['perm'] or None,
                             locked=params['locked'],
                             maven_support=params['maven_support'],
                             maven_include_all=params['maven_include_all'],
                             extra=params['extra'])
+        if plan_file and params['apply_plan']:
+            profile = common_koji.get_profile_name(profile)
+            try:
+                result = apply_tag_plan(session, profile, name, check_mode,
+                                        plan_file, **tag_settings)
+            except PlanError as e:
+                module.fail_json(msg=str(e))
+        elif plan_file and check_mode:
+            profile = common_koji.get_profile_name(profile)
+            result = plan_tag(session, profile, name, plan_file,
+                              **tag_settings)
+        elif fingerprint_file:
+            profile = common_koji.get_profile_name(profile)
+            result = ensure_tag_fingerprint(session, profile, name,
+                                            check_mode, fingerprint_file,
+                                            params['single_event'],
+                                            **tag_settings)
+        elif params['single_event']:
+            result = ensure_tag_single_event(session, name, check_mode,
+                                             **tag_settings)
+        else:
+            result = ensure_tag(session, name, check_mode, **tag_settings)
+        if check_mode and result['changed']:
+            result['descendants'] = get_descendant_counts(session, [name])
     elif state == 'absent':
         result = delete_tag(session, name, check_mode)
 
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils import common_koji
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: koji_tag_info
+
+short_description: Report the effective package lists of Koji tags
+description:
+   - Find the packages and blocks that each Koji tag ends up with after
+     inheritance, like "koji list-pkgs --tag" does for one tag.
+   - This module does not ask the hub to compute each tag's inherited
+     package list. Instead it reads the inheritance links and each tag's
+     direct package list once, and computes the effective lists locally. It
+     walks the inheritance the same way the hub does, following each
+     link's "pkg_filter", "maxdepth" and "intransitive" settings and
+     skipping parents that a negative priority prunes. Tags that share
+     parents only process each parent once, so this is much faster than
+     querying hundreds of tags one at a time.
+   - This module never changes anything in Koji.
+options:
+   tags:
+     description:
+       - The names of the Koji tags to describe.
+     required: true
+requirements:
+  - "python >= 2.7"
+  - "koji"
+'''
+
+EXAMPLES = '''
+- name: Check which packages our build tags end up with
+  hosts: localhost
+  tasks:
+    - name: Read the effective package lists
+      koji_tag_info:
+        tags:
+          - ceph-3.1-rhel-7-build
+          - ceph-3.2-rhel-7-build
+      register: tag_info
+
+    - name: Make sure no build tag blocks ceph
+      assert:
+        that:
+          - "'ceph' in item.value.packages"
+      loop: "{{ tag_info.tags | dict2items }}"
+'''
+
+RETURN = '''
+tags:
+  description: the effective package lists for each tag name.
+  returned: always
+  type: dict
+  sample:
+    ceph-3.1-rhel-7-build:
+      packages:
+        ceph: kdreyer
+        ceph-ansible: aschoen
+      blocked:
+        - koji
+'''
+
+
+class EffectivePackages(object):
+    """
+    Compute the packages that tags end up with, from local data only.
+
+    We follow the hub's readPackageList() rules: a tag's own package
+    entries come first, then each parent's entries in the order that
+    readFullInheritance() lists the links, and the first entry we find for
+    a package name decides its owner and whether it is blocked. A package
+    name must match every pkg_filter on the path to the parent that lists
+    it.
+
+    :param graph: InheritanceGraph with the links for these tags and all
+                  their ancestors.
+    :param dict indexes: tag IDs to PackageIndexes of the packages listed
+                         directly on those tags.
+    """
+
+    def __init__(self, graph, indexes):
+        self.graph = graph
+        self.indexes = indexes
+        # (tag ID, filters) -> list of (package name, (owner, blocked))
+        # tuples that pass those filters. Tags that share parents filter
+        # each parent's list once.
+        self._offers = {}
+
+    def packages(self, tag_id):
+        """
+        Return the effective package list for this tag.
+
+        :param int tag_id: Koji tag ID
+        :returns: dict of package names to (owner name, blocked) tuples.
+        """
+        packages = dict(self.indexes[tag_id].items())
+        for link in self.graph.inheritance(tag_id):
+            offered = self._offered(link['parent_id'], link['filters'])
+            for name, entry in offered:
+                if name not in packages:
+                    packages[name] = entry
+        return packages
+
+    def _offered(self, tag_id, filters):
+        """
+        Return the entries listed directly on tag_id that pass these
+        pkg_filter patterns.
+        """
+        key = (tag_id, tuple(filters))
+        if key not in self._offers:
+            self._offers[key] = [
+                (name, entry) for name, entry in self.indexes[tag_id].items()
+                if common_koji.match_package_filters(name, filters)]
+        return self._offers[key]
+
+
+def describe_packages(packages):
+    """
+    Split an effective package list into Ansible facts.
+
+    :param dict packages: package names to (owner name, blocked) tuples.
+    :returns: dict with a "packages" dict of unblocked package names to
+              owner names, and a sorted "blocked" list of package names.
+    """
+    unblocked = {}
+    blocked = []
+    for name, (owner, is_blocked) in packages.items():
+        if is_blocked:
+            blocked.append(name)
+        else:
+            unblocked[name] = owner
+    return {'packages': unblocked, 'blocked': sorted(blocked)}
+
+
+def get_tags_info(session, names):
+    """
+    Compute the effective package lists for these tags.
+
+    We read the inheritance links with one multicall per generation of
+    parents, and every tag's direct package list with one more multicall.
+
+    :param session: a koji.ClientSession
+    :param list names: Koji tag names
+    :returns: a result dict for Ansible
+    :raises: ValueError if a tag does not exist or the links form a loop.
+    """
+    tag_ids = common_koji.get_tag_ids(session, names)
+    for name in names:
+        if not tag_ids[name]:
+            raise ValueError('tag %s does not exist' % name)
+    graph = common_koji.InheritanceGraph()
+    for name in names:
+        graph.names[tag_ids[name]] = name
+    graph.load_ancestors(session, [tag_ids[name] for name in names])
+    cycle = graph.find_cycle()
+    if cycle:
+        raise ValueError('inheritance loop: %s' % graph.describe_path(cycle))
+    all_ids = sorted(graph.parents)
+    indexes = common_koji.get_package_indexes(session, all_ids)
+    effective = EffectivePackages(graph, dict(zip(all_ids, indexes)))
+    tags = {}
+    for name in names:
+        packages = effective.packages(tag_ids[name])
+        tags[name] = describe_packages(packages)
+    return {'changed': False, 'tags': tags}
+
+
+def run_module():
+    module_args = dict(
+        koji=dict(),
+        tags=dict(type='list', required=True),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if not common_koji.HAS_KOJI:
+        module.fail_json(msg='koji is required for this module')
+
+    params = module.params
+    profile = params['koji']
+
+    session = common_koji.get_session(profile)
+
+    try:
+        result = get_tags_info(session, params['tags'])
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == '__main__':
+    main()
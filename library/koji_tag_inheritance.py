@@ -1,6 +1,8 @@
 #!/usr/bin/python
+import sys
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils import common_koji
+from ansible.module_utils.parsing.convert_bool import boolean
 
 
 ANSIBLE_METADATA = {
@@ -32,11 +34,21 @@ options:
    child_tag:
      description:
        - The name of the Koji tag that will be the child.
-     required: true
+       - You must set either I(child_tag) and I(parent_tag), or I(links).
    parent_tag:
      description:
        - The name of the Koji tag that will be the parent of the child.
-     required: true
+   links:
+     description:
+       - A list of many inheritance links to manage in one task, instead of
+         a single I(child_tag) and I(parent_tag). Each list item is a dict
+         with a "child_tag", a "parent_tag", and any of the I(priority),
+         I(maxdepth), I(pkg_filter), I(intransitive), I(noconfig) and
+         I(state) settings of this module.
+       - Ansible reads each child tag's inheritance once, and it sends one
+         setInheritanceData call for each child tag that needs changes. It
+         sends these calls for all the child tags in multicall batches.
+     type: list
    priority:
      description:
        - The priority of this parent for this child. Parents with smaller
@@ -95,6 +107,17 @@ options:
        - Whether to add or remove this inheritance link.
      choices: [present, absent]
      default: present
+   tag_cache_file:
+     description:
+       - Path to a JSON file where Ansible saves the names and IDs of all
+         Koji tags, so that it does not ask the hub for the child and parent
+         tag IDs every time. Ansible updates the file from the hub's
+         history of created, edited and deleted tags, and only reads all
+         the tags again with one listTags call when that history is not
+         enough.
+       - Koji does not record tag renames in its history. Delete this file
+         after you rename a tag.
+     type: path
 requirements:
   - "python >= 2.7"
   - "koji"
@@ -116,6 +139,19 @@ EXAMPLES = '''
         parent_tag: sclo7-devtoolset-7-rh-release
         child_tag: other-storage-el7-build
         state: absent
+
+    - name: manage several links with one setInheritanceData per child
+      koji_tag_inheritance:
+        links:
+          - child_tag: storage7-ceph-nautilus-el7-build
+            parent_tag: sclo7-devtoolset-7-rh-release
+            priority: 25
+          - child_tag: storage7-ceph-nautilus-el7-build
+            parent_tag: sclo7-devtoolset-6-rh-release
+            state: absent
+          - child_tag: storage7-ceph-octopus-el8-build
+            parent_tag: el8-build
+            priority: 10
 '''
 
 RETURN = ''' # '''
@@ -130,32 +166,35 @@ def get_ids_and_inheritance(session, child_tag, parent_tag):
     """
     Query Koji for the current state of these tags and inheritance.
 
+    We read everything in one multicall. We skip the getTag calls for tags
+    that are already in common_koji's tag ID cache.
+
     :param session: Koji client session
     :param str child_tag: Koji tag name
     :param str parent_tag: Koji tag name
     :return: 3-element tuple of child_id (int), parent_id (int),
              and current_inheritance (list)
     """
-    child_taginfo = session.getTag(child_tag)
-    parent_taginfo = session.getTag(parent_tag)
-    child_id = child_taginfo['id'] if child_taginfo else None
-    parent_id = parent_taginfo['id'] if parent_taginfo else None
-    if child_id:
-        current_inheritance = session.getInheritanceData(child_id)
-    else:
-        current_inheritance = []
-    # TODO use multicall to get all of this at once:
-    # (Need to update the test suite fakes to handle multicalls)
-    # session.multicall = True
-    # session.getTag(child_tag, strict=True)
-    # session.getTag(parent_tag, strict=True)
-    # session.getInheritanceData(child_tag)
-    # multicall_results = session.multiCall(strict=True)
-    # # flatten multicall results:
-    # multicall_results = [result[0] for result in multicall_results]
-    # child_id = multicall_results[0]['id']
-    # parent_id = multicall_results[1]['id']
-    # current_inheritance = multicall_results[2]
+    koji_profile = sys.modules[session.__module__]
+    missing = [name for name in (child_tag, parent_tag)
+               if name not in common_koji.tag_id_cache]
+    calls = [('getTag', (name,), {}) for name in missing]
+    calls.append(('getInheritanceData', (child_tag,), {}))
+    try:
+        results = common_koji.multicall(session, calls)
+    except koji_profile.GenericError:
+        # getInheritanceData raises an error if the child tag does not
+        # exist.
+        ids = common_koji.get_tag_ids(session, [child_tag, parent_tag])
+        if ids[child_tag]:
+            raise
+        return (None, ids[parent_tag], [])
+    for name, taginfo in zip(missing, results):
+        if taginfo:
+            common_koji.tag_id_cache[name] = taginfo['id']
+    child_id = common_koji.tag_id_cache.get(child_tag)
+    parent_id = common_koji.tag_id_cache.get(parent_tag)
+    current_inheritance = results[-1]
     return (child_id, parent_id, current_inheritance)
 
 
@@ -184,6 +223,25 @@ def generate_new_rule(child_id, parent_tag, parent_id, priority, maxdepth,
         'priority': priority}
 
 
+def merge_inheritance(current_inheritance, changes):
+    """
+    Return a child tag's rules after setInheritanceData applies these
+    changes.
+
+    :param list current_inheritance: the child's current rules
+    :param list changes: rules to add or replace, or to remove if they have
+                         a "delete link" key.
+    :return: list of rules
+    """
+    rules = dict((rule['parent_id'], rule) for rule in current_inheritance)
+    for change in changes:
+        if change.get('delete link'):
+            rules.pop(change['parent_id'], None)
+        else:
+            rules[change['parent_id']] = change
+    return list(rules.values())
+
+
 def add_tag_inheritance(session, child_tag, parent_tag, priority, maxdepth,
                         pkg_filter, intransitive, noconfig, check_mode):
     """
@@ -241,6 +299,12 @@ def add_tag_inheritance(session, child_tag, parent_tag, priority, maxdepth,
     result['stdout_lines'].extend(
         common_koji.describe_inheritance_rule(new_rule))
     result['changed'] = True
+    if child_id and parent_id:
+        rules = merge_inheritance(current_inheritance, [new_rule])
+        graph = common_koji.InheritanceGraph()
+        graph.names[child_id] = child_tag
+        common_koji.check_inheritance_changes(session, {child_id: rules},
+                                              graph)
     if not check_mode:
         common_koji.ensure_logged_in(session)
         session.setInheritanceData(child_tag, [new_rule])
@@ -258,7 +322,8 @@ def remove_tag_inheritance(session, child_tag, parent_tag, check_mode):
     :return: result (dict)
     """
     result = {'changed': False, 'stdout_lines': []}
-    current_inheritance = session.getInheritanceData(child_tag)
+    data = get_ids_and_inheritance(session, child_tag, parent_tag)
+    _, _, current_inheritance = data
     found_rule = {}
     for rule in current_inheritance:
         if rule['name'] == parent_tag:
@@ -277,20 +342,177 @@ def remove_tag_inheritance(session, child_tag, parent_tag, check_mode):
     return result
 
 
+LINK_SETTINGS = {
+    'priority': None,
+    'maxdepth': None,
+    'pkg_filter': '',
+    'intransitive': False,
+    'noconfig': False,
+    'state': 'present',
+}
+
+# Link settings that the hub stores as integers and booleans. YAML and
+# templated variables often give us strings like "10" or "yes".
+INT_LINK_SETTINGS = ('priority', 'maxdepth')
+BOOL_LINK_SETTINGS = ('intransitive', 'noconfig')
+
+LINKS_BATCH_SIZE = 500
+
+
+def normalize_links(links):
+    """
+    Check each item of the "links" list and fill in default settings.
+
+    :param list links: list of link setting dicts
+    :returns: dict of child tag names to lists of link dicts, in order.
+    :raises: ValueError if a link dict is invalid.
+    """
+    by_child = {}
+    seen = set()
+    for link in links:
+        if not isinstance(link, dict) or 'child_tag' not in link \
+                or 'parent_tag' not in link:
+            raise ValueError('each item in links must be a dict with a '
+                             'child_tag and a parent_tag')
+        key = (link['child_tag'], link['parent_tag'])
+        if key in seen:
+            raise ValueError('link from %s to %s is listed more than once'
+                             % key)
+        seen.add(key)
+        unknown = set(link) - set(LINK_SETTINGS) - \
+            set(['child_tag', 'parent_tag'])
+        if unknown:
+            raise ValueError('unsupported settings for link from %s to %s: '
+                             '%s' % (key[0], key[1],
+                                     ', '.join(sorted(unknown))))
+        settings = dict(LINK_SETTINGS)
+        settings.update(link)
+        for name in INT_LINK_SETTINGS:
+            if settings[name] is None:
+                continue
+            try:
+                settings[name] = int(settings[name])
+            except (TypeError, ValueError):
+                raise ValueError('link from %s to %s: %s must be an int'
+                                 % (key[0], key[1], name))
+        for name in BOOL_LINK_SETTINGS:
+            try:
+                settings[name] = boolean(settings[name], strict=True)
+            except TypeError:
+                raise ValueError('link from %s to %s: %s must be a bool'
+                                 % (key[0], key[1], name))
+        if settings['state'] not in ('present', 'absent'):
+            raise ValueError('state must be present or absent')
+        if settings['state'] == 'present' and settings['priority'] is None:
+            raise ValueError('link from %s to %s needs a priority' % key)
+        by_child.setdefault(link['child_tag'], []).append(settings)
+    return by_child
+
+
+def ensure_links(session, check_mode, links):
+    """
+    Ensure that many tag inheritance links exist or do not exist.
+
+    We group the links by child tag. We look up all the tag IDs at once,
+    read every child tag's inheritance in one multicall, and send one
+    setInheritanceData call per child tag in multicall batches.
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param list links: list of link setting dicts
+    :return: result (dict)
+    """
+    by_child = normalize_links(links)
+    names = set(by_child)
+    for child_links in by_child.values():
+        names.update(link['parent_tag'] for link in child_links
+                     if link['state'] == 'present')
+    ids = common_koji.get_tag_ids(session, sorted(names))
+    result = {'changed': False, 'stdout_lines': []}
+    for name in sorted(names):
+        if ids[name]:
+            continue
+        if name in by_child:
+            msg = 'child tag %s not found' % name
+        else:
+            msg = 'parent tag %s not found' % name
+        if not check_mode:
+            raise NoSuchTagError(msg)
+        result['stdout_lines'].append(msg)
+    children = sorted(child for child in by_child if ids[child])
+    calls = [('getInheritanceData', (ids[child],), {}) for child in children]
+    inheritances = common_koji.multicall(session, calls)
+    writes = []
+    new_rules = {}
+    for child, current_inheritance in zip(children, inheritances):
+        child_id = ids[child]
+        changes = []
+        lines = []
+        for link in by_child[child]:
+            parent_tag = link['parent_tag']
+            current = [rule for rule in current_inheritance
+                       if rule['name'] == parent_tag]
+            if link['state'] == 'absent':
+                for rule in current:
+                    lines.append('remove inheritance link:')
+                    lines.extend(
+                        common_koji.describe_inheritance_rule(rule))
+                    changes.append(dict(rule, **{'delete link': True}))
+                continue
+            parent_id = ids[parent_tag]
+            if not parent_id:
+                continue  # check mode, reported above
+            new_rule = generate_new_rule(child_id, parent_tag, parent_id,
+                                         link['priority'], link['maxdepth'],
+                                         link['pkg_filter'],
+                                         link['intransitive'],
+                                         link['noconfig'])
+            if new_rule in current:
+                continue
+            lines.append('add inheritance link:')
+            lines.extend(common_koji.describe_inheritance_rule(new_rule))
+            changes.append(new_rule)
+        if changes:
+            result['changed'] = True
+            result['stdout_lines'].extend('%s: %s' % (child, line)
+                                          for line in lines)
+            writes.append(('setInheritanceData', (child_id, changes), {}))
+            new_rules[child_id] = merge_inheritance(current_inheritance,
+                                                    changes)
+    if new_rules:
+        # Check for loops before we write anything. We already know the
+        # children's links.
+        graph = common_koji.InheritanceGraph()
+        for child, current_inheritance in zip(children, inheritances):
+            graph.names[ids[child]] = child
+            graph.set_parents(ids[child], current_inheritance)
+        common_koji.check_inheritance_changes(session, new_rules, graph)
+    if writes and not check_mode:
+        common_koji.ensure_logged_in(session)
+        common_koji.multicall(session, writes, batch=LINKS_BATCH_SIZE)
+    return result
+
+
 def run_module():
     module_args = dict(
         koji=dict(),
-        child_tag=dict(required=True),
-        parent_tag=dict(required=True),
+        child_tag=dict(),
+        parent_tag=dict(),
+        links=dict(type='list'),
         priority=dict(type='int'),
         maxdepth=dict(type='int'),
         pkg_filter=dict(default=''),
         intransitive=dict(type='bool', default=False),
         noconfig=dict(type='bool', default=False),
         state=dict(choices=['present', 'absent'], default='present'),
+        tag_cache_file=dict(type='path'),
     )
     module = AnsibleModule(
         argument_spec=module_args,
+        mutually_exclusive=[('links', 'child_tag'),
+                            ('links', 'parent_tag')],
+        required_one_of=[('links', 'child_tag')],
+        required_together=[('child_tag', 'parent_tag')],
         supports_check_mode=True
     )
 
@@ -303,8 +525,17 @@ def run_module():
     profile = params['koji']
 
     session = common_koji.get_session(profile)
+    if params['tag_cache_file']:
+        common_koji.load_tag_ids(session,
+                                 common_koji.get_profile_name(profile),
+                                 params['tag_cache_file'])
 
-    if state == 'present':
+    if params['links']:
+        try:
+            result = ensure_links(session, check_mode, params['links'])
+        except (NoSuchTagError, ValueError) as e:
+            module.fail_json(msg=str(e))
+    elif state == 'present':
         if 'priority' not in params:
             module.fail_json(msg='specify a "priority" integer')
         try:
@@ -317,7 +548,7 @@ def run_module():
                                          intransitive=params['intransitive'],
                                          noconfig=params['noconfig'],
                                          check_mode=check_mode)
-        except NoSuchTagError as e:
+        except (NoSuchTagError, ValueError) as e:
             module.fail_json(msg=str(e))
     elif state == 'absent':
         try:
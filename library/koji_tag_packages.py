@@ -1,6 +1,4 @@
 #!/usr/bin/python
-import sys
-from collections import defaultdict
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils import common_koji
 
@@ -29,20 +27,64 @@ description:
 options:
    tag:
      description:
-       - The name of the Koji tag to manage packages for.
+       - The name of the Koji tag to manage packages for, or a list of tag
+         names.
+       - With a list of tags, Ansible makes the same changes to every tag.
+         It reads all the tags' package lists in one multicall, and sends
+         the changes for all the tags together in multicall batches.
+     type: list
      required: true
    packages:
      description:
        - dict of package owners and the a lists of packages each owner
          maintains.
+   packages_file:
+     description:
+       - Path to a YAML or JSON file on the Ansible controller with the
+         I(packages) dict. Use this instead of I(packages) for very large
+         package lists. Ansible reads the file without templating it, and
+         sends the list to the module in a compressed form.
+       - Relative paths are relative to the "files" directory of the role
+         or playbook.
+       - This requires the koji_tag_packages action plugin from this
+         project's "action_plugins" directory.
    blocked_packages:
      description:
        - list of package names to be blocked or unblocked
+   blocked_packages_file:
+     description:
+       - Path to a YAML or JSON file on the Ansible controller with the
+         I(blocked_packages) list. See I(packages_file).
    state:
      description:
        - Whether to add or remove the given packages.
      choices: [present, absent]
      default: present
+   prune_inherited:
+     description:
+       - With I(state=present), do not list packages on this tag when the
+         tag already inherits them from a parent with the same owner, and do
+         not block packages that no parent offers. Ansible removes these
+         redundant entries if they are already on the tag.
+       - Ansible reads each parent's inherited package list and inheritance
+         links once to decide this. It does not skip packages that come
+         through an inheritance rule with a I(pkg_filter) setting, or
+         through a parent's intransitive links.
+       - Ansible reports the number of entries it skipped in
+         C(avoided_rows).
+     type: bool
+     default: false
+   tag_cache_file:
+     description:
+       - Path to a JSON file where Ansible saves the names and IDs of all
+         Koji tags. When you set this, Ansible looks up tag IDs in this file
+         instead of asking the hub for each tag. It updates the file from
+         the hub's history of created, edited and deleted tags, and only
+         reads all the tags again with one listTags call when that history
+         is not enough.
+       - Koji does not record tag renames in its history. Delete this file
+         after you rename a tag.
+     type: path
 requirements:
   - "python >= 2.7"
   - "koji"
@@ -71,6 +113,30 @@ EXAMPLES = '''
         - ceph
         - ceph-ansible
 
+- name: Ensure packages are available, without repeating inherited entries
+  koji_tag_packages:
+    tag: ceph-3.1-rhel-7-candidate
+    prune_inherited: true
+    packages:
+      kdreyer:
+        - ansible
+        - ceph
+
+- name: Ensure packages are present for all the per-arch variants
+  koji_tag_packages:
+    tag:
+      - ceph-3.1-rhel-7-x86_64
+      - ceph-3.1-rhel-7-ppc64le
+      - ceph-3.1-rhel-7-s390x
+    packages:
+      kdreyer:
+        - ceph
+
+- name: Ensure a long list of packages from a file is present
+  koji_tag_packages:
+    tag: ceph-3.1-rhel-7
+    packages_file: ceph-3.1-rhel-7-packages.yml
+
 - name: Block the ceph-ansible package for ceph-3.1-rhel-7
   koji_tag_packages:
     tag: ceph-3.1-rhel-7
@@ -88,7 +154,29 @@ EXAMPLES = '''
 RETURN = ''' # '''
 
 
-def ensure_packages(session, tag_name, tag_id, check_mode, packages):
+# Number of write RPCs to send in each multicall request.
+WRITE_BATCH_SIZE = 1000
+
+
+def send_changes(session, check_mode, changes, calls):
+    """
+    Send these write RPCs in multicall batches, or append them to "calls".
+
+    :param session: Koji client session
+    :param bool check_mode: don't make any changes
+    :param list changes: (method, args, kwargs) tuples
+    :param list calls: if set, append the changes here instead of sending
+                       them.
+    """
+    if calls is not None:
+        calls.extend(changes)
+    elif changes and not check_mode:
+        common_koji.ensure_logged_in(session)
+        common_koji.multicall(session, changes, batch=WRITE_BATCH_SIZE)
+
+
+def ensure_packages(session, tag_name, tag_id, check_mode, packages,
+                    redundant=(), current_pkgs=None, calls=None):
     """
     Ensure that these packages are configured on this Koji tag.
 
@@ -98,115 +186,212 @@ def ensure_packages(session, tag_name, tag_id, check_mode, packages):
     :param bool check_mode: don't make any changes
     :param dict packages: Ensure that these owners and package names are
                           configured for this tag.
+    :param redundant: package names that this tag inherits already. Remove
+                      these if they are listed directly on the tag.
+    :param dict current_pkgs: the tag's package index, if the caller
+                              already read it with get_package_index().
+    :param list calls: if set, append the write RPCs to this list instead of
+                       sending them.
     """
     result = {'changed': False, 'stdout_lines': []}
-    # Note: this in particular could really benefit from koji's
-    # multicalls...
-    current_pkgs = session.listPackages(tagID=tag_id)
-    current_names = set([pkg['package_name'] for pkg in current_pkgs])
-    # Create a "current_owned" dict to compare with what's in Ansible.
-    current_owned = defaultdict(set)
-    for pkg in current_pkgs:
-        owner = pkg['owner_name']
-        pkg_name = pkg['package_name']
-        current_owned[owner].add(pkg_name)
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_id)
+    changes = []
     for owner, owned in packages.items():
         for package in owned:
-            if package not in current_names:
+            if package not in current_pkgs:
                 # The package was missing from the tag entirely.
-                if not check_mode:
-                    common_koji.ensure_logged_in(session)
-                    session.packageListAdd(tag_name, package, owner)
+                changes.append(('packageListAdd',
+                                (tag_name, package, owner), {}))
                 result['stdout_lines'].append('added pkg %s' % package)
-                result['changed'] = True
-            else:
-                # The package is already in this tag.
-                # Verify ownership.
-                if package not in current_owned.get(owner, []):
-                    if not check_mode:
-                        common_koji.ensure_logged_in(session)
-                        session.packageListSetOwner(tag_name, package, owner)
-                    result['stdout_lines'].append('set %s owner %s' %
-                                                  (package, owner))
-                    result['changed'] = True
+            elif current_pkgs.owner(package) != owner:
+                # The package is already in this tag with another owner.
+                changes.append(('packageListSetOwner',
+                                (tag_name, package, owner), {}))
+                result['stdout_lines'].append('set %s owner %s' %
+                                              (package, owner))
+    for package in redundant:
+        if package in current_pkgs:
+            changes.append(('packageListRemove', (tag_name, package), {}))
+            result['stdout_lines'].append('remove pkg %s' % package)
+    if changes:
+        result['changed'] = True
+        send_changes(session, check_mode, changes, calls)
     return result
 
 
-def remove_packages(session, tag_name, check_mode, packages):
+def remove_packages(session, tag_name, check_mode, packages,
+                    current_pkgs=None, calls=None):
+    """
+    Ensure that these packages are not listed on this Koji tag.
+
+    We only remove the packages that are on the tag now. "current_pkgs" and
+    "calls" work like they do for ensure_packages().
+    """
     result = {'changed': False, 'stdout_lines': []}
-    for owner, packages in packages.items():
-        for package in packages:
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_name,
+                                                     with_owners=False)
+    changes = []
+    for owner, owned in packages.items():
+        for package in owned:
+            if package not in current_pkgs:
+                continue
+            changes.append(('packageListRemove', (tag_name, package), {}))
             result['stdout_lines'].append('remove pkg %s' % package)
-            result['changed'] = True
-            if not check_mode:
-                common_koji.ensure_logged_in(session)
-                session.packageListRemove(tag_name, package)
+    if changes:
+        result['changed'] = True
+        send_changes(session, check_mode, changes, calls)
     return result
 
 
-def ensure_blocked_packages(session, tag_name, tag_id, check_mode, packages):
+def ensure_blocked_packages(session, tag_name, tag_id, check_mode, packages,
+                            unneeded=(), current_pkgs=None, calls=None):
     """
     Note: here "packages" is just a list of package names, no owners
-    as koji doesn't require an owner for a blocked package listing
+    as koji doesn't require an owner for a blocked package listing.
+    "unneeded" is a list of blocks that no parent needs. We remove these
+    entries if they are blocked. (An unblock would leave the package listed
+    on this tag.) "current_pkgs" and "calls" work like they do for
+    ensure_packages().
     """
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_id,
+                                                     with_owners=False)
     changes = []
-    koji_profile = sys.modules[session.__module__]
-    try:
-        current_pkgs = session.listPackages(tagID=tag_id, with_owners=False)
-    except koji_profile.ParameterError as e:
-        # Koji Hubs before v1.25 do not have with_owners performance
-        # optimization
-        if "unexpected keyword argument 'with_owners'" in str(e):
-            current_pkgs = session.listPackages(tagID=tag_id)
-        else:
-            raise
-
-    current_blocked = set(pkg['package_name']
-                          for pkg in current_pkgs if pkg['blocked'])
-
+    log = []
     for package in packages:
-        if package not in current_blocked:
-            if not check_mode:
-                common_koji.ensure_logged_in(session)
-                session.packageListBlock(tag_name, package)
-            changes.append('block pkg %s' % package)
-    return changes
-
-
-def remove_package_blocks(session, tag_name, check_mode, packages):
+        if not current_pkgs.is_blocked(package):
+            changes.append(('packageListBlock', (tag_name, package), {}))
+            log.append('block pkg %s' % package)
+    for package in unneeded:
+        if current_pkgs.is_blocked(package):
+            changes.append(('packageListRemove', (tag_name, package), {}))
+            log.append('remove pkg %s' % package)
+    send_changes(session, check_mode, changes, calls)
+    return log
+
+
+def remove_package_blocks(session, tag_name, check_mode, packages,
+                          current_pkgs=None, calls=None):
+    """
+    Unblock these packages if they are blocked on this Koji tag.
+    "current_pkgs" and "calls" work like they do for ensure_packages().
+    """
+    if current_pkgs is None:
+        current_pkgs = common_koji.get_package_index(session, tag_name,
+                                                     with_owners=False)
     changes = []
-    koji_profile = sys.modules[session.__module__]
-    try:
-        current_pkgs = session.listPackages(tagID=tag_name, with_owners=False)
-    except koji_profile.ParameterError as e:
-        # Koji Hubs before v1.25 do not have with_owners performance
-        # optimization
-        if "unexpected keyword argument 'with_owners'" in str(e):
-            current_pkgs = session.listPackages(tagID=tag_name)
-        else:
-            raise
-    current_blocked = set(pkg['package_name']
-                          for pkg in current_pkgs if pkg['blocked'])
+    log = []
     for package in packages:
-        if package in current_blocked:
-            changes.append('unblock pkg %s' % package)
-            if not check_mode:
-                common_koji.ensure_logged_in(session)
-                session.packageListUnblock(tag_name, package)
-    return changes
+        if current_pkgs.is_blocked(package):
+            changes.append(('packageListUnblock', (tag_name, package), {}))
+            log.append('unblock pkg %s' % package)
+    send_changes(session, check_mode, changes, calls)
+    return log
+
+
+def ensure_tag_packages(session, tag_name, tag_id, check_mode, packages,
+                        blocked_packages, prune_inherited, current_pkgs,
+                        calls):
+    """
+    Ensure that these packages are present or blocked on this Koji tag.
+
+    :param session: Koji client session
+    :param str tag_name: Koji tag name
+    :param int tag_id: Koji tag ID
+    :param bool check_mode: don't make any changes
+    :param dict packages: owners and package names to add, or None
+    :param list blocked_packages: package names to block, or None
+    :param bool prune_inherited: skip packages that this tag inherits, and
+                                 blocks that no parent needs.
+    :param dict current_pkgs: the tag's package index
+    :param list calls: append the write RPCs to this list.
+    :returns: result
+    """
+    result = {'changed': False, 'stdout_lines': []}
+    redundant = unneeded = set()
+    if prune_inherited:
+        rules = session.getInheritanceData(tag_name)
+        inherited, provided = common_koji.get_inherited_packages(session,
+                                                                 rules)
+        packages, redundant, blocked_packages, unneeded = \
+            common_koji.prune_package_lists(packages, blocked_packages,
+                                            inherited, provided)
+    if packages or redundant:
+        result = ensure_packages(session, tag_name, tag_id, check_mode,
+                                 packages or {}, redundant, current_pkgs,
+                                 calls)
+    if blocked_packages or unneeded:
+        changes = ensure_blocked_packages(session, tag_name, tag_id,
+                                          check_mode, blocked_packages or [],
+                                          unneeded, current_pkgs, calls)
+        if changes:
+            result['changed'] = True
+            result['stdout_lines'] += changes
+    if prune_inherited:
+        if redundant:
+            result['stdout_lines'].append(
+                'skipped %d packages inherited from parents'
+                % len(redundant))
+        if unneeded:
+            result['stdout_lines'].append(
+                'skipped %d blocks of packages that no parent offers'
+                % len(unneeded))
+        result['avoided_rows'] = len(redundant) + len(unneeded)
+    return result
+
+
+def remove_tag_packages(session, tag_name, check_mode, packages,
+                        blocked_packages, current_pkgs, calls):
+    """
+    Ensure that these packages are not present or blocked on this Koji tag.
+
+    :param session: Koji client session
+    :param str tag_name: Koji tag name
+    :param bool check_mode: don't make any changes
+    :param dict packages: owners and package names to remove, or None
+    :param list blocked_packages: package names to unblock, or None
+    :param dict current_pkgs: the tag's package index
+    :param list calls: append the write RPCs to this list.
+    :returns: result
+    """
+    result = {'changed': False, 'stdout_lines': []}
+    if packages:
+        result = remove_packages(session, tag_name, check_mode, packages,
+                                 current_pkgs, calls)
+    if blocked_packages:
+        changes = remove_package_blocks(session, tag_name, check_mode,
+                                        blocked_packages, current_pkgs, calls)
+        if changes:
+            result['changed'] = True
+            result['stdout_lines'] += changes
+    return result
 
 
 def run_module():
     module_args = dict(
         koji=dict(),
-        tag=dict(required=True),
+        tag=dict(type='list', required=True),
         state=dict(choices=['present', 'absent'], default='present'),
         packages=dict(type='dict'),
-        blocked_packages=dict(type='list')
+        blocked_packages=dict(type='list'),
+        packages_file=dict(type='path'),
+        blocked_packages_file=dict(type='path'),
+        # The action plugin reads packages_file and blocked_packages_file and
+        # sends their contents in these options.
+        packages_data=dict(),
+        blocked_packages_data=dict(),
+        prune_inherited=dict(type='bool', default=False),
+        tag_cache_file=dict(type='path'),
     )
     module = AnsibleModule(
         argument_spec=module_args,
-        required_one_of=[('packages', 'blocked_packages')],
+        required_one_of=[('packages', 'blocked_packages', 'packages_file',
+                          'blocked_packages_file', 'packages_data',
+                          'blocked_packages_data')],
+        mutually_exclusive=[('packages', 'packages_data'),
+                            ('blocked_packages', 'blocked_packages_data')],
         supports_check_mode=True
     )
 
@@ -216,37 +401,57 @@ def run_module():
     check_mode = module.check_mode
     params = module.params
     profile = params['koji']
-    tag_name = params['tag']
+    tag_names = params['tag']
     state = params['state']
-    packages = params['packages']
-    blocked_packages = params['blocked_packages']
+    try:
+        packages, blocked_packages = common_koji.get_package_params(params)
+    except ValueError as e:
+        module.fail_json(msg=str(e))
 
     session = common_koji.get_session(profile)
-    tag_info = session.getTag(tag_name)
-    if not tag_info:
-        module.fail_json(msg='tag %s does not exist' % tag_name)
-
+    if params['tag_cache_file']:
+        common_koji.load_tag_ids(session,
+                                 common_koji.get_profile_name(profile),
+                                 params['tag_cache_file'])
+    ids = common_koji.get_tag_ids(session, tag_names)
+    for tag_name in tag_names:
+        if not ids[tag_name]:
+            module.fail_json(msg='tag %s does not exist' % tag_name)
+    tag_ids = [ids[tag_name] for tag_name in tag_names]
+
+    # Read each tag's package list once for both settings.
+    with_owners = state == 'present' and bool(packages)
+    if len(tag_ids) == 1:
+        indexes = [common_koji.get_package_index(session, tag_ids[0],
+                                                 with_owners)]
+    else:
+        indexes = common_koji.get_package_indexes(session, tag_ids,
+                                                  with_owners)
+
+    # Send all the changes for all the tags together.
     result = {'changed': False, 'stdout_lines': []}
-    if state == 'present':
-        if packages:
-            result = ensure_packages(
-                session, tag_name, tag_info['id'], check_mode, packages)
-        if blocked_packages:
-            changes = ensure_blocked_packages(session, tag_name,
-                                              tag_info['id'], check_mode,
-                                              blocked_packages)
-            if changes:
-                result['changed'] = True
-                result['stdout_lines'] += changes
-    elif state == 'absent':
-        if packages:
-            result = remove_packages(session, tag_name, check_mode, packages)
-        if blocked_packages:
-            changes = remove_package_blocks(
-                session, tag_name, check_mode, blocked_packages)
-            if changes:
-                result['changed'] = True
-                result['stdout_lines'] += changes
+    calls = []
+    for tag_name, tag_id, current_pkgs in zip(tag_names, tag_ids, indexes):
+        if state == 'present':
+            tag_result = ensure_tag_packages(
+                session, tag_name, tag_id, check_mode, packages,
+                blocked_packages, params['prune_inherited'], current_pkgs,
+                calls)
+        elif state == 'absent':
+            tag_result = remove_tag_packages(
+                session, tag_name, check_mode, packages, blocked_packages,
+                current_pkgs, calls)
+        if len(tag_names) == 1:
+            result = tag_result
+            continue
+        if tag_result['changed']:
+            result['changed'] = True
+        result['stdout_lines'].extend('%s: %s' % (tag_name, line)
+                                      for line in tag_result['stdout_lines'])
+        if 'avoided_rows' in tag_result:
+            result['avoided_rows'] = (result.get('avoided_rows', 0)
+                                      + tag_result['avoided_rows'])
+    send_changes(session, check_mode, calls, None)
 
     module.exit_json(**result)
 
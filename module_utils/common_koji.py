@@ -1,6 +1,21 @@
 # -*- coding: utf-8 -*-
+import base64
 import os
+from array import array
 import copy
+import json
+import re
+import sys
+import tempfile
+import zlib
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2 has a builtin intern()
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # Python 2
 try:
     import koji
     from koji_cli.lib import activate_session
@@ -84,6 +99,964 @@ def ensure_logged_in(session):
         activate_session(session, session.opts)
 
 
+def multicall(session, calls, batch=None):
+    """
+    Send many RPCs to the hub in a single round trip.
+
+    :param session: a koji.ClientSession
+    :param list calls: list of (method name, args, kwargs) tuples to send, in
+                       order.
+    :param int batch: if set, split the multicall into chunks of this many
+                      calls.
+    :returns: list of results, one for each call, in order. If any call
+              fails, raise the first koji error.
+    """
+    if not calls:
+        return []
+    session.multicall = True
+    for method, args, kwargs in calls:
+        getattr(session, method)(*args, **kwargs)
+    if batch:
+        results = session.multiCall(strict=True, batch=batch)
+    else:
+        results = session.multiCall(strict=True)
+    # Each successful result is a single-element list.
+    return [result[0] for result in results]
+
+
+class RecordingSession(object):
+    """
+    Wrap a koji.ClientSession. Send read-only RPCs to the hub, and record all
+    other RPCs in a list instead of sending them.
+
+    We use this to find the exact write RPCs that a module would make.
+    Recorded RPCs always return None.
+    """
+
+    def __init__(self, session, read_methods):
+        """
+        :param session: a koji.ClientSession
+        :param read_methods: names of read-only RPCs that we may send to the
+                             hub.
+        """
+        self._session = session
+        self._read_methods = set(read_methods)
+        self._queued = []
+        # Modules look up Koji's exception classes in the session's module.
+        self.__module__ = session.__module__
+        # We never need to authenticate, because we never write.
+        self.logged_in = True
+        self.multicall = False
+        # list of (method name, args, kwargs) tuples
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name == 'system':
+            return self._session.system
+        if self.multicall:
+            def queue(*args, **kwargs):
+                self._queued.append((name, args, kwargs))
+            return queue
+        if name in self._read_methods:
+            return getattr(self._session, name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+    def multiCall(self, strict=False, batch=None):
+        self.multicall = False
+        queued = self._queued
+        self._queued = []
+        reads = [call for call in queued if call[0] in self._read_methods]
+        read_results = iter(multicall(self._session, reads, batch))
+        results = []
+        for call in queued:
+            if call[0] in self._read_methods:
+                results.append([next(read_results)])
+            else:
+                self.calls.append(call)
+                results.append([None])
+        return results
+
+
+# hub capability utils
+
+
+method_cache = set()
+
+
+def get_hub_methods(session):
+    """
+    Return the names of all the RPCs this hub supports.
+
+    :param session: a koji.ClientSession
+    :returns: set of method names (str)
+    """
+    global method_cache
+    if not method_cache:
+        method_cache = set(session.system.listMethods())
+    return method_cache
+
+
+def hub_has_method(session, name):
+    """
+    Return True if this hub supports this RPC name, False otherwise.
+    """
+    return name in get_hub_methods(session)
+
+
+# tag ID utils
+
+
+tag_id_cache = {}
+
+TAG_IDS_STATE_KEY = 'tag_ids'
+
+
+def load_tag_ids(session, profile, path):
+    """
+    Fill tag_id_cache with every tag's name and ID.
+
+    We save the listTags results in a state file, along with the hub's event
+    ID at that time. On later runs we read the hub's tag_config history
+    since that event, and apply each created, edited or deleted tag to the
+    saved list. We only call listTags again if the history does not tell us
+    enough to update the list.
+
+    Koji does not record tag renames in its history. If you rename a tag,
+    delete this state file.
+
+    :param session: a koji.ClientSession
+    :param str profile: Koji profile name
+    :param str path: path to the state file
+    """
+    saved = load_state(path).get(profile, {}).get(TAG_IDS_STATE_KEY)
+    if saved:
+        history = session.queryHistory(tables=['tag_config'],
+                                       afterEvent=saved['event_id'])
+        entries = history.get('tag_config', [])
+        tags = apply_tag_history(saved['tags'], entries)
+        if tags is not None:
+            tag_id_cache.clear()
+            tag_id_cache.update(tags)
+            if entries:
+                # The history covers every change up to its last event.
+                event_id = max(max(entry['create_event'],
+                                   entry.get('revoke_event') or 0)
+                               for entry in entries)
+                update_state(path, profile, TAG_IDS_STATE_KEY,
+                             {'event_id': event_id, 'tags': tag_id_cache})
+            return
+    # Koji runs a multicall in a single transaction, so this event ID
+    # matches this list of tags.
+    event, tags = multicall(session, [('getLastEvent', (), {}),
+                                      ('listTags', (), {})])
+    tag_id_cache.clear()
+    tag_id_cache.update((tag['name'], tag['id']) for tag in tags)
+    update_state(path, profile, TAG_IDS_STATE_KEY,
+                 {'event_id': event['id'], 'tags': tag_id_cache})
+
+
+def apply_tag_history(tags, entries):
+    """
+    Update a list of tag names and IDs with tag_config history entries.
+
+    Each change to a tag's configuration revokes the old tag_config row and
+    creates a new one. A tag exists if it still has an active row, and the
+    hub deleted it if we only see revoked rows.
+
+    :param dict tags: tag names to IDs
+    :param list entries: queryHistory() tag_config entries
+    :returns: a new dict of tag names to IDs, or None if the entries do not
+              name their tags, or if two tags end up with the same name.
+    """
+    # tag ID -> (name, True if the tag still exists)
+    changed = {}
+    for entry in entries:
+        name = entry.get('tag.name')
+        if name is None:
+            return None
+        active = entry.get('revoke_event') is None
+        exists = changed.get(entry['tag_id'], (name, False))[1]
+        changed[entry['tag_id']] = (name, exists or active)
+    result = dict((name, tag_id) for name, tag_id in tags.items()
+                  if tag_id not in changed)
+    for tag_id, (name, exists) in changed.items():
+        if not exists:
+            continue
+        if result.get(name, tag_id) != tag_id:
+            return None
+        result[name] = tag_id
+    return result
+
+
+def get_tag_ids(session, names):
+    """
+    Look up the IDs for these tag names.
+
+    We remember every ID in tag_id_cache for the life of this process. We
+    read the names that are not in the cache with one getTag multicall.
+
+    :param session: a koji.ClientSession
+    :param list names: Koji tag names
+    :returns: dict of tag names to IDs. The ID is None if the tag does not
+              exist.
+    """
+    missing = [name for name in names if name not in tag_id_cache]
+    if len(missing) == 1:
+        taginfos = [session.getTag(missing[0])]
+    else:
+        calls = [('getTag', (name,), {}) for name in missing]
+        taginfos = multicall(session, calls)
+    for name, taginfo in zip(missing, taginfos):
+        if taginfo:
+            tag_id_cache[name] = taginfo['id']
+    return dict((name, tag_id_cache.get(name)) for name in names)
+
+
+# package list utils
+
+
+# Most tags fit in one page. The hub reads a tag's whole package list for
+# every page, so small pages cost many full reads on the hub.
+PACKAGE_PAGE_SIZE = 20000
+
+
+def iter_packages(session, tag_id, with_owners=True,
+                  page_size=PACKAGE_PAGE_SIZE):
+    """
+    Iterate over the packages listed directly on this tag.
+
+    We read the listPackages RPC one page at a time (with the "limit" and
+    "offset" queryOpts) so that we never hold the full XML-RPC response for a
+    very large tag in memory. If the hub ignores the paging options, we
+    receive the full list in the first response and stop there.
+
+    The hub applies "offset" and "limit" after it reads the tag's full
+    package list, so each page costs the hub a full read. Keep page_size
+    large enough that a typical tag needs only one or two pages.
+
+    We read every page at the hub's current event when we start, so that
+    packages that someone adds or removes while we read cannot shift the
+    pages and make us skip or repeat packages.
+
+    :param session: a koji.ClientSession
+    :param tag_id: Koji tag ID or name
+    :param bool with_owners: also query the owner names. Set this to False
+                             when you do not need owners, because it makes
+                             the hub's query faster on Koji v1.25 or newer.
+    :param int page_size: number of packages to read in each RPC.
+    :returns: generator of listPackages dicts
+    """
+    koji_profile = sys.modules[session.__module__]
+    kwargs = {'tagID': tag_id}
+    if not with_owners:
+        kwargs['with_owners'] = False
+    # Read every page at the same event.
+    kwargs['event'] = session.getLastEvent()['id']
+    offset = 0
+    last_name = None
+    while True:
+        opts = {'order': 'package_name', 'offset': offset, 'limit': page_size}
+        try:
+            page = session.listPackages(queryOpts=opts, **kwargs)
+        except koji_profile.ParameterError as e:
+            # Koji Hubs before v1.25 do not have with_owners performance
+            # optimization
+            if "unexpected keyword argument 'with_owners'" in str(e) \
+                    and 'with_owners' in kwargs:
+                del kwargs['with_owners']
+                continue
+            raise
+        if page and last_name is not None and \
+                page[0]['package_name'] <= last_name:
+            # The hub ignored our offset, so we have already seen this page.
+            return
+        for package in page:
+            yield package
+        if len(page) != page_size:
+            return
+        last_name = page[-1]['package_name']
+        offset += page_size
+
+
+def get_package_index(session, tag_id, with_owners=True):
+    """
+    Read a compact index of the packages listed directly on this tag.
+
+    We only keep the fields that koji-ansible compares, and we store each
+    owner name once, so the index is much smaller than listPackages' full
+    list of dicts.
+
+    :param session: a koji.ClientSession
+    :param tag_id: Koji tag ID or name
+    :param bool with_owners: also query the owner names. If False, every
+                             owner in the index is None.
+    :returns: PackageIndex, a mapping of package names to (owner name,
+              blocked) tuples.
+    """
+    packages = iter_packages(session, tag_id, with_owners)
+    return build_package_index(packages, with_owners)
+
+
+def get_package_indexes(session, tag_ids, with_owners=True):
+    """
+    Read compact package indexes for many tags in one multicall.
+
+    Unlike get_package_index(), we read each tag's full list in one RPC.
+    The indexes share one copy of each package and owner name.
+
+    :param session: a koji.ClientSession
+    :param list tag_ids: Koji tag IDs or names
+    :param bool with_owners: also query the owner names. If False, every
+                             owner in the index is None.
+    :returns: list of package indexes, one for each tag.
+    """
+    koji_profile = sys.modules[session.__module__]
+    kwargs = {} if with_owners else {'with_owners': False}
+    calls = [('listPackages', (), dict(kwargs, tagID=tag_id))
+             for tag_id in tag_ids]
+    try:
+        listings = multicall(session, calls)
+    except koji_profile.ParameterError as e:
+        # Koji Hubs before v1.25 do not have with_owners performance
+        # optimization
+        if "unexpected keyword argument 'with_owners'" not in str(e) \
+                or with_owners:
+            raise
+        calls = [('listPackages', (), {'tagID': tag_id})
+                 for tag_id in tag_ids]
+        listings = multicall(session, calls)
+    indexes = []
+    strings = {}
+    for i, listing in enumerate(listings):
+        indexes.append(build_package_index(listing, with_owners, strings))
+        listings[i] = None  # free each full list as soon as we can
+    return indexes
+
+
+def build_package_index(packages, with_owners=True, strings=None):
+    """
+    Build a compact index from listPackages dicts.
+
+    :param packages: iterable of listPackages dicts
+    :param bool with_owners: keep the owner names. If False, every owner in
+                             the index is None.
+    :param dict strings: if set, share name strings through this table. Pass
+                         the same dict when you build indexes for several
+                         tags, so that they store each package name once.
+    :returns: PackageIndex
+    """
+    index = PackageIndex(strings)
+    for package in packages:
+        owner = package.get('owner_name') if with_owners else None
+        index.add(package['package_name'], owner, package.get('blocked'))
+    return index
+
+
+class PackageIndex(Mapping):
+    """
+    Compact, read-only index of a tag's package list.
+
+    This maps package names to (owner name, blocked) tuples, like a dict, but
+    it does not store a tuple for every package. Each package name maps to a
+    slot number. The owner for each slot is a small integer in an array
+    that points into a table of the (few) distinct owner names, and the
+    "blocked" flag for each slot is one byte.
+
+    :param dict strings: if set, share name strings through this table, so
+                         that several indexes store each name only once.
+    """
+
+    def __init__(self, strings=None):
+        self._strings = strings
+        self._slots = {}
+        self._owner_names = []
+        self._owner_ids = {}
+        self._owners = array('i')
+        self._blocked = bytearray()
+
+    def _share(self, string):
+        if self._strings is None:
+            return string
+        return self._strings.setdefault(string, string)
+
+    def add(self, name, owner, blocked):
+        """
+        Add a package to this index.
+
+        :param str name: package name
+        :param str owner: owner name, or None
+        :param bool blocked: True if the tag blocks this package
+        """
+        owner_id = -1
+        if owner is not None:
+            owner_id = self._owner_ids.get(owner)
+            if owner_id is None:
+                owner_id = len(self._owner_names)
+                owner = self._share(owner)
+                self._owner_names.append(owner)
+                self._owner_ids[owner] = owner_id
+        slot = self._slots.get(name)
+        if slot is None:
+            self._slots[self._share(name)] = len(self._owners)
+            self._owners.append(owner_id)
+            self._blocked.append(1 if blocked else 0)
+        else:
+            self._owners[slot] = owner_id
+            self._blocked[slot] = 1 if blocked else 0
+
+    def owner(self, name):
+        """ Return the owner name for this package, or None. """
+        owner_id = self._owners[self._slots[name]]
+        if owner_id < 0:
+            return None
+        return self._owner_names[owner_id]
+
+    def is_blocked(self, name):
+        """ Return True if this package is on the tag and blocked. """
+        slot = self._slots.get(name)
+        return slot is not None and bool(self._blocked[slot])
+
+    def blocked(self):
+        """ Return a list of the blocked package names. """
+        blocked = self._blocked
+        return [name for name, slot in self._slots.items() if blocked[slot]]
+
+    def __getitem__(self, name):
+        return (self.owner(name), self.is_blocked(name))
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __repr__(self):
+        return 'PackageIndex(%r)' % dict(self.items())
+
+
+# pkg_filter pattern -> compiled regular expression
+package_filter_cache = {}
+
+
+def get_inherited_packages(session, rules):
+    """
+    Read the packages that a tag's parents offer to it.
+
+    We read each parent's inherited package list once, in a single
+    multicall, and the parents' inheritance links with one multicall per
+    generation. We ignore parents that do not exist (yet).
+
+    A parent's inherited package list also shows packages that come through
+    the parent's own intransitive links, from beyond the child's
+    "maxdepth", or through a pruned parent. The child does not inherit
+    those, so we walk the child's proposed inheritance like the hub does,
+    and check each entry's tag and "pkg_filter" patterns against the links
+    that the child follows through that parent.
+
+    :param session: a koji.ClientSession
+    :param list rules: inheritance rules for the child tag, in
+                       getInheritanceData() format. We use the "name",
+                       "priority", "maxdepth", "intransitive" and
+                       "pkg_filter" keys.
+    :returns: two-element tuple. The first element is a dict of package
+              names to owner names for the packages that the child certainly
+              inherits. The owner is None if a parent blocks the package, or
+              if a link that the child does not follow could hide the
+              package from the child. The second element is a set of the
+              package names that any parent could offer, unblocked, to the
+              child.
+    """
+    rules = sorted(rules, key=lambda rule: rule['priority'])
+    parent_ids = get_tag_ids(session, [rule['name'] for rule in rules])
+    rules = [dict(rule, parent_id=parent_ids[rule['name']]) for rule in rules
+             if parent_ids[rule['name']]]
+    graph = InheritanceGraph()
+    graph.load_ancestors(session, [rule['parent_id'] for rule in rules])
+    # rule index -> tag IDs that the child reaches through that rule's
+    # parent, with the pkg_filter patterns along the way.
+    reach = {}
+    for link in graph.inheritance(None, rules):
+        reach.setdefault(link['via'], {}).setdefault(link['parent_id'],
+                                                     link['filters'])
+    followed = [(rule, reach[index]) for index, rule in enumerate(rules)
+                if index in reach]
+    calls = [('listPackages', (), {'tagID': rule['parent_id'],
+                                   'inherited': True})
+             for rule, _ in followed]
+    listings = multicall(session, calls)
+    inherited = {}
+    provided = set()
+    for (rule, tags), listing in zip(followed, listings):
+        for package in listing:
+            name = package['package_name']
+            # Entries that the child cannot see might still hide an entry
+            # that it does see, so we treat them as uncertain.
+            filters = tags.get(package['tag_id'])
+            visible = filters is not None and \
+                match_package_filters(name, filters)
+            if not package['blocked'] or not visible:
+                provided.add(name)
+            if name in inherited:
+                # A parent with a higher priority already decided this.
+                continue
+            owner = package.get('owner_name')
+            if package['blocked'] or not visible:
+                owner = None
+            elif isinstance(owner, str):
+                owner = intern(owner)
+            inherited[name] = owner
+    return inherited, provided
+
+
+def match_package_filters(name, filters):
+    """
+    Return True if a package name matches every "pkg_filter" pattern.
+
+    The hub hides a package from a child unless it matches the filters of
+    every link along the way.
+
+    :param str name: package name
+    :param list filters: regular expression strings
+    """
+    for pattern in filters:
+        regex = package_filter_cache.get(pattern)
+        if regex is None:
+            regex = package_filter_cache[pattern] = re.compile(pattern)
+        if not regex.match(name):
+            return False
+    return True
+
+
+def prune_package_lists(packages, blocked_packages, inherited, provided):
+    """
+    Remove redundant entries from desired package and block lists.
+
+    A package entry is redundant if the tag already inherits the package
+    with the same owner. A block is redundant if no parent offers the
+    package.
+
+    :param dict packages: owner names to lists of package names, or None.
+    :param list blocked_packages: package names to block, or None.
+    :param dict inherited: package names to owners, from
+                           get_inherited_packages()
+    :param set provided: package names that parents offer, from
+                         get_inherited_packages()
+    :returns: four-element tuple: the pruned "packages" dict, the set of
+              redundant package names, the pruned "blocked_packages" list,
+              and the set of redundant block names.
+    """
+    redundant = set()
+    if packages:
+        pruned_packages = {}
+        for owner, owned in packages.items():
+            for package in owned:
+                if inherited.get(package) == owner:
+                    redundant.add(package)
+                else:
+                    pruned_packages.setdefault(owner, []).append(package)
+        packages = pruned_packages
+    unneeded = set()
+    if blocked_packages:
+        unneeded = set(package for package in blocked_packages
+                       if package not in provided)
+        blocked_packages = [package for package in blocked_packages
+                            if package not in unneeded]
+    return packages, redundant, blocked_packages, unneeded
+
+
+def decode_package_data(data):
+    """
+    Decode a package list that the koji_tag or koji_tag_packages action
+    plugin read from a packages_file or blocked_packages_file on the
+    controller.
+
+    :param str data: base64-encoded zlib-compressed JSON
+    :returns: the packages dict or blocked_packages list
+    """
+    text = zlib.decompress(base64.b64decode(data)).decode('utf-8')
+    return json.loads(text)
+
+
+def get_package_params(params):
+    """
+    Return the "packages" and "blocked_packages" settings for a module,
+    decoding any lists that the action plugin read from files.
+
+    :param dict params: AnsibleModule params
+    :returns: two-element tuple of packages and blocked_packages
+    :raises: ValueError if the user set a *_file option, but the action
+             plugin did not read it.
+    """
+    values = []
+    for setting in ('packages', 'blocked_packages'):
+        value = params[setting]
+        if params[setting + '_data'] is not None:
+            value = decode_package_data(params[setting + '_data'])
+        elif params[setting + '_file']:
+            raise ValueError('%s_file requires the koji-ansible action '
+                             'plugins' % setting)
+        values.append(value)
+    return tuple(values)
+
+
+# controller-side state file utils
+
+
+def load_state(path):
+    """
+    Load koji-ansible's saved state from a JSON file.
+
+    :param str path: path to the state file.
+    :returns: dict, or an empty dict if the file does not exist yet.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno == 2:  # ENOENT
+            return {}
+        raise
+
+
+def update_state(path, profile, key, value):
+    """
+    Save one value into koji-ansible's JSON state file.
+
+    We re-read the file just before writing it, and we replace it atomically,
+    so that concurrent tasks lose as few updates as possible. A lost update
+    is harmless: the next run simply does the full work again.
+
+    :param str path: path to the state file.
+    :param str profile: Koji profile name. We keep each profile's state
+                        separate, because each profile is a different hub.
+    :param str key: key for this value within the profile, eg. a tag name.
+    :param value: JSON-serializable value to store, or None to delete this
+                  key.
+    """
+    state = load_state(path)
+    profile_state = state.setdefault(profile, {})
+    if value is None:
+        profile_state.pop(key, None)
+    else:
+        profile_state[key] = value
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.koji-ansible-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+# inheritance graph utils
+
+
+INHERITANCE_BATCH_SIZE = 1000
+
+
+class InheritanceGraph(object):
+    """
+    Local copy of (part of) a hub's tag inheritance links.
+
+    Load every link on the hub with from_hub(), or a set of tags and their
+    ancestors with load_ancestors(). Then answer inheritance, ancestor,
+    descendant and cycle questions without more RPCs. inheritance() follows
+    the hub's readFullInheritance() rules, and we memoize each tag's
+    inheritance until the links change.
+    """
+
+    def __init__(self):
+        # child tag ID -> list of getInheritanceData() rules, by priority
+        self.parents = {}
+        self.names = {}
+        # tag ID -> readFullInheritance()-style list of links
+        self._inheritance = {}
+        self._children = None
+
+    @classmethod
+    def from_hub(cls, session):
+        """
+        Load every tag's inheritance links from the hub, in one RPC.
+
+        The hub's history holds every active inheritance link, with the
+        names of both tags.
+
+        :param session: a koji.ClientSession
+        :returns: InheritanceGraph
+        """
+        graph = cls()
+        history = session.queryHistory(tables=['tag_inheritance'],
+                                       active=True)
+        rules = {}
+        for entry in history['tag_inheritance']:
+            rules.setdefault(entry['tag_id'], []).append({
+                'parent_id': entry['parent_id'],
+                'name': entry['parent.name'],
+                'priority': entry['priority'],
+                'maxdepth': entry['maxdepth'],
+                'intransitive': entry['intransitive'],
+                'noconfig': entry['noconfig'],
+                'pkg_filter': entry['pkg_filter'],
+            })
+            graph.names[entry['tag_id']] = entry['tag.name']
+        for tag_id, tag_rules in rules.items():
+            graph.set_parents(tag_id, tag_rules)
+        return graph
+
+    def load_ancestors(self, session, tag_ids):
+        """
+        Load the links for these tags and all their ancestors.
+
+        We read one generation of parents per multicall. Use this instead
+        of from_hub() when you only need a few tags' ancestors.
+
+        :param session: a koji.ClientSession
+        :param list tag_ids: Koji tag IDs
+        """
+        todo = [tag_id for tag_id in tag_ids if tag_id not in self.parents]
+        while todo:
+            self._load(session, todo)
+            todo = sorted(set(rule['parent_id']
+                              for tag_id in todo
+                              for rule in self.parents[tag_id]
+                              if rule['parent_id'] not in self.parents))
+
+    def _load(self, session, tag_ids):
+        calls = [('getInheritanceData', (tag_id,), {}) for tag_id in tag_ids]
+        results = multicall(session, calls, batch=INHERITANCE_BATCH_SIZE)
+        for tag_id, rules in zip(tag_ids, results):
+            self.set_parents(tag_id, rules)
+
+    def set_parents(self, tag_id, rules):
+        """
+        Replace all of a tag's inheritance links.
+
+        Use this to load links, or to try out proposed changes before you
+        send them to the hub.
+
+        :param int tag_id: child tag ID
+        :param list rules: getInheritanceData()-style rules. We use the
+                           "parent_id", "name", "priority", "maxdepth",
+                           "intransitive", "noconfig" and "pkg_filter" keys.
+        """
+        self.parents[tag_id] = sorted(rules, key=lambda r: r['priority'])
+        for rule in rules:
+            if rule.get('name'):
+                self.names[rule['parent_id']] = rule['name']
+        self._inheritance = {}
+        self._children = None
+
+    def inheritance(self, tag_id, rules=None):
+        """
+        Walk a tag's inheritance like the hub's readFullInheritance().
+
+        We visit the links depth-first in priority order. A link's
+        "maxdepth" limits how much further we go: we pass on
+        min(maxdepth, the depth we have left) - 1. Only the starting tag
+        follows its intransitive links. A link with a negative priority
+        prunes its parent: we do not inherit through it, and we skip that
+        parent for the rest of the walk. We skip links back to a tag on the
+        current path, and links to a tag we already visited with at least
+        the same depth, filters and noconfig settings.
+
+        :param int tag_id: Koji tag ID, or None for a tag that does not
+                           exist yet.
+        :param list rules: use these rules for tag_id instead of its
+                           current links. We do not memoize the result.
+        :returns: list of link dicts, in the hub's order. Each dict has the
+                  "parent_id" and "child_id", the "currdepth" of the
+                  parent (1 for a direct parent), the "nextdepth" budget,
+                  the list of "filters" (pkg_filter patterns that a
+                  package name must all match), "noconfig", and "via", the
+                  index of the starting tag's rule that we came through.
+        """
+        if rules is None and tag_id in self._inheritance:
+            return self._inheritance[tag_id]
+        if rules is None:
+            rules = self.parents.get(tag_id, [])
+        else:
+            rules = sorted(rules, key=lambda r: r['priority'])
+        order = []
+        state = {'hist': {}, 'pruned': set()}
+        self._recurse(tag_id, rules, order, state, frozenset(), 0, None,
+                      False, [], None)
+        if rules is self.parents.get(tag_id, []):
+            self._inheritance[tag_id] = order
+        return order
+
+    def _recurse(self, tag_id, rules, order, state, top, currdepth, maxdepth,
+                 noconfig, filters, via):
+        if maxdepth is not None and maxdepth < 1:
+            return
+        currdepth += 1
+        top = top | set([tag_id])
+        for index, rule in enumerate(rules):
+            parent_id = rule['parent_id']
+            if parent_id in top or parent_id in state['pruned']:
+                continue
+            if rule.get('intransitive') and len(top) > 1:
+                continue
+            if rule['priority'] < 0:
+                state['pruned'].add(parent_id)
+                continue
+            nextdepth = rule.get('maxdepth')
+            if nextdepth is None:
+                if maxdepth is not None:
+                    nextdepth = maxdepth - 1
+            elif maxdepth is not None:
+                nextdepth = min(nextdepth, maxdepth) - 1
+            link_filters = list(filters)
+            if rule.get('pkg_filter'):
+                link_filters.append(rule['pkg_filter'])
+            link_noconfig = noconfig or bool(rule.get('noconfig'))
+            link = {'parent_id': parent_id, 'child_id': tag_id,
+                    'currdepth': currdepth, 'nextdepth': nextdepth,
+                    'filters': link_filters, 'noconfig': link_noconfig,
+                    'via': index if via is None else via}
+            previous = state['hist'].setdefault(parent_id, [])
+            if any(self._covers(prev, link) for prev in previous):
+                continue
+            previous.append(link)
+            order.append(link)
+            self._recurse(parent_id, self.parents.get(parent_id, []), order,
+                          state, top, currdepth, nextdepth, link_noconfig,
+                          link_filters, link['via'])
+
+    @staticmethod
+    def _covers(previous, link):
+        """ Return True if an earlier visit reaches everything this one does.
+        """
+        if previous['nextdepth'] is not None:
+            if link['nextdepth'] is None or \
+                    previous['nextdepth'] < link['nextdepth']:
+                return False
+        if not set(previous['filters']) <= set(link['filters']):
+            return False
+        return link['noconfig'] or not previous['noconfig']
+
+    def ancestors(self, tag_id):
+        """
+        Return the tags that this tag inherits from.
+
+        :param int tag_id: Koji tag ID
+        :returns: dict of ancestor tag IDs to their depth (1 for a parent,
+                  2 for a grandparent, etc.) If the tag reaches an ancestor
+                  through several paths, we return the smallest depth.
+        """
+        found = {}
+        for link in self.inheritance(tag_id):
+            depth = found.get(link['parent_id'], link['currdepth'])
+            found[link['parent_id']] = min(depth, link['currdepth'])
+        return found
+
+    def children(self):
+        """
+        Return the reverse links: parent tag IDs to sets of child tag IDs.
+        """
+        if self._children is None:
+            self._children = {}
+            for child_id, rules in self.parents.items():
+                for rule in rules:
+                    self._children.setdefault(rule['parent_id'],
+                                              set()).add(child_id)
+        return self._children
+
+    def descendants(self, tag_id):
+        """
+        Return the tags that inherit from this tag.
+
+        This only knows about the child tags that we have loaded.
+
+        :param int tag_id: Koji tag ID
+        :returns: dict of descendant tag IDs to their depth.
+        """
+        children = self.children()
+        candidates = set()
+        todo = [tag_id]
+        while todo:
+            current = todo.pop()
+            for child_id in children.get(current, ()):
+                if child_id not in candidates and child_id != tag_id:
+                    candidates.add(child_id)
+                    todo.append(child_id)
+        descendants = {}
+        for child_id in candidates:
+            depth = self.ancestors(child_id).get(tag_id)
+            if depth is not None:
+                descendants[child_id] = depth
+        return descendants
+
+    def find_cycle(self):
+        """
+        Find a loop in the inheritance links, ignoring maxdepth and
+        intransitive settings.
+
+        :returns: list of tag IDs from a tag back to itself, or None.
+        """
+        done = set()
+        for start in sorted(self.parents):
+            if start in done:
+                continue
+            path = [start]
+            on_path = set(path)
+            stack = [iter(self.parents[start])]
+            while stack:
+                rule = next(stack[-1], None)
+                if rule is None:
+                    stack.pop()
+                    finished = path.pop()
+                    on_path.discard(finished)
+                    done.add(finished)
+                    continue
+                parent_id = rule['parent_id']
+                if parent_id in on_path:
+                    return path[path.index(parent_id):] + [parent_id]
+                if parent_id in done:
+                    continue
+                path.append(parent_id)
+                on_path.add(parent_id)
+                stack.append(iter(self.parents.get(parent_id, [])))
+        return None
+
+    def describe_path(self, tag_ids):
+        """ Return a "a -> b -> c" string of tag names for these IDs. """
+        return ' -> '.join(self.names.get(tag_id, str(tag_id))
+                           for tag_id in tag_ids)
+
+
+def check_inheritance_changes(session, changes, graph=None):
+    """
+    Check that these inheritance changes will not create a loop.
+
+    :param session: a koji.ClientSession
+    :param dict changes: child tag IDs to the complete new lists of
+                         inheritance rules for those children.
+    :param graph: InheritanceGraph that already holds the current links, if
+                  you have one. We load whatever else we need into it.
+    :raises: ValueError if the changes would create an inheritance loop.
+    """
+    if graph is None:
+        graph = InheritanceGraph()
+    parent_ids = set(rule['parent_id'] for rules in changes.values()
+                     for rule in rules)
+    graph.load_ancestors(session, sorted(parent_ids))
+    for child_id, rules in changes.items():
+        graph.set_parents(child_id, rules)
+    cycle = graph.find_cycle()
+    if cycle:
+        raise ValueError('inheritance loop: %s' % graph.describe_path(cycle))
+
+
 # inheritance display utils
 
 
@@ -159,20 +1132,16 @@ def get_perm_name(session, id_):
             return perm_name
 
 
-def ensure_krb_principals(session, user, check_mode, krb_principals):
+def get_krb_principal_changes(user, krb_principals):
     """
-    Ensure that a user or host has a list of Kerberos principals.
-
-    This method adds or removes Kerberos principals on a user or host.
-    The Koji Hub must be running Koji v1.19 or greater.
+    Find the editUser mappings that give a user or host these principals.
 
-    :param session: Koji client session
     :param dict user: Koji "user" (person or host) information, from the
                       getUser RPC.
-    :param bool check_mode: don't make any changes
     :param list krb_principals: list of desired Kerberos principals for this
                                 user or host.
-    :returns: a possibly-empty list of human-readable changes
+    :returns: two-element tuple: a possibly-empty list of human-readable
+              changes, and a list of editUser krb_principal_mappings dicts.
     """
     current_principals = user['krb_principals']
     to_add = set(krb_principals) - set(current_principals)
@@ -185,12 +1154,61 @@ def ensure_krb_principals(session, user, check_mode, krb_principals):
     for principal in to_remove:
         changes.append('remove %s krb principal' % principal)
         mappings.append({'old': principal, 'new': None})
+    return changes, mappings
+
+
+def ensure_krb_principals(session, user, check_mode, krb_principals):
+    """
+    Ensure that a user or host has a list of Kerberos principals.
+
+    This method adds or removes Kerberos principals on a user or host.
+    The Koji Hub must be running Koji v1.19 or greater.
+
+    :param session: Koji client session
+    :param dict user: Koji "user" (person or host) information, from the
+                      getUser RPC.
+    :param bool check_mode: don't make any changes
+    :param list krb_principals: list of desired Kerberos principals for this
+                                user or host.
+    :returns: a possibly-empty list of human-readable changes
+    """
+    changes, mappings = get_krb_principal_changes(user, krb_principals)
     if changes and not check_mode:
         ensure_logged_in(session)
         session.editUser(user['id'], krb_principal_mappings=mappings)
     return changes
 
 
+# host utils
+
+
+def get_channel_changes(host_name, current_channels, desired_channels):
+    """
+    Find the RPCs that make a host belong to these channels (and only them).
+
+    :param str host_name: Koji host name
+    :param list current_channels: names of the host's channels now
+    :param list desired_channels: names of the channels that the host should
+                                  belong to. The hub creates any channel
+                                  that does not exist yet.
+    :returns: two-element tuple: a possibly-empty list of human-readable
+              changes, and a list of (method name, args, kwargs) calls for
+              multicall().
+    """
+    changes = []
+    calls = []
+    for channel in current_channels:
+        if channel not in desired_channels:
+            changes.append('removed host from channel %s' % channel)
+            calls.append(('removeHostFromChannel', (host_name, channel), {}))
+    for channel in desired_channels:
+        if channel not in current_channels:
+            changes.append('added host to channel %s' % channel)
+            calls.append(('addHostToChannel', (host_name, channel),
+                          {'create': True}))
+    return changes, calls
+
+
 def task_diff_data(before, after, item_name, item_type,
                    keys_to_copy=[], keys_to_omit=[]):
     """
@@ -1,3 +1,4 @@
+import pytest
 import sys
 from os.path import abspath, dirname, join
 
@@ -36,3 +37,10 @@ def pytest_sessionstart(session):
     sys.modules[module_name] = module
     import ansible.module_utils
     ansible.module_utils.common_koji = module
+
+
+@pytest.fixture(autouse=True)
+def expire_tag_id_cache():
+    # Each test's fake hub has its own tag IDs.
+    import ansible.module_utils.common_koji as common_koji
+    common_koji.tag_id_cache.clear()
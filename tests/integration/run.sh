@@ -8,6 +8,7 @@ export PYTHONPATH=$(pwd)/koji:$(pwd)/koji/cli
 # Use our local koji-ansible Git clone:
 export ANSIBLE_LIBRARY=$(pwd)/library
 export ANSIBLE_MODULE_UTILS=$(pwd)/module_utils
+export ANSIBLE_ACTION_PLUGINS=$(pwd)/action_plugins
 
 # Use our local Ansible installation (from pip):
 export PATH=$PATH:$HOME/.local/bin
@@ -0,0 +1,107 @@
+import sys
+from os.path import abspath, dirname, join
+from ansible.module_utils import common_koji
+from ansible.parsing.dataloader import DataLoader
+from mock import Mock
+import pytest
+
+
+def load_action_plugin():
+    """
+    Import action_plugins/koji_tag.py. The name "koji_tag" already belongs
+    to the module in the "library" directory.
+    """
+    tests_directory = dirname(abspath(__file__))
+    location = join(dirname(tests_directory), 'action_plugins', 'koji_tag.py')
+    module_name = 'action_koji_tag'
+    if sys.version_info[0] == 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, location)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    if sys.version_info[0] == 2:
+        import imp
+        module = imp.load_source(module_name, location)
+    return module
+
+
+action_koji_tag = load_action_plugin()
+
+
+class TestEncodePackageData(object):
+
+    def test_round_trip(self):
+        packages = {'kdreyer': ['ceph', 'ansible'], 'hongliu': ['rpm-build']}
+        data = action_koji_tag.encode_package_data(packages)
+        assert common_koji.decode_package_data(data) == packages
+
+    def test_compact(self):
+        packages = {'kdreyer': ['package-%05d' % i for i in range(10000)]}
+        data = action_koji_tag.encode_package_data(packages)
+        assert len(data) < len(str(packages)) / 4
+
+
+class TestActionModule(object):
+
+    @pytest.fixture
+    def executed(self):
+        return []
+
+    def action(self, monkeypatch, executed, args):
+        task = Mock(args=args, async_val=0, check_mode=False)
+        action = action_koji_tag.ActionModule(task=task,
+                                              connection=Mock(),
+                                              play_context=Mock(),
+                                              loader=DataLoader(),
+                                              templar=None,
+                                              shared_loader_obj=None)
+        monkeypatch.setattr(action, '_find_needle',
+                            lambda dirname, needle: needle)
+
+        def execute_module(module_args, task_vars):
+            executed.append(module_args)
+            return {'changed': True}
+        monkeypatch.setattr(action, '_execute_module', execute_module)
+        return action
+
+    def test_packages_file(self, tmpdir, monkeypatch, executed):
+        path = tmpdir.join('packages.yml')
+        path.write('kdreyer:\n  - ceph\n  - ansible\n')
+        args = {'name': 'ceph-5.0-rhel-8', 'packages_file': str(path)}
+        action = self.action(monkeypatch, executed, args)
+        result = action.run(task_vars={})
+        assert result['changed'] is True
+        module_args = executed[0]
+        assert 'packages_file' not in module_args
+        data = module_args['packages_data']
+        packages = common_koji.decode_package_data(data)
+        assert packages == {'kdreyer': ['ceph', 'ansible']}
+
+    def test_blocked_packages_file(self, tmpdir, monkeypatch, executed):
+        path = tmpdir.join('blocked.json')
+        path.write('["ceph", "ansible"]')
+        args = {'tag': 'ceph-5.0-rhel-8', 'blocked_packages_file': str(path)}
+        action = self.action(monkeypatch, executed, args)
+        action.run(task_vars={})
+        data = executed[0]['blocked_packages_data']
+        assert common_koji.decode_package_data(data) == ['ceph', 'ansible']
+
+    def test_both(self, tmpdir, monkeypatch, executed):
+        path = tmpdir.join('packages.yml')
+        path.write('kdreyer:\n  - ceph\n')
+        args = {'name': 'ceph-5.0-rhel-8', 'packages_file': str(path),
+                'packages': {'kdreyer': ['ansible']}}
+        action = self.action(monkeypatch, executed, args)
+        result = action.run(task_vars={})
+        assert result['failed'] is True
+        assert result['msg'] == \
+            'you cannot set both packages and packages_file'
+        assert executed == []
+
+    def test_wrong_type(self, tmpdir, monkeypatch, executed):
+        path = tmpdir.join('packages.yml')
+        path.write('- ceph\n')
+        args = {'name': 'ceph-5.0-rhel-8', 'packages_file': str(path)}
+        action = self.action(monkeypatch, executed, args)
+        result = action.run(task_vars={})
+        assert result['msg'] == 'packages_file must contain a dict'
@@ -6,6 +6,23 @@ from ansible.module_utils.common_koji import describe_inheritance_rule
 from ansible.module_utils.common_koji import get_perms
 from ansible.module_utils.common_koji import get_perm_id
 from ansible.module_utils.common_koji import get_perm_name
+from ansible.module_utils.common_koji import multicall
+from ansible.module_utils.common_koji import RecordingSession
+from ansible.module_utils.common_koji import hub_has_method
+from ansible.module_utils.common_koji import iter_packages
+from ansible.module_utils.common_koji import get_package_index
+from ansible.module_utils.common_koji import get_package_indexes
+from ansible.module_utils.common_koji import PackageIndex
+from ansible.module_utils.common_koji import get_inherited_packages
+from ansible.module_utils.common_koji import prune_package_lists
+from ansible.module_utils.common_koji import load_state
+from ansible.module_utils.common_koji import update_state
+from ansible.module_utils.common_koji import get_tag_ids
+from ansible.module_utils.common_koji import load_tag_ids
+from ansible.module_utils.common_koji import InheritanceGraph
+from ansible.module_utils.common_koji import check_inheritance_changes
+from utils import FakeMulticallSession
+from utils import apply_query_opts
 import pytest
 
 
@@ -190,6 +207,635 @@ class TestGetPerms(object):
         assert session.called == 1
 
 
+class TestMulticall(object):
+
+    class FakeMulticallKoji(FakeMulticallSession):
+        def __init__(self):
+            self.called = []
+
+        def getTag(self, name, strict=False):
+            self.called.append(name)
+            return {'name': name}
+
+    @pytest.fixture()
+    def session(self):
+        return self.FakeMulticallKoji()
+
+    def test_empty(self, session):
+        assert multicall(session, []) == []
+        assert session.multicall is False
+
+    def test_results(self, session):
+        calls = [('getTag', ('foo',), {}),
+                 ('getTag', ('bar',), {'strict': True})]
+        result = multicall(session, calls)
+        assert result == [{'name': 'foo'}, {'name': 'bar'}]
+        assert session.called == ['foo', 'bar']
+        assert session.multicall is False
+
+
+class TestRecordingSession(object):
+
+    class FakeKoji(FakeMulticallSession):
+        def __init__(self):
+            self.tags = {}
+
+        def getTag(self, name, strict=False):
+            return self.tags.get(name)
+
+        def createTag(self, name, parent=None, **kwargs):
+            self.tags[name] = {'name': name}
+            return 1
+
+    @pytest.fixture()
+    def session(self):
+        return self.FakeKoji()
+
+    @pytest.fixture()
+    def recorder(self, session):
+        return RecordingSession(session, ['getTag'])
+
+    def test_read(self, session, recorder):
+        session.tags['foo'] = {'name': 'foo'}
+        assert recorder.getTag('foo') == {'name': 'foo'}
+        assert recorder.calls == []
+
+    def test_write(self, session, recorder):
+        assert recorder.createTag('foo', perm=None) is None
+        assert session.tags == {}
+        assert recorder.calls == [('createTag', ('foo',), {'perm': None})]
+
+    def test_multicall(self, session, recorder):
+        session.tags['foo'] = {'name': 'foo'}
+        calls = [('getTag', ('foo',), {}),
+                 ('createTag', ('bar',), {}),
+                 ('getTag', ('bar',), {})]
+        result = multicall(recorder, calls)
+        assert result == [{'name': 'foo'}, None, None]
+        assert recorder.calls == [('createTag', ('bar',), {})]
+        assert recorder.multicall is False
+        assert 'bar' not in session.tags
+
+    def test_logged_in(self, recorder):
+        assert recorder.logged_in is True
+        common_koji.ensure_logged_in(recorder)
+
+
+class TestHubHasMethod(object):
+
+    class FakeMethodsKoji(object):
+        def __init__(self):
+            self.called = 0
+            self.system = self
+
+        def listMethods(self):
+            self.called += 1
+            return ['getTag', 'editTagExternalRepo']
+
+    @pytest.fixture(autouse=True)
+    def expire_cache(self):
+        # Reset the method cache after every run.
+        common_koji.method_cache = set()
+
+    def test_hub_has_method(self):
+        session = self.FakeMethodsKoji()
+        assert hub_has_method(session, 'editTagExternalRepo')
+        assert not hub_has_method(session, 'bogusMethod')
+        # Verify that we used cached data for the second call:
+        assert session.called == 1
+
+
+class ParameterError(Exception):
+    pass
+
+
+class TestPackageIndex(object):
+
+    class FakePackagesKoji(FakeMulticallSession):
+        def __init__(self, count, old_hub=False, paging=True):
+            self.packages = [
+                {'package_name': 'pkg%05d' % i,
+                 'owner_name': 'user%d' % (i % 3),
+                 'blocked': i % 2 == 0}
+                for i in range(count)
+            ]
+            self.old_hub = old_hub
+            self.paging = paging
+            self.calls = []
+            self.events = []
+            self.event_id = 1000
+
+        def getLastEvent(self):
+            return {'id': self.event_id}
+
+        def listPackages(self, tagID, with_owners=None, queryOpts=None,
+                         event=None):
+            if self.old_hub and with_owners is not None:
+                raise ParameterError(
+                    "unexpected keyword argument 'with_owners'")
+            self.calls.append(queryOpts)
+            self.events.append(event)
+            packages = self.packages
+            if event is not None:
+                packages = [package for package in packages
+                            if package.get('create_event', 0) <= event]
+            if not self.paging:
+                return packages
+            return apply_query_opts(packages, queryOpts)
+
+    def test_paged(self):
+        session = self.FakePackagesKoji(25)
+        packages = list(iter_packages(session, 1, page_size=10))
+        assert packages == session.packages
+        assert len(session.calls) == 3
+
+    def test_pinned_event(self):
+        session = self.FakePackagesKoji(25)
+        pages = iter_packages(session, 1, page_size=10)
+        first = [next(pages) for _ in range(10)]
+        # Someone adds a package that sorts before our next page.
+        session.event_id = 1001
+        session.packages.insert(0, {'package_name': 'aaa',
+                                    'owner_name': 'user0',
+                                    'blocked': False,
+                                    'create_event': 1001})
+        packages = first + list(pages)
+        assert packages == session.packages[1:]
+        assert session.events == [1000, 1000, 1000]
+
+    def test_default_page_size(self):
+        session = self.FakePackagesKoji(15000)
+        packages = list(iter_packages(session, 1))
+        assert len(packages) == 15000
+        assert len(session.calls) == 1
+
+    def test_exact_page_multiple(self):
+        session = self.FakePackagesKoji(20)
+        packages = list(iter_packages(session, 1, page_size=10))
+        assert packages == session.packages
+        assert len(session.calls) == 3
+
+    def test_hub_ignores_paging(self):
+        session = self.FakePackagesKoji(10, paging=False)
+        packages = list(iter_packages(session, 1, page_size=10))
+        assert packages == session.packages
+        assert len(session.calls) == 2
+
+    def test_old_hub(self):
+        session = self.FakePackagesKoji(5, old_hub=True)
+        packages = list(iter_packages(session, 1, with_owners=False))
+        assert packages == session.packages
+
+    def test_index(self):
+        session = self.FakePackagesKoji(4)
+        index = get_package_index(session, 1)
+        assert index == {
+            'pkg00000': ('user0', True),
+            'pkg00001': ('user1', False),
+            'pkg00002': ('user2', True),
+            'pkg00003': ('user0', False),
+        }
+
+    def test_index_without_owners(self):
+        session = self.FakePackagesKoji(2)
+        index = get_package_index(session, 1, with_owners=False)
+        assert index == {
+            'pkg00000': (None, True),
+            'pkg00001': (None, False),
+        }
+
+    def test_indexes(self):
+        session = self.FakePackagesKoji(2)
+        indexes = get_package_indexes(session, [1, 2])
+        expected = {
+            'pkg00000': ('user0', True),
+            'pkg00001': ('user1', False),
+        }
+        assert indexes == [expected, expected]
+        assert session.calls == [None, None]
+
+    def test_indexes_old_hub(self):
+        session = self.FakePackagesKoji(1, old_hub=True)
+        indexes = get_package_indexes(session, [1, 2], with_owners=False)
+        assert indexes == [{'pkg00000': (None, True)}] * 2
+
+
+class TestPackageIndexMapping(object):
+
+    def test_mapping(self):
+        index = PackageIndex()
+        index.add('ceph', 'kdreyer', False)
+        index.add('bash', None, True)
+        assert len(index) == 2
+        assert 'ceph' in index
+        assert 'tar' not in index
+        assert index['ceph'] == ('kdreyer', False)
+        assert index['bash'] == (None, True)
+        assert index.get('tar', (None, False)) == (None, False)
+        with pytest.raises(KeyError):
+            index['tar']
+
+    def test_blocked(self):
+        index = PackageIndex()
+        index.add('ceph', 'kdreyer', False)
+        index.add('bash', 'kdreyer', True)
+        assert index.blocked() == ['bash']
+        assert index.is_blocked('bash') is True
+        assert index.is_blocked('ceph') is False
+        assert index.is_blocked('tar') is False
+
+    def test_owner_table(self):
+        index = PackageIndex()
+        for i in range(10):
+            index.add('pkg%d' % i, 'user%d' % (i % 2), False)
+        assert index.owner('pkg3') == 'user1'
+        assert index._owner_names == ['user0', 'user1']
+
+    def test_shared_strings(self):
+        strings = {}
+        first = PackageIndex(strings)
+        second = PackageIndex(strings)
+        first.add(''.join(['ce', 'ph']), 'kdreyer', False)
+        second.add(''.join(['ce', 'ph']), 'kdreyer', False)
+        assert list(first)[0] is list(second)[0]
+
+    def test_add_twice(self):
+        index = PackageIndex()
+        index.add('ceph', 'kdreyer', False)
+        index.add('ceph', 'ktdreyer', True)
+        assert len(index) == 1
+        assert index['ceph'] == ('ktdreyer', True)
+
+
+class TestInheritedPackages(object):
+
+    class FakeKoji(FakeMulticallSession):
+        def __init__(self):
+            self.tags = {
+                'parent-a': {'id': 1},
+                'parent-b': {'id': 2},
+                'base': {'id': 3},
+                'extras': {'id': 4},
+            }
+            # parent-a inherits from base, and from extras intransitively.
+            self.inheritance = {
+                1: [{'parent_id': 3, 'name': 'base', 'priority': 0,
+                     'maxdepth': None, 'intransitive': False},
+                    {'parent_id': 4, 'name': 'extras', 'priority': 10,
+                     'maxdepth': None, 'intransitive': True}],
+            }
+            self.packages = {
+                1: [{'package_name': 'ceph', 'owner_name': 'kdreyer',
+                     'blocked': False, 'tag_id': 3},
+                    {'package_name': 'bash', 'owner_name': 'kdreyer',
+                     'blocked': True, 'tag_id': 1},
+                    {'package_name': 'python', 'owner_name': 'kdreyer',
+                     'blocked': False, 'tag_id': 4}],
+                2: [{'package_name': 'bash', 'owner_name': 'kdreyer',
+                     'blocked': False, 'tag_id': 2},
+                    {'package_name': 'ceph', 'owner_name': 'hongliu',
+                     'blocked': False, 'tag_id': 2},
+                    {'package_name': 'rpm', 'owner_name': 'hongliu',
+                     'blocked': False, 'tag_id': 2}],
+            }
+
+        def getTag(self, name, strict=False):
+            return self.tags.get(name)
+
+        def getInheritanceData(self, tag_id):
+            return self.inheritance.get(tag_id, [])
+
+        def listPackages(self, tagID, inherited=False):
+            assert inherited
+            return self.packages[tagID]
+
+    @pytest.fixture()
+    def session(self):
+        return self.FakeKoji()
+
+    def rule(self, name, priority, maxdepth=None, pkg_filter=''):
+        return {'name': name, 'priority': priority, 'maxdepth': maxdepth,
+                'pkg_filter': pkg_filter}
+
+    def test_priority(self, session):
+        rules = [self.rule('parent-b', 10), self.rule('parent-a', 0)]
+        inherited, provided = get_inherited_packages(session, rules)
+        assert inherited == {'ceph': 'kdreyer', 'bash': None,
+                             'rpm': 'hongliu', 'python': None}
+        assert provided == {'ceph', 'bash', 'rpm', 'python'}
+
+    def test_maxdepth(self, session):
+        rules = [self.rule('parent-a', 0, maxdepth=0),
+                 self.rule('parent-b', 10)]
+        inherited, provided = get_inherited_packages(session, rules)
+        assert inherited == {'ceph': None, 'bash': None, 'rpm': 'hongliu',
+                             'python': None}
+
+    def test_intransitive(self, session):
+        # parent-a's listing shows python from its intransitive link to
+        # extras, but the child does not inherit python from parent-a.
+        rules = [self.rule('parent-a', 0)]
+        inherited, provided = get_inherited_packages(session, rules)
+        assert inherited['python'] is None
+        assert inherited['ceph'] == 'kdreyer'
+        assert 'python' in provided
+
+    def test_pkg_filter(self, session):
+        # The child's filter hides rpm, but ceph matches it.
+        rules = [self.rule('parent-b', 0, pkg_filter='^(ceph|bash)$')]
+        inherited, provided = get_inherited_packages(session, rules)
+        assert inherited == {'bash': 'kdreyer', 'ceph': 'hongliu',
+                             'rpm': None}
+        assert provided == {'bash', 'ceph', 'rpm'}
+
+    def test_missing_parent(self, session):
+        rules = [self.rule('parent-c', 0), self.rule('parent-a', 10)]
+        inherited, provided = get_inherited_packages(session, rules)
+        assert inherited == {'ceph': 'kdreyer', 'bash': None,
+                             'python': None}
+        assert provided == {'ceph', 'python'}
+
+    def test_prune(self):
+        inherited = {'ceph': 'kdreyer', 'bash': None, 'rpm': 'hongliu'}
+        provided = {'ceph', 'rpm'}
+        packages = {'kdreyer': ['ceph', 'bash', 'rpm']}
+        blocked = ['rpm', 'coreutils']
+        result = prune_package_lists(packages, blocked, inherited, provided)
+        assert result == ({'kdreyer': ['bash', 'rpm']}, {'ceph'},
+                          ['rpm'], {'coreutils'})
+
+    def test_prune_none(self):
+        result = prune_package_lists(None, None, {}, set())
+        assert result == (None, set(), None, set())
+
+
+class TestState(object):
+
+    def test_missing(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        assert load_state(path) == {}
+
+    def test_update(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        update_state(path, 'koji', 'tag-a', {'event_id': 1})
+        update_state(path, 'koji', 'tag-b', {'event_id': 2})
+        update_state(path, 'cbs', 'tag-a', {'event_id': 3})
+        assert load_state(path) == {
+            'koji': {'tag-a': {'event_id': 1}, 'tag-b': {'event_id': 2}},
+            'cbs': {'tag-a': {'event_id': 3}},
+        }
+        update_state(path, 'koji', 'tag-a', None)
+        assert load_state(path)['koji'] == {'tag-b': {'event_id': 2}}
+        # We do not leave temporary files behind.
+        assert tmpdir.listdir() == [tmpdir.join('state.json')]
+
+
+class TestTagIds(object):
+
+    class FakeKoji(FakeMulticallSession):
+        def __init__(self):
+            self.tags = {'tag-a': {'id': 1, 'name': 'tag-a'},
+                         'tag-b': {'id': 2, 'name': 'tag-b'}}
+            self.event_id = 100
+            self.history = []
+            self.calls = []
+
+        def getTag(self, tagInfo):
+            self.calls.append('getTag')
+            return self.tags.get(tagInfo)
+
+        def listTags(self):
+            self.calls.append('listTags')
+            return list(self.tags.values())
+
+        def getLastEvent(self):
+            return {'id': self.event_id}
+
+        def queryHistory(self, tables, afterEvent):
+            self.calls.append('queryHistory')
+            return {'tag_config': [
+                entry for entry in self.history
+                if entry['create_event'] > afterEvent or
+                (entry.get('revoke_event') or 0) > afterEvent]}
+
+    def test_get_tag_ids(self):
+        session = self.FakeKoji()
+        ids = get_tag_ids(session, ['tag-a', 'tag-b', 'tag-c'])
+        assert ids == {'tag-a': 1, 'tag-b': 2, 'tag-c': None}
+        assert session.calls == ['getTag'] * 3
+        # We remember the tags that exist.
+        ids = get_tag_ids(session, ['tag-a', 'tag-b'])
+        assert ids == {'tag-a': 1, 'tag-b': 2}
+        assert session.calls == ['getTag'] * 3
+
+    def test_load_tag_ids(self, tmpdir):
+        path = str(tmpdir.join('tags.json'))
+        session = self.FakeKoji()
+        load_tag_ids(session, 'koji', path)
+        assert common_koji.tag_id_cache == {'tag-a': 1, 'tag-b': 2}
+        assert session.calls == ['listTags']
+        saved = load_state(path)['koji']['tag_ids']
+        assert saved == {'event_id': 100,
+                         'tags': {'tag-a': 1, 'tag-b': 2}}
+
+    def test_load_saved_tag_ids(self, tmpdir):
+        path = str(tmpdir.join('tags.json'))
+        update_state(path, 'koji', 'tag_ids',
+                     {'event_id': 100, 'tags': {'tag-a': 1}})
+        session = self.FakeKoji()
+        load_tag_ids(session, 'koji', path)
+        assert common_koji.tag_id_cache == {'tag-a': 1}
+        assert session.calls == ['queryHistory']
+        assert get_tag_ids(session, ['tag-a']) == {'tag-a': 1}
+        assert session.calls == ['queryHistory']
+
+    def history_entry(self, tag_id, name, create_event, revoke_event=None):
+        return {'tag_id': tag_id, 'tag.name': name,
+                'create_event': create_event, 'revoke_event': revoke_event}
+
+    def load_saved(self, tmpdir, session, tags):
+        path = str(tmpdir.join('tags.json'))
+        update_state(path, 'koji', 'tag_ids',
+                     {'event_id': 99, 'tags': tags})
+        load_tag_ids(session, 'koji', path)
+        return path
+
+    def test_load_created_tag(self, tmpdir):
+        session = self.FakeKoji()
+        session.history = [self.history_entry(2, 'tag-b', 100)]
+        path = self.load_saved(tmpdir, session, {'tag-a': 1})
+        assert common_koji.tag_id_cache == {'tag-a': 1, 'tag-b': 2}
+        assert session.calls == ['queryHistory']
+        assert load_state(path)['koji']['tag_ids'] == {
+            'event_id': 100, 'tags': {'tag-a': 1, 'tag-b': 2}}
+
+    def test_load_edited_tag(self, tmpdir):
+        session = self.FakeKoji()
+        session.history = [self.history_entry(1, 'tag-a', 50, 101),
+                           self.history_entry(1, 'tag-a', 101)]
+        path = self.load_saved(tmpdir, session, {'tag-a': 1, 'tag-b': 2})
+        assert common_koji.tag_id_cache == {'tag-a': 1, 'tag-b': 2}
+        assert session.calls == ['queryHistory']
+        assert load_state(path)['koji']['tag_ids']['event_id'] == 101
+
+    def test_load_deleted_tag(self, tmpdir):
+        session = self.FakeKoji()
+        session.history = [self.history_entry(2, 'tag-b', 50, 100)]
+        self.load_saved(tmpdir, session, {'tag-a': 1, 'tag-b': 2})
+        assert common_koji.tag_id_cache == {'tag-a': 1}
+        assert session.calls == ['queryHistory']
+
+    def test_load_conflicting_tag(self, tmpdir):
+        # Another tag took tag-a's name, so tag-a must have been renamed.
+        session = self.FakeKoji()
+        session.history = [self.history_entry(3, 'tag-a', 100)]
+        path = self.load_saved(tmpdir, session, {'tag-a': 1})
+        assert common_koji.tag_id_cache == {'tag-a': 1, 'tag-b': 2}
+        assert session.calls == ['queryHistory', 'listTags']
+        assert load_state(path)['koji']['tag_ids']['event_id'] == 100
+
+
+def link(parent_id, priority=0, maxdepth=None, intransitive=False,
+         pkg_filter=''):
+    return {'parent_id': parent_id, 'name': 'tag-%d' % parent_id,
+            'priority': priority, 'maxdepth': maxdepth,
+            'intransitive': intransitive, 'noconfig': False,
+            'pkg_filter': pkg_filter}
+
+
+class TestInheritanceGraph(object):
+
+    class FakeKoji(FakeMulticallSession):
+        def __init__(self, links):
+            self.links = links
+
+        def getInheritanceData(self, tag):
+            return self.links.get(tag, [])
+
+        def queryHistory(self, tables, active):
+            assert tables == ['tag_inheritance'] and active
+            rows = []
+            for tag_id, links in self.links.items():
+                for entry in links:
+                    row = dict(entry)
+                    row['tag_id'] = tag_id
+                    row['tag.name'] = 'tag-%d' % tag_id
+                    row['parent.name'] = row.pop('name')
+                    rows.append(row)
+            return {'tag_inheritance': rows}
+
+    @pytest.fixture
+    def graph(self):
+        # 1 -> 2 -> 3 -> 4, and 1 -> 5
+        graph = InheritanceGraph()
+        graph.set_parents(1, [link(2), link(5, priority=10)])
+        graph.set_parents(2, [link(3)])
+        graph.set_parents(3, [link(4)])
+        return graph
+
+    def test_ancestors(self, graph):
+        assert graph.ancestors(1) == {2: 1, 3: 2, 4: 3, 5: 1}
+        assert graph.ancestors(4) == {}
+
+    def test_maxdepth(self, graph):
+        graph.set_parents(1, [link(2, maxdepth=1), link(5, priority=10)])
+        assert graph.ancestors(1) == {2: 1, 3: 2, 5: 1}
+        graph.set_parents(1, [link(2, maxdepth=0)])
+        assert graph.ancestors(1) == {2: 1}
+
+    def test_intransitive(self, graph):
+        graph.set_parents(2, [link(3, intransitive=True)])
+        assert graph.ancestors(2) == {3: 1, 4: 2}
+        assert graph.ancestors(1) == {2: 1, 5: 1}
+
+    def test_nested_maxdepth(self, graph):
+        # The hub passes on min(maxdepth, depth left) - 1, so the inner
+        # link's maxdepth stops the walk one level sooner.
+        graph.set_parents(1, [link(2, maxdepth=3)])
+        graph.set_parents(2, [link(3, maxdepth=1)])
+        assert graph.ancestors(1) == {2: 1, 3: 2}
+        assert graph.ancestors(2) == {3: 1, 4: 2}
+
+    def test_prune(self, graph):
+        graph.set_parents(1, [link(2), link(4, priority=-1)])
+        assert graph.ancestors(1) == {2: 1, 3: 2}
+        graph.set_parents(2, [link(3), link(4, priority=-1)])
+        assert graph.ancestors(1) == {2: 1, 3: 2}
+        assert graph.ancestors(3) == {4: 1}
+
+    def test_first_visit(self, graph):
+        # Like the hub, we list each ancestor once, at the depth where the
+        # walk first reaches it.
+        graph.set_parents(1, [link(2), link(4, priority=10)])
+        assert graph.ancestors(1)[4] == 3
+
+    def test_inheritance(self, graph):
+        graph.set_parents(2, [link(3, pkg_filter='^a')])
+        graph.set_parents(3, [link(4, pkg_filter='^ab', maxdepth=2)])
+        order = graph.inheritance(1)
+        assert [(entry['parent_id'], entry['currdepth'], entry['nextdepth'],
+                 entry['filters'], entry['via']) for entry in order] == [
+            (2, 1, None, [], 0),
+            (3, 2, None, ['^a'], 0),
+            (4, 3, 2, ['^a', '^ab'], 0),
+            (5, 1, None, [], 1),
+        ]
+
+    def test_inheritance_rules(self, graph):
+        order = graph.inheritance(None, [link(3, maxdepth=0)])
+        assert [entry['parent_id'] for entry in order] == [3]
+        assert graph.inheritance(None) == []
+
+    def test_descendants(self, graph):
+        assert graph.descendants(3) == {2: 1, 1: 2}
+        graph.set_parents(1, [link(2, maxdepth=0)])
+        assert graph.descendants(3) == {2: 1}
+
+    def test_memoized(self, graph):
+        order = graph.inheritance(1)
+        assert graph.inheritance(1) is order
+        graph.inheritance(None, [link(2)])
+        assert list(graph._inheritance) == [1]
+        graph.set_parents(3, [])
+        assert graph._inheritance == {}
+
+    def test_find_cycle(self, graph):
+        assert graph.find_cycle() is None
+        graph.set_parents(4, [link(2)])
+        assert graph.find_cycle() == [2, 3, 4, 2]
+        assert graph.describe_path([2, 3, 4, 2]) == \
+            'tag-2 -> tag-3 -> tag-4 -> tag-2'
+
+    def test_ancestors_with_cycle(self, graph):
+        graph.set_parents(4, [link(1)])
+        assert graph.ancestors(1) == {2: 1, 3: 2, 4: 3, 5: 1}
+
+    def test_load_ancestors(self):
+        session = self.FakeKoji({1: [link(2), link(5)], 2: [link(3)]})
+        graph = InheritanceGraph()
+        graph.load_ancestors(session, [1])
+        assert graph.ancestors(1) == {2: 1, 3: 2, 5: 1}
+        # One multicall per generation.
+        assert [len(calls) for calls in session.requests] == [1, 2, 1]
+
+    def test_from_hub(self):
+        session = self.FakeKoji({1: [link(2), link(5, priority=10)],
+                                 2: [link(3)]})
+        graph = InheritanceGraph.from_hub(session)
+        assert graph.ancestors(1) == {2: 1, 3: 2, 5: 1}
+        assert graph.descendants(3) == {2: 1, 1: 2}
+        assert graph.names[1] == 'tag-1'
+        assert session.requests == []
+
+    def test_check_changes(self):
+        session = self.FakeKoji({2: [link(3)], 3: [link(4)]})
+        check_inheritance_changes(session, {1: [link(2)]})
+        with pytest.raises(ValueError) as e:
+            check_inheritance_changes(session, {4: [link(2)]})
+        assert str(e.value) == \
+            'inheritance loop: tag-2 -> tag-3 -> tag-4 -> tag-2'
+
+
 """
 Live tests, need to figure out how to mock these out:
 
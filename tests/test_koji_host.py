@@ -7,9 +7,10 @@ from utils import fail_json
 from utils import set_module_args
 from utils import AnsibleExitJson
 from utils import AnsibleFailJson
+from utils import FakeMulticallSession
 
 
-class FakeKojiSession(object):
+class FakeKojiSession(FakeMulticallSession):
 
     def __init__(self):
         self.hosts = {}
@@ -282,6 +283,41 @@ class TestEnsureHostChanged(object):
         assert session.host_channels['builder'] == []
 
 
+class TestEnsureChannels(object):
+
+    @pytest.fixture
+    def session(self, session, builder):
+        session.hosts['builder'] = builder
+        session.host_channels['builder'] = [{'id': 1, 'name': 'default'}]
+        return session
+
+    @pytest.fixture
+    def logins(self, monkeypatch):
+        logins = []
+        monkeypatch.setattr(koji_host.common_koji, 'ensure_logged_in',
+                            logins.append)
+        return logins
+
+    @pytest.mark.parametrize('channels', (['default'], ['createrepo']))
+    def test_check_mode_anonymous(self, session, logins, channels):
+        koji_host.ensure_channels(session, 1, 'builder', True, channels)
+        assert logins == []
+        assert session.host_channels['builder'] == \
+            [{'id': 1, 'name': 'default'}]
+
+    def test_one_multicall(self, session, logins):
+        result = koji_host.ensure_channels(session, 1, 'builder', False,
+                                           ['createrepo', 'container'])
+        assert result['stdout_lines'] == [
+            'removed host from channel default',
+            'added host to channel createrepo',
+            'added host to channel container',
+        ]
+        assert logins == [session]
+        assert session.requests == [['removeHostFromChannel',
+                                     'addHostToChannel', 'addHostToChannel']]
+
+
 class TestEnsureHostCreated(object):
 
     @pytest.mark.parametrize('check_mode', (True, False))
@@ -0,0 +1,210 @@
+import pytest
+import koji_host_drain
+from koji import TASK_STATES  # NOQA: used by count_open_tasks
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+
+
+class FakeKojiSession(FakeMulticallSession):
+
+    logged_in = True
+
+    def __init__(self):
+        self.hosts = {}
+        # host ID -> list of open task counts, one for each listTasks call.
+        # The last count repeats.
+        self.open_tasks = {}
+
+    def add_host(self, name, enabled=True, open_tasks=(0,)):
+        host_id = len(self.hosts) + 1
+        self.hosts[name] = {'id': host_id, 'name': name, 'enabled': enabled}
+        self.open_tasks[host_id] = list(open_tasks)
+
+    def getHost(self, hostInfo):
+        return self.hosts.get(hostInfo)
+
+    def enableHost(self, hostname):
+        self.hosts[hostname]['enabled'] = True
+
+    def disableHost(self, hostname):
+        self.hosts[hostname]['enabled'] = False
+
+    def listTasks(self, opts, queryOpts):
+        assert queryOpts == {'countOnly': True}
+        assert opts['state'] == [TASK_STATES['OPEN'],
+                                 TASK_STATES['ASSIGNED']]
+        counts = self.open_tasks[opts['host_id']]
+        if len(counts) > 1:
+            return counts.pop(0)
+        return counts[0]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(koji_host_drain, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def session():
+    session = FakeKojiSession()
+    session.add_host('builder1', open_tasks=(2, 1, 0))
+    session.add_host('builder2', open_tasks=(1, 1, 1, 1, 1, 0))
+    session.add_host('builder3', enabled=False)
+    return session
+
+
+class TestDrainHosts(object):
+
+    def test_drain(self, session, clock):
+        names = ['builder1', 'builder2', 'builder3']
+        result = koji_host_drain.drain_hosts(session, False, names,
+                                             poll_interval=10,
+                                             max_poll_interval=30)
+        assert result['changed'] is True
+        assert result['stdout_lines'] == ['builder1: disabled host',
+                                          'builder2: disabled host']
+        assert result['polls'] == 6
+        assert result['disabled_hosts'] == ['builder1', 'builder2']
+        assert not session.hosts['builder1']['enabled']
+        assert not session.hosts['builder2']['enabled']
+        # Every poll is one multicall, and idle hosts drop out.
+        assert session.requests == [
+            ['getHost'] * 3,
+            ['disableHost'] * 2,
+            ['listTasks'] * 3,
+            ['listTasks'] * 2,
+            ['listTasks'] * 2,
+            ['listTasks'],
+            ['listTasks'],
+            ['listTasks'],
+        ]
+        # We back off while nothing finishes.
+        assert clock.sleeps == [10, 10, 10, 20, 30]
+
+    def test_already_drained(self, session, clock):
+        result = koji_host_drain.drain_hosts(session, False, ['builder3'])
+        assert result == {'changed': False, 'stdout_lines': [], 'polls': 1,
+                          'disabled_hosts': []}
+        assert clock.sleeps == []
+
+    def test_check_mode(self, session, clock):
+        result = koji_host_drain.drain_hosts(session, True, ['builder1'])
+        assert result['changed'] is True
+        assert result['polls'] == 0
+        assert result['disabled_hosts'] == ['builder1']
+        assert session.hosts['builder1']['enabled']
+        assert session.requests == [['getHost']]
+
+    def test_timeout(self, session, clock):
+        session.open_tasks[2] = [1]
+        with pytest.raises(koji_host_drain.DrainTimeoutError) as e:
+            koji_host_drain.drain_hosts(session, False,
+                                        ['builder1', 'builder2'],
+                                        timeout=25, poll_interval=10)
+        assert str(e.value) == \
+            'timed out waiting for 1 open tasks on builder2'
+        assert e.value.disabled_hosts == ['builder1', 'builder2']
+        assert clock.now == 25
+        assert not session.hosts['builder2']['enabled']
+
+    def test_unknown_host(self, session, clock):
+        with pytest.raises(ValueError) as e:
+            koji_host_drain.drain_hosts(session, False, ['nope'])
+        assert str(e.value) == 'host nope does not exist'
+
+
+class TestSetEnabled(object):
+
+    def test_enable(self, session):
+        hosts = koji_host_drain.get_hosts(session, ['builder1', 'builder3'])
+        result = koji_host_drain.set_enabled(session, False, hosts, True)
+        assert result['stdout_lines'] == ['builder3: enabled host']
+        assert session.hosts['builder3']['enabled']
+        assert session.requests[-1] == ['enableHost']
+
+
+class TestMain(object):
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(koji_host_drain.AnsibleModule,
+                            'exit_json', exit_json)
+        monkeypatch.setattr(koji_host_drain.AnsibleModule,
+                            'fail_json', fail_json)
+
+    @pytest.fixture(autouse=True)
+    def fake_session(self, monkeypatch, session):
+        monkeypatch.setattr(koji_host_drain.common_koji,
+                            'get_session',
+                            lambda x: session)
+
+    def test_drained(self, session, clock):
+        set_module_args({'hosts': ['builder1'], 'poll_interval': 1})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_host_drain.main()
+        result = exit.value.args[0]
+        assert result['changed'] is True
+        assert result['polls'] == 3
+
+    def test_enabled(self, session):
+        set_module_args({'hosts': ['builder3'], 'state': 'enabled'})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_host_drain.main()
+        result = exit.value.args[0]
+        assert result['stdout_lines'] == ['builder3: enabled host']
+
+    def test_enable_drained(self, session, clock):
+        set_module_args({'hosts': ['builder1', 'builder3'],
+                         'poll_interval': 1})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_host_drain.main()
+        drained = exit.value.args[0]
+        assert drained['disabled_hosts'] == ['builder1']
+        set_module_args({'hosts': ['builder1', 'builder3'],
+                         'state': 'enabled',
+                         'disabled_hosts': drained['disabled_hosts']})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_host_drain.main()
+        result = exit.value.args[0]
+        # builder3 was disabled before the drain, so it stays disabled.
+        assert result['stdout_lines'] == ['builder1: enabled host']
+        assert not session.hosts['builder3']['enabled']
+
+    def test_timeout(self, session, clock):
+        set_module_args({'hosts': ['builder2', 'builder3'], 'timeout': 5,
+                         'poll_interval': 1})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_host_drain.main()
+        result = exit.value.args[0]
+        assert result['msg'] == \
+            'timed out waiting for 1 open tasks on builder2'
+        assert result['changed'] is True
+        # builder3 was already disabled.
+        assert result['disabled_hosts'] == ['builder2']
+
+    def test_unknown_host(self, session):
+        set_module_args({'hosts': ['nope']})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_host_drain.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'host nope does not exist'
@@ -0,0 +1,145 @@
+import pytest
+import koji_host_info
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+
+
+class GenericError(Exception):
+    pass
+
+
+class FakeKojiSession(FakeMulticallSession):
+
+    def __init__(self):
+        self.hosts = []
+        self.host_channels = {}
+        self.user_krb_principals = {}
+
+    def add_host(self, name, arches, channels, krb_principals=()):
+        host_id = len(self.hosts) + 1
+        self.hosts.append({
+            'arches': ' '.join(arches),
+            'capacity': 2.0,
+            'comment': None,
+            'description': None,
+            'enabled': True,
+            'id': host_id,
+            'name': name,
+            'ready': True,
+            'task_load': 0.0,
+            'user_id': host_id + 100,
+        })
+        self.host_channels[host_id] = list(channels)
+        self.user_krb_principals[host_id + 100] = list(krb_principals)
+
+    def listHosts(self, arches=None, channelID=None):
+        channels = set(channel for channels in self.host_channels.values()
+                       for channel in channels)
+        if channelID and channelID not in channels:
+            raise GenericError('No such channel: %s' % channelID)
+        hosts = []
+        for host in self.hosts:
+            if arches and not set(arches) & set(host['arches'].split()):
+                continue
+            if channelID and channelID not in self.host_channels[host['id']]:
+                continue
+            hosts.append(dict(host))
+        return hosts
+
+    def listChannels(self, hostID):
+        return [{'id': i, 'name': name}
+                for i, name in enumerate(self.host_channels[hostID])]
+
+    def getUser(self, userInfo):
+        return {'id': userInfo,
+                'krb_principals': self.user_krb_principals[userInfo]}
+
+
+@pytest.fixture
+def session():
+    session = FakeKojiSession()
+    session.add_host('builder2', ['x86_64'], ['default'])
+    session.add_host('builder1', ['x86_64', 'i686'],
+                     ['default', 'createrepo'],
+                     ['compile/builder1@EXAMPLE.COM'])
+    session.add_host('armbuilder', ['aarch64'], ['default'])
+    return session
+
+
+class TestGetHostsInfo(object):
+
+    def test_all(self, session):
+        hosts = koji_host_info.get_hosts_info(session)
+        assert [host['name'] for host in hosts] == \
+            ['armbuilder', 'builder1', 'builder2']
+        builder1 = hosts[1]
+        assert builder1['channels'] == ['createrepo', 'default']
+        assert builder1['krb_principals'] == ['compile/builder1@EXAMPLE.COM']
+        assert builder1['arches'] == 'x86_64 i686'
+        assert session.requests == [['listChannels', 'getUser'] * 3]
+
+    def test_arches(self, session):
+        hosts = koji_host_info.get_hosts_info(session, arches=['i686'])
+        assert [host['name'] for host in hosts] == ['builder1']
+
+    def test_channel(self, session):
+        hosts = koji_host_info.get_hosts_info(session, channel='default',
+                                              arches=['x86_64'])
+        assert [host['name'] for host in hosts] == ['builder1', 'builder2']
+
+    def test_no_hosts(self, session):
+        hosts = koji_host_info.get_hosts_info(session, arches=['s390x'])
+        assert hosts == []
+        assert session.requests == []
+
+    def test_unknown_channel(self, session):
+        with pytest.raises(ValueError) as e:
+            koji_host_info.get_hosts_info(session, channel='nope')
+        assert str(e.value) == 'channel nope does not exist'
+
+
+class TestGetKrbPrincipals(object):
+
+    @pytest.mark.parametrize(('user', 'expected'), [
+        (None, []),
+        ({'krb_principals': ['a@EXAMPLE.COM']}, ['a@EXAMPLE.COM']),
+        ({'krb_principal': 'a@EXAMPLE.COM'}, ['a@EXAMPLE.COM']),
+        ({'krb_principal': None}, []),
+    ])
+    def test_get_krb_principals(self, user, expected):
+        assert koji_host_info.get_krb_principals(user) == expected
+
+
+class TestMain(object):
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(koji_host_info.AnsibleModule,
+                            'exit_json', exit_json)
+        monkeypatch.setattr(koji_host_info.AnsibleModule,
+                            'fail_json', fail_json)
+
+    @pytest.fixture(autouse=True)
+    def fake_session(self, monkeypatch, session):
+        monkeypatch.setattr(koji_host_info.common_koji,
+                            'get_session',
+                            lambda x: session)
+
+    def test_channel(self, session):
+        set_module_args({'channel': 'createrepo'})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_host_info.main()
+        result = exit.value.args[0]
+        assert result['changed'] is False
+        assert [host['name'] for host in result['hosts']] == ['builder1']
+
+    def test_unknown_channel(self, session):
+        set_module_args({'channel': 'nope'})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_host_info.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'channel nope does not exist'
@@ -0,0 +1,279 @@
+import pytest
+import koji_hosts
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+
+
+class FakeKojiSession(FakeMulticallSession):
+
+    def __init__(self):
+        self.hosts = {}
+        self.host_channels = {}
+        self.user_krb_principals = {}
+
+    def addHost(self, hostname, arches, krb_principal=None, force=False):
+        host_id = len(self.hosts) + 1
+        self.hosts[hostname] = {
+            'arches': ' '.join(arches),
+            'capacity': 2.0,
+            'comment': '',
+            'description': '',
+            'enabled': True,
+            'id': host_id,
+            'name': hostname,
+            'ready': False,
+            'task_load': 0.0,
+            'user_id': host_id + 100,
+        }
+        self.host_channels[hostname] = ['default']
+        if krb_principal:
+            self.user_krb_principals[host_id + 100] = [krb_principal]
+        return host_id
+
+    def _host(self, hostInfo):
+        for host in self.hosts.values():
+            if hostInfo in (host['id'], host['name']):
+                return host
+        raise ValueError('no such host %s' % hostInfo)
+
+    def listHosts(self):
+        return list(self.hosts.values())
+
+    def getHost(self, hostInfo):
+        return self._host(hostInfo)
+
+    def getUser(self, userInfo):
+        for host in self.hosts.values():
+            if host['user_id'] == userInfo:
+                principals = self.user_krb_principals.get(userInfo, [])
+                return {'id': userInfo, 'name': host['name'],
+                        'krb_principals': list(principals)}
+        return None
+
+    def editHost(self, hostInfo, **kw):
+        self._host(hostInfo).update(kw)
+
+    def enableHost(self, hostname):
+        self._host(hostname)['enabled'] = True
+
+    def disableHost(self, hostname):
+        self._host(hostname)['enabled'] = False
+
+    def listChannels(self, hostID):
+        name = self._host(hostID)['name']
+        return [{'id': i, 'name': channel}
+                for i, channel in enumerate(self.host_channels[name])]
+
+    def addHostToChannel(self, hostname, channel_name, create=False):
+        assert create
+        self.host_channels[hostname].append(channel_name)
+
+    def removeHostFromChannel(self, hostname, channel_name):
+        self.host_channels[hostname].remove(channel_name)
+
+    def editUser(self, userInfo, krb_principal_mappings=None):
+        principals = self.user_krb_principals.setdefault(userInfo, [])
+        for mapping in krb_principal_mappings:
+            if mapping['old']:
+                principals.remove(mapping['old'])
+            if mapping['new']:
+                principals.append(mapping['new'])
+
+
+@pytest.fixture
+def session():
+    session = FakeKojiSession()
+    session.addHost('builder1', ['x86_64'])
+    session.addHost('builder2', ['x86_64'])
+    return session
+
+
+@pytest.fixture
+def logins(monkeypatch):
+    logins = []
+    monkeypatch.setattr(koji_hosts.common_koji, 'ensure_logged_in',
+                        logins.append)
+    return logins
+
+
+class TestNormalizeHosts(object):
+
+    def test_defaults(self):
+        specs = koji_hosts.normalize_hosts([
+            {'name': 'builder1', 'arches': ['x86_64'],
+             'krb_principal': 'compile/builder1@EXAMPLE.COM'}])
+        assert specs == [{
+            'name': 'builder1',
+            'arches': ['x86_64'],
+            'channels': None,
+            'state': 'enabled',
+            'krb_principals': ['compile/builder1@EXAMPLE.COM'],
+            'capacity': None,
+            'description': None,
+            'comment': None,
+        }]
+
+    def test_list_strings(self):
+        specs = koji_hosts.normalize_hosts([
+            {'name': 'builder1', 'arches': 'x86_64',
+             'channels': 'default, createrepo'}])
+        assert specs[0]['arches'] == ['x86_64']
+        assert specs[0]['channels'] == ['default', 'createrepo']
+
+    @pytest.mark.parametrize('capacity', [2, '2', '2.0', 2.0])
+    def test_capacity(self, capacity):
+        specs = koji_hosts.normalize_hosts([
+            {'name': 'builder1', 'arches': 'x86_64', 'capacity': capacity}])
+        assert specs[0]['capacity'] == 2.0
+        assert isinstance(specs[0]['capacity'], float)
+
+    @pytest.mark.parametrize(('hosts', 'message'), [
+        ([{'name': 'builder1'}],
+         'each item in hosts must be a dict with a name and arches'),
+        ([{'name': 'builder1', 'arches': []}] * 2,
+         'host builder1 is listed more than once'),
+        ([{'name': 'builder1', 'arches': [], 'color': 'red'}],
+         'unsupported settings for host builder1: color'),
+        ([{'name': 'builder1', 'arches': [], 'state': 'off'}],
+         'state must be enabled or disabled'),
+        ([{'name': 'builder1', 'arches': {'x86_64': True}}],
+         'host builder1: arches must be a list'),
+        ([{'name': 'builder1', 'arches': [], 'channels': 1}],
+         'host builder1: channels must be a list'),
+        ([{'name': 'builder1', 'arches': [], 'capacity': 'lots'}],
+         'host builder1: capacity must be a number'),
+    ])
+    def test_invalid(self, hosts, message):
+        with pytest.raises(ValueError) as e:
+            koji_hosts.normalize_hosts(hosts)
+        assert str(e.value) == message
+
+
+class TestEnsureHosts(object):
+
+    def test_unchanged(self, session, logins):
+        hosts = [{'name': 'builder1', 'arches': ['x86_64'],
+                  'channels': ['default'], 'krb_principals': []},
+                 {'name': 'builder2', 'arches': ['x86_64']}]
+        result = koji_hosts.ensure_hosts(session, False, hosts)
+        assert result == {'changed': False, 'stdout_lines': []}
+        assert logins == []
+        assert session.requests == [['listChannels', 'getUser']]
+
+    def test_unchanged_capacity(self, session, logins):
+        hosts = [{'name': 'builder1', 'arches': ['x86_64'], 'capacity': '2'},
+                 {'name': 'builder2', 'arches': ['x86_64']}]
+        result = koji_hosts.ensure_hosts(session, False, hosts)
+        assert result == {'changed': False, 'stdout_lines': []}
+        assert logins == []
+
+    def test_changes(self, session, logins):
+        session.disableHost('builder2')
+        hosts = [{'name': 'builder1', 'arches': ['x86_64', 'i686'],
+                  'channels': ['createrepo'], 'comment': 'new disk'},
+                 {'name': 'builder2', 'arches': ['x86_64'],
+                  'krb_principals': ['compile/builder2@EXAMPLE.COM']}]
+        result = koji_hosts.ensure_hosts(session, False, hosts)
+        assert result['changed'] is True
+        assert sorted(result['stdout_lines']) == [
+            'builder1: added host to channel createrepo',
+            'builder1: edited host arches',
+            'builder1: edited host comment',
+            'builder1: removed host from channel default',
+            'builder2: add compile/builder2@EXAMPLE.COM krb principal',
+            'builder2: enabled host',
+        ]
+        assert len(logins) == 1
+        assert session.requests == [
+            ['listChannels', 'getUser'],
+            ['editHost', 'removeHostFromChannel', 'addHostToChannel',
+             'enableHost', 'editUser'],
+        ]
+        assert session.hosts['builder1']['arches'] == 'x86_64 i686'
+        assert session.hosts['builder1']['comment'] == 'new disk'
+        assert session.host_channels['builder1'] == ['createrepo']
+        assert session.hosts['builder2']['enabled'] is True
+        assert session.user_krb_principals[102] == \
+            ['compile/builder2@EXAMPLE.COM']
+
+    def test_check_mode(self, session, logins):
+        hosts = [{'name': 'builder1', 'arches': ['x86_64'],
+                  'state': 'disabled'},
+                 {'name': 'builder3', 'arches': ['x86_64']}]
+        result = koji_hosts.ensure_hosts(session, True, hosts)
+        assert result['changed'] is True
+        assert result['stdout_lines'] == ['builder3: created host',
+                                          'builder1: disabled host']
+        assert logins == []
+        assert session.hosts['builder1']['enabled'] is True
+        assert 'builder3' not in session.hosts
+
+    def test_create(self, session, logins):
+        hosts = [{'name': 'builder3', 'arches': ['x86_64'],
+                  'channels': ['default', 'createrepo'],
+                  'krb_principal': 'compile/builder3@EXAMPLE.COM'}]
+        result = koji_hosts.ensure_hosts(session, False, hosts)
+        assert result['stdout_lines'] == [
+            'builder3: created host',
+            'builder3: added host to channel createrepo',
+        ]
+        assert session.requests == [['addHost'], ['getHost'],
+                                    ['listChannels', 'getUser'],
+                                    ['addHostToChannel']]
+        assert session.host_channels['builder3'] == ['default', 'createrepo']
+
+    def test_batches(self, session, logins, monkeypatch):
+        monkeypatch.setattr(koji_hosts, 'WRITE_BATCH_SIZE', 2)
+        hosts = [{'name': name, 'arches': ['x86_64'], 'state': 'disabled',
+                  'comment': 'maintenance'}
+                 for name in ('builder1', 'builder2')]
+        koji_hosts.ensure_hosts(session, False, hosts)
+        assert session.requests == [['disableHost', 'editHost'],
+                                    ['disableHost', 'editHost']]
+
+
+class TestMain(object):
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(koji_hosts.AnsibleModule,
+                            'exit_json', exit_json)
+        monkeypatch.setattr(koji_hosts.AnsibleModule,
+                            'fail_json', fail_json)
+
+    @pytest.fixture(autouse=True)
+    def fake_session(self, monkeypatch, session, logins):
+        monkeypatch.setattr(koji_hosts.common_koji,
+                            'get_session',
+                            lambda x: session)
+
+    def test_disable(self, session):
+        set_module_args({'hosts': [{'name': 'builder1',
+                                    'arches': ['x86_64'],
+                                    'state': 'disabled'}]})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_hosts.main()
+        result = exit.value.args[0]
+        assert result['changed'] is True
+        assert result['stdout_lines'] == ['builder1: disabled host']
+
+    def test_arches_string(self, session):
+        set_module_args({'hosts': [{'name': 'builder1',
+                                    'arches': 'x86_64,i686'}]})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_hosts.main()
+        result = exit.value.args[0]
+        assert result['stdout_lines'] == ['builder1: edited host arches']
+        assert session.hosts['builder1']['arches'] == 'x86_64 i686'
+
+    def test_invalid(self, session):
+        set_module_args({'hosts': [{'name': 'builder1'}]})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_hosts.main()
+        result = exit.value.args[0]
+        assert result['msg'] == \
+            'each item in hosts must be a dict with a name and arches'
@@ -0,0 +1,162 @@
+import pytest
+import koji_package_owner
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+
+
+class GenericError(Exception):
+    pass
+
+
+class FakeKojiSession(FakeMulticallSession):
+
+    logged_in = True
+
+    def __init__(self):
+        self.users = {'alice': 1, 'bob': 2}
+        # tag name -> package name -> owner name
+        self.tags = {}
+
+    def getUser(self, userInfo=None, strict=False, krb_princs=True):
+        if userInfo in self.users:
+            return {'id': self.users[userInfo], 'name': userInfo}
+        return None
+
+    def tag_id(self, tag_name):
+        return sorted(self.tags).index(tag_name) + 1
+
+    def listPackages(self, userID, with_dups=False):
+        if userID not in self.users:
+            raise GenericError('No such user: %s' % userID)
+        result = []
+        for tag_name, packages in self.tags.items():
+            for package, owner in packages.items():
+                if owner != userID:
+                    continue
+                result.append({'tag_id': self.tag_id(tag_name),
+                               'tag_name': tag_name,
+                               'package_name': package,
+                               'owner_name': owner})
+        return result
+
+    def packageListSetOwner(self, taginfo, pkginfo, owner):
+        tag_name = sorted(self.tags)[taginfo - 1]
+        self.tags[tag_name][pkginfo] = owner
+
+
+@pytest.fixture
+def session():
+    session = FakeKojiSession()
+    session.tags = {
+        'ceph-3.1-rhel-7': {'ceph': 'alice', 'ceph-ansible': 'bob'},
+        'ceph-3.2-rhel-7': {'ceph': 'alice', 'ceph-ansible': 'alice'},
+    }
+    return session
+
+
+class TestTransferOwner(object):
+
+    def test_transfer(self, session):
+        result = koji_package_owner.transfer_owner(session, False, 'alice',
+                                                   'bob')
+        assert result['changed'] is True
+        assert result['transferred'] == 3
+        assert result['tags'] == {'ceph-3.1-rhel-7': 1, 'ceph-3.2-rhel-7': 2}
+        assert result['stdout_lines'] == [
+            'ceph-3.1-rhel-7: set owner bob on 1 packages',
+            'ceph-3.2-rhel-7: set owner bob on 2 packages',
+            'transferred 3 of 3 packages',
+        ]
+        for packages in session.tags.values():
+            assert set(packages.values()) == set(['bob'])
+
+    def test_unchanged(self, session):
+        koji_package_owner.transfer_owner(session, False, 'alice', 'bob')
+        result = koji_package_owner.transfer_owner(session, False, 'alice',
+                                                   'bob')
+        assert result['changed'] is False
+        assert result['transferred'] == 0
+
+    def test_check_mode(self, session):
+        result = koji_package_owner.transfer_owner(session, True, 'alice',
+                                                   'bob')
+        assert result['changed'] is True
+        assert result['transferred'] == 3
+        assert session.tags['ceph-3.2-rhel-7']['ceph'] == 'alice'
+
+    def test_filters(self, session):
+        result = koji_package_owner.transfer_owner(
+            session, False, 'alice', 'bob', tags=['ceph-3.2-rhel-7'],
+            packages=['ceph'])
+        assert result['tags'] == {'ceph-3.2-rhel-7': 1}
+        assert session.tags['ceph-3.1-rhel-7']['ceph'] == 'alice'
+        assert session.tags['ceph-3.2-rhel-7']['ceph'] == 'bob'
+        assert session.tags['ceph-3.2-rhel-7']['ceph-ansible'] == 'alice'
+
+    def test_batches(self, session, monkeypatch):
+        monkeypatch.setattr(koji_package_owner, 'WRITE_BATCH_SIZE', 2)
+        result = koji_package_owner.transfer_owner(session, False, 'alice',
+                                                   'bob')
+        assert session.requests == [
+            ['getUser', 'getUser'],
+            ['packageListSetOwner', 'packageListSetOwner'],
+            ['packageListSetOwner'],
+        ]
+        assert result['stdout_lines'][-2:] == [
+            'transferred 2 of 3 packages',
+            'transferred 3 of 3 packages',
+        ]
+
+    def test_unknown_user(self, session):
+        with pytest.raises(ValueError) as e:
+            koji_package_owner.transfer_owner(session, False, 'alice',
+                                              'carol')
+        assert str(e.value) == 'user carol does not exist'
+
+    def test_unknown_from_owner(self, session):
+        with pytest.raises(ValueError) as e:
+            koji_package_owner.transfer_owner(session, False, 'carol',
+                                              'bob')
+        assert str(e.value) == 'user carol does not exist'
+
+
+class TestMain(object):
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(koji_package_owner.AnsibleModule,
+                            'exit_json', exit_json)
+        monkeypatch.setattr(koji_package_owner.AnsibleModule,
+                            'fail_json', fail_json)
+
+    @pytest.fixture(autouse=True)
+    def fake_session(self, monkeypatch, session):
+        monkeypatch.setattr(koji_package_owner.common_koji,
+                            'get_session',
+                            lambda x: session)
+
+    def test_transfer(self, session):
+        set_module_args({'from_owner': 'alice', 'to_owner': 'bob'})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_package_owner.main()
+        result = exit.value.args[0]
+        assert result['changed'] is True
+        assert result['transferred'] == 3
+
+    def test_unknown_user(self, session):
+        set_module_args({'from_owner': 'alice', 'to_owner': 'carol'})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_package_owner.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'user carol does not exist'
+
+    def test_unknown_from_owner(self, session):
+        set_module_args({'from_owner': 'carol', 'to_owner': 'bob'})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_package_owner.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'user carol does not exist'
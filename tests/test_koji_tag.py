@@ -1,6 +1,13 @@
 import pytest
 import koji_tag
 from collections import defaultdict
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+from utils import apply_query_opts
 
 
 class GenericError(Exception):
@@ -13,12 +20,19 @@ class ParameterError(Exception):
         return str(self.args[0])
 
 
-class FakeKojiSession(object):
+class FakeKojiSession(FakeMulticallSession):
     def __init__(self):
         self.tag_repos = defaultdict(list)
         self.tags = {}
         self.inheritance = {}
         self.groups = []
+        self.event_id = 1000
+        self.history = {}
+        # tag name or ID -> history for queryHistory(tag=...)
+        self.tag_history = {}
+        # history tables that this hub knows, or None for all of them
+        self.history_tables = None
+        self.next_tag_id = 100
 
     def getTag(self, tagInfo, strict=False, event=None):
         if isinstance(tagInfo, int):
@@ -37,11 +51,22 @@ class FakeKojiSession(object):
         if existing:
             raise RuntimeError('tag %s already exists' % name)
         tag = {
-            name: {'id': 100, 'packages': []}
+            name: {'id': self.next_tag_id, 'packages': [],
+                   'arches': arches, 'perm': perm, 'locked': locked,
+                   'maven_support': maven_support,
+                   'maven_include_all': maven_include_all,
+                   'extra': extra or {}}
         }
+        self.next_tag_id += 1
         self.tags.update(tag)
         return tag[name]['id']
 
+    def editTag2(self, tagInfo, **kwargs):
+        tag = self.getTag(tagInfo)
+        for key in kwargs.pop('remove_extra', []):
+            del tag['extra'][key]
+        tag.update(kwargs)
+
     def getTagExternalRepos(self, tag_info=None, repo_info=None, event=None):
         if isinstance(tag_info, int):
             raise NotImplementedError('specify a tag by name')
@@ -82,11 +107,82 @@ class FakeKojiSession(object):
         }
         self.tag_repos[tag_info].append(repo)
 
+    def editTagExternalRepo(self, tag_info, repo_info, priority=None,
+                            merge_mode=None):
+        if isinstance(tag_info, int):
+            raise NotImplementedError('specify a tag by name')
+        if isinstance(repo_info, int):
+            raise NotImplementedError('specify a repo by name')
+        repos = self.tag_repos[tag_info]
+        found = None
+        for i, repo in enumerate(repos):
+            if repo['external_repo_name'] == repo_info:
+                found = i
+        if found is None:
+            raise GenericError('external repo not associated with tag')
+        repo = repos[found].copy()
+        if priority is not None:
+            for other in repos:
+                if other['external_repo_name'] != repo_info and \
+                        other['priority'] == priority:
+                    raise GenericError('priority %d already in use'
+                                       % priority)
+            repo['priority'] = priority
+        if merge_mode is not None:
+            repo['merge_mode'] = merge_mode
+        repos[found] = repo
+
     def getInheritanceData(self, tag, event=None):
+        if isinstance(tag, int):
+            tag = [name for name, info in self.tags.items()
+                   if info['id'] == tag][0]
         if tag not in self.inheritance:
             return []
         return self.inheritance[tag]
 
+    def getFullInheritance(self, tag, event=None, reverse=False):
+        if not reverse:
+            # Every link above this tag. Each entry names the parent tag in
+            # "parent_id" and "name".
+            links = []
+            todo = [(tag, 1)]
+            while todo:
+                child, depth = todo.pop(0)
+                for rule in self.getInheritanceData(child):
+                    links.append({'child_id': self.getTag(child)['id'],
+                                  'parent_id': rule['parent_id'],
+                                  'name': rule['name'],
+                                  'currdepth': depth})
+                    todo.append((rule['name'], depth + 1))
+            return links
+        # Like the hub, return every link below this tag. Each entry names
+        # the child tag in "tag_id" and "name".
+        links = []
+        todo = [(self.getTag(tag)['id'], 1)]
+        while todo:
+            parent_id, depth = todo.pop(0)
+            for child, rules in sorted(self.inheritance.items()):
+                for rule in rules:
+                    if rule['parent_id'] != parent_id:
+                        continue
+                    child_id = self.getTag(child)['id']
+                    links.append({'tag_id': child_id,
+                                  'parent_id': parent_id,
+                                  'name': child,
+                                  'currdepth': depth})
+                    todo.append((child_id, depth + 1))
+        return links
+
+    def getBuildTargets(self, info=None, event=None, buildTagID=None,
+                        destTagID=None, queryOpts=None):
+        return getattr(self, 'targets', [])
+
+    def deleteTag(self, tagInfo):
+        tag = self.getTag(tagInfo)
+        name = [name for name, info in self.tags.items() if info is tag][0]
+        del self.tags[name]
+        self.inheritance.pop(name, None)
+
     def removeExternalRepoFromTag(self, tag_info, repo_info):
         if isinstance(tag_info, int):
             raise NotImplementedError('specify a tag by name')
@@ -106,16 +202,30 @@ class FakeKojiSession(object):
             raise NotImplementedError()
         self.inheritance[tag] = data
 
-    def listPackages(self, tagID, with_owners=True):
+    def listPackages(self, tagID, with_owners=True, inherited=False,
+                     queryOpts=None, event=None):
         tag = self.getTag(tagID)
-        return tag['packages']
+        packages = list(tag['packages'])
+        if inherited:
+            seen = set(package['package_name'] for package in packages)
+            name = [n for n, t in self.tags.items() if t is tag][0]
+            rules = sorted(self.getInheritanceData(name),
+                           key=lambda rule: rule['priority'])
+            for rule in rules:
+                for package in self.listPackages(rule['name'],
+                                                 inherited=True):
+                    if package['package_name'] not in seen:
+                        seen.add(package['package_name'])
+                        packages.append(package)
+        return apply_query_opts(packages, queryOpts)
 
     def packageListAdd(self, taginfo, pkginfo, owner):
         tag = self.getTag(taginfo)
         package = {'package_id': '0',
                    'package_name': pkginfo,
                    'owner_name': owner,
-                   'blocked': False}
+                   'blocked': False,
+                   'tag_id': tag['id']}
         tag['packages'].append(package)
 
     def groupListAdd(self, tagID, group_name, block=False,
@@ -170,15 +280,23 @@ class FakeKojiSession(object):
         if isinstance(tagID, int):
             groups = self.getTagGroups(tagID)
             for group in groups:
-                if (
-                    group['name'] == group_name
-                    and pkg_name in group['packagelist']
-                ):
-                    group['packagelist'].remove(pkg_name)
-                    break
+                if group['name'] != group_name:
+                    continue
+                for entry in group['packagelist']:
+                    if entry == pkg_name or \
+                            (isinstance(entry, dict)
+                             and entry['package'] == pkg_name):
+                        group['packagelist'].remove(entry)
+                        break
         else:
             raise NotImplementedError('specify a tag by id')
 
+    def packageListSetOwner(self, taginfo, pkginfo, owner, force=False):
+        tag = self.getTag(taginfo)
+        for package in tag['packages']:
+            if package['package_name'] == pkginfo:
+                package['owner_name'] = owner
+
     def packageListRemove(self, taginfo, pkginfo):
         tag = self.getTag(taginfo)
         found = None
@@ -194,6 +312,12 @@ class FakeKojiSession(object):
         for package in tag['packages']:
             if package['package_name'] == pkginfo:
                 package['blocked'] = True
+                return
+        tag['packages'].append({'package_id': '0',
+                                'package_name': pkginfo,
+                                'owner_name': None,
+                                'blocked': True,
+                                'tag_id': tag['id']})
 
     def packageListUnblock(self, taginfo, pkginfo, force=False):
         tag = self.getTag(taginfo)
@@ -201,6 +325,36 @@ class FakeKojiSession(object):
             if package['package_name'] == pkginfo:
                 package['blocked'] = False
 
+    def getLastEvent(self, before=None):
+        return {'id': self.event_id, 'ts': 1600000000.0}
+
+    def queryHistory(self, tables=None, tag=None, **kwargs):
+        if tables == ['tag_inheritance'] and kwargs.get('active'):
+            # Every active link on the hub.
+            rows = []
+            for child, rules in sorted(self.inheritance.items()):
+                for rule in rules:
+                    rows.append({'tag_id': self.getTag(child)['id'],
+                                 'tag.name': child,
+                                 'parent_id': rule['parent_id'],
+                                 'parent.name': rule['name'],
+                                 'priority': rule['priority'],
+                                 'maxdepth': rule.get('maxdepth'),
+                                 'intransitive': rule.get('intransitive',
+                                                          False),
+                                 'noconfig': rule.get('noconfig', False),
+                                 'pkg_filter': rule.get('pkg_filter', '')})
+            return {'tag_inheritance': rows}
+        if self.history_tables is not None:
+            for table in tables or ():
+                if table not in self.history_tables:
+                    raise GenericError('No such history table: %s' % table)
+        history = self.tag_history.get(tag, self.history)
+        if tables is None:
+            return history
+        return dict((table, entries) for table, entries in history.items()
+                    if table in tables)
+
     def ensure_logged_in(self, session):
         return session
 
@@ -213,6 +367,12 @@ def session():
     return FakeKojiSession()
 
 
+@pytest.fixture(autouse=True)
+def expire_method_cache():
+    # Reset the hub method cache after every run.
+    koji_tag.common_koji.method_cache = set()
+
+
 class TestValidateRepos(object):
 
     def test_simple(self):
@@ -240,33 +400,6 @@ class TestValidateRepos(object):
             koji_tag.validate_repos(repos)
 
 
-class TestAddExternalRepos(object):
-
-    def test_simple(self, session):
-        tag_name = 'my-centos-7'
-        repos_to_add = [{'repo_info': 'centos-7-cr', 'priority': 10}]
-        koji_tag.add_external_repos(session, tag_name, repos_to_add)
-
-    def test_merge_mode(self, session):
-        tag_name = 'my-centos-7'
-        repos_to_add = [{'repo_info': 'centos-7-cr',
-                         'priority': 10},
-                        {'repo_info': 'epel-7',
-                         'priority': 20,
-                         'merge_mode': 'simple'}]
-        koji_tag.add_external_repos(session, tag_name, repos_to_add)
-
-
-class TestRemoveExternalRepos(object):
-
-    def test_simple(self, session):
-        tag_name = 'my-centos-7'
-        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 10)
-        session.addExternalRepoToTag(tag_name, 'epel-7', 20)
-        repos_to_remove = ['centos-7-cr', 'epel-7']
-        koji_tag.remove_external_repos(session, tag_name, repos_to_remove)
-
-
 class TestEnsureExternalRepos(object):
 
     @pytest.fixture
@@ -369,8 +502,8 @@ class TestEnsureExternalRepos(object):
         expected = {
             'changed': True,
             'stdout_lines': [
-                'Removing centos-7-cr repo at priority 9 from tag my-centos-7',
-                'Adding centos-7-cr repo with prio 20 to tag my-centos-7'
+                'Changing centos-7-cr repo priority from 9 to 20 on tag '
+                'my-centos-7',
             ],
             'diff': {
                 'before': {
@@ -452,6 +585,108 @@ class TestEnsureExternalRepos(object):
         ]
         assert result_repos == expected_repos
 
+    def test_edit_merge_mode_in_place(self, session, tag_name):
+        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 10)
+        check_mode = False
+        repos = [{'repo': 'centos-7-cr', 'priority': 10, 'merge_mode': 'bare'}]
+        result = koji_tag.ensure_external_repos(
+            session, tag_name, check_mode, repos)
+        assert result['stdout_lines'] == [
+            'Changing centos-7-cr repo merge mode from "koji" to "bare" on '
+            'tag my-centos-7',
+        ]
+        result_repos = session.getTagExternalRepos(tag_name)
+        expected_repos = [
+            {'tag_name': 'my-centos-7',
+             'external_repo_name': 'centos-7-cr',
+             'merge_mode': 'bare',
+             'priority': 10},
+        ]
+        assert result_repos == expected_repos
+
+    def test_swap_priorities(self, session, tag_name):
+        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 10)
+        session.addExternalRepoToTag(tag_name, 'epel-7', 20)
+        check_mode = False
+        repos = [{'repo': 'centos-7-cr', 'priority': 20},
+                 {'repo': 'epel-7', 'priority': 10}]
+        result = koji_tag.ensure_external_repos(
+            session, tag_name, check_mode, repos)
+        # These priorities collide, so we cannot edit them in place.
+        assert result['stdout_lines'] == [
+            'Removing centos-7-cr repo at priority 10 from tag my-centos-7',
+            'Removing epel-7 repo at priority 20 from tag my-centos-7',
+            'Adding centos-7-cr repo with prio 20 to tag my-centos-7',
+            'Adding epel-7 repo with prio 10 to tag my-centos-7',
+        ]
+        result_repos = session.getTagExternalRepos(tag_name)
+        expected_repos = [
+            {'tag_name': 'my-centos-7',
+             'external_repo_name': 'epel-7',
+             'merge_mode': 'koji',
+             'priority': 10},
+            {'tag_name': 'my-centos-7',
+             'external_repo_name': 'centos-7-cr',
+             'merge_mode': 'koji',
+             'priority': 20},
+        ]
+        assert result_repos == expected_repos
+
+    def test_edit_priority_into_removed_slot(self, session, tag_name):
+        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 10)
+        session.addExternalRepoToTag(tag_name, 'epel-7', 20)
+        check_mode = False
+        repos = [{'repo': 'centos-7-cr', 'priority': 20}]
+        result = koji_tag.ensure_external_repos(
+            session, tag_name, check_mode, repos)
+        assert result['stdout_lines'] == [
+            'Removing epel-7 repo from tag my-centos-7',
+            'Changing centos-7-cr repo priority from 10 to 20 on tag '
+            'my-centos-7',
+        ]
+        result_repos = session.getTagExternalRepos(tag_name)
+        expected_repos = [
+            {'tag_name': 'my-centos-7',
+             'external_repo_name': 'centos-7-cr',
+             'merge_mode': 'koji',
+             'priority': 20},
+        ]
+        assert result_repos == expected_repos
+
+    def test_check_mode(self, session, tag_name):
+        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 9)
+        check_mode = True
+        repos = [{'repo': 'centos-7-cr', 'priority': 20}]
+        result = koji_tag.ensure_external_repos(
+            session, tag_name, check_mode, repos)
+        assert result['changed'] is True
+        result_repos = session.getTagExternalRepos(tag_name)
+        assert result_repos[0]['priority'] == 9
+
+
+class TestEnsureExternalReposOldHub(object):
+    """ Koji Hubs without the editTagExternalRepo RPC """
+
+    @pytest.fixture
+    def session(self, session, monkeypatch):
+        monkeypatch.delattr(FakeKojiSession, 'editTagExternalRepo')
+        return session
+
+    def test_edit_priority(self, session):
+        tag_name = 'my-centos-7'
+        session.addExternalRepoToTag(tag_name, 'centos-7-cr', 9)
+        check_mode = False
+        repos = [{'repo': 'centos-7-cr', 'priority': 20}]
+        result = koji_tag.ensure_external_repos(
+            session, tag_name, check_mode, repos)
+        assert result['stdout_lines'] == [
+            'Removing centos-7-cr repo at priority 9 from tag my-centos-7',
+            'Adding centos-7-cr repo with prio 20 to tag my-centos-7'
+        ]
+        result_repos = session.getTagExternalRepos(tag_name)
+        assert len(result_repos) == 1
+        assert result_repos[0]['priority'] == 20
+
 
 class TestEnsureInheritance(object):
 
@@ -640,12 +875,13 @@ class TestEnsurePackageBlocks(object):
 class TestEnsurePackageBlocksOldHub(TestEnsurePackageBlocks):
     @pytest.fixture
     def session(self, session, monkeypatch):
-        def oldListPackages(tagID, with_owners=None):
+        def oldListPackages(tagID, with_owners=None, queryOpts=None,
+                            event=None):
             if with_owners is not None:
                 raise ParameterError(
                     "unexpected keyword argument 'with_owners'")
             tag = session.getTag(tagID)
-            return tag['packages']
+            return apply_query_opts(tag['packages'], queryOpts)
         monkeypatch.setattr(session, 'listPackages', oldListPackages)
         return session
 
@@ -737,6 +973,58 @@ class TestEnsureGroups(object):
         }
         assert result == expected
 
+    def test_ensure_groups_packages(self, session):
+        check_mode = False
+        session.createTag('rhel-8-cnv-2.4')
+        session.groups = [
+            {'tag_id': 100, 'name': 'build', 'packagelist': [
+                {'package': 'bash', 'tag_id': 100},
+                {'package': 'rpm-build', 'tag_id': 100},
+                {'package': 'sed', 'tag_id': 1},
+            ]},
+        ]
+        desired_groups = {'build': ['bash', 'gcc']}
+        result = koji_tag.ensure_groups(session,
+                                        100,
+                                        check_mode,
+                                        desired_groups)
+        # We do not remove the inherited "sed" package.
+        assert result['stdout_lines'] == [
+            'removed pkg rpm-build from group build',
+            'added pkg gcc to group build',
+        ]
+        packagelist = session.groups[0]['packagelist']
+        assert {'package': 'rpm-build', 'tag_id': 100} not in packagelist
+        assert 'gcc' in packagelist
+
+    def test_ensure_groups_unchanged(self, session):
+        check_mode = False
+        session.createTag('rhel-8-cnv-2.4')
+        session.groups = [
+            {'tag_id': 100, 'name': 'build', 'packagelist': [
+                {'package': 'bash', 'tag_id': 100},
+                {'package': 'sed', 'tag_id': 1},
+            ]},
+        ]
+        desired_groups = {'build': ['bash', 'sed']}
+        result = koji_tag.ensure_groups(session,
+                                        100,
+                                        check_mode,
+                                        desired_groups)
+        assert result == {'changed': False, 'stdout_lines': []}
+
+    @pytest.mark.parametrize('inherit', (True, False))
+    def test_ensure_groups_inherit(self, session, monkeypatch, inherit):
+        session.createTag('rhel-8-cnv-2.4')
+        calls = []
+
+        def getTagGroups(tagID, inherit=True):
+            calls.append(inherit)
+            return []
+        monkeypatch.setattr(session, 'getTagGroups', getTagGroups)
+        koji_tag.ensure_groups(session, 100, True, {}, inherit)
+        assert calls == [inherit]
+
 
 class TestEnsurePackages(object):
     @pytest.mark.parametrize('check_mode', (False, True))
@@ -768,6 +1056,20 @@ class TestEnsurePackages(object):
         }
         assert result == expected
 
+    def test_keep_blocked(self, session):
+        tag_id = 1
+        tag_name = 'ceph-5.0-rhel-8'
+        session.tags = {'ceph-5.0-rhel-8': {'id': tag_id, 'packages': []}}
+        session.packageListAdd('ceph-5.0-rhel-8', 'ceph', 'kdreyer')
+        session.packageListAdd('ceph-5.0-rhel-8', 'bash', 'kdreyer')
+        session.packageListBlock(tag_id, 'bash')
+        packages = {'kdreyer': ['ceph']}
+        result = koji_tag.ensure_packages(
+            session, tag_name, tag_id, False, packages, ['bash'])
+        assert result == {'changed': False, 'stdout_lines': []}
+        pkgs = session.listPackages(tag_id)
+        assert set(pkg['package_name'] for pkg in pkgs) == {'ceph', 'bash'}
+
 
 class TestEnsureTag(object):
     @pytest.fixture
@@ -858,3 +1160,769 @@ class TestEnsureTag(object):
             }
         }
         assert result == expected
+
+    def test_one_package_read(self, session, monkeypatch):
+        session.tags['ceph-5.0-rhel-8'] = {'id': 3, 'packages': []}
+        session.packageListAdd('ceph-5.0-rhel-8', 'ceph', 'kdreyer')
+        session.packageListAdd('ceph-5.0-rhel-8', 'bash', 'kdreyer')
+        reads = []
+        listPackages = session.listPackages
+
+        def counting_listPackages(*args, **kwargs):
+            reads.append(kwargs)
+            return listPackages(*args, **kwargs)
+        monkeypatch.setattr(session, 'listPackages', counting_listPackages)
+        result = koji_tag.ensure_tag(
+            session, 'ceph-5.0-rhel-8', False, inheritance=None,
+            external_repos=None, packages={'hongliu': ['ceph', 'rpm-build']},
+            groups=None, blocked_packages=['rpm-build'])
+        assert result['stdout_lines'] == [
+            'set ceph owner hongliu',
+            'added pkg rpm-build',
+            'remove pkg bash',
+            'blocked pkg rpm-build',
+        ]
+        assert len(reads) == 1
+        assert session.requests == [['packageListSetOwner', 'packageListAdd',
+                                     'packageListRemove', 'packageListBlock']]
+
+
+class TestEnsureTagFingerprint(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session.tags = {'my-centos-7-parent': {'id': 1}}
+        return session
+
+    @pytest.fixture
+    def fingerprint_file(self, tmpdir):
+        return str(tmpdir.join('fingerprints.json'))
+
+    @pytest.fixture
+    def settings(self):
+        return dict(inheritance=[{'parent': 'my-centos-7-parent',
+                                  'priority': 0}],
+                    external_repos=None,
+                    packages={'kdreyer': ['ceph', 'ansible']},
+                    groups=None,
+                    blocked_packages=None)
+
+    def ensure(self, session, fingerprint_file, settings, check_mode=False):
+        return koji_tag.ensure_tag_fingerprint(
+            session, 'testkoji', 'ceph-5.0-rhel-8', check_mode,
+            fingerprint_file, **settings)
+
+    def test_fingerprint_normalized(self, settings):
+        first = koji_tag.get_fingerprint('ceph-5.0-rhel-8', **settings)
+        settings['packages'] = {'kdreyer': ['ansible', 'ceph']}
+        second = koji_tag.get_fingerprint('ceph-5.0-rhel-8', **settings)
+        assert first == second
+        settings['packages'] = {'kdreyer': ['ansible']}
+        third = koji_tag.get_fingerprint('ceph-5.0-rhel-8', **settings)
+        assert first != third
+
+    def test_first_run(self, session, fingerprint_file, settings):
+        result = self.ensure(session, fingerprint_file, settings)
+        assert result['changed'] is True
+        assert 'ceph-5.0-rhel-8' in session.tags
+        state = koji_tag.common_koji.load_state(fingerprint_file)
+        saved = state['testkoji']['ceph-5.0-rhel-8']
+        assert saved['event_id'] == 1000
+
+    def test_unchanged(self, session, fingerprint_file, settings,
+                       monkeypatch):
+        self.ensure(session, fingerprint_file, settings)
+        session.event_id = 1010
+        monkeypatch.setattr(session, 'getTag', None)
+        result = self.ensure(session, fingerprint_file, settings)
+        assert result == {
+            'changed': False,
+            'stdout_lines': ['tag ceph-5.0-rhel-8 unchanged since event 1000'],
+        }
+
+    def test_tag_listing_history(self, session, fingerprint_file, settings,
+                                 monkeypatch):
+        self.ensure(session, fingerprint_file, settings)
+        session.history = {'tag_listing': [{'build_id': 1}]}
+        monkeypatch.setattr(session, 'getTag', None)
+        result = self.ensure(session, fingerprint_file, settings)
+        assert result['changed'] is False
+
+    def test_history_tables(self, session, monkeypatch):
+        queries = []
+        query_history = session.queryHistory
+
+        def recording_query_history(**kwargs):
+            queries.append(kwargs['tables'])
+            return query_history(**kwargs)
+        monkeypatch.setattr(session, 'queryHistory', recording_query_history)
+        koji_tag.tag_changed_since(session, 'ceph-5.0-rhel-8', 1000)
+        assert 'tag_listing' not in queries[0]
+        assert 'tag_config' in queries[0]
+        assert 'tag_package_owners' in queries[0]
+
+    def test_old_hub_history_tables(self, session):
+        session.history_tables = koji_tag.CONFIG_HISTORY_TABLES
+        session.history = {'tag_packages': [{'package.name': 'ceph'}]}
+        assert koji_tag.tag_changed_since(session, 'ceph-5.0-rhel-8', 1000)
+        session.history = {'tag_listing': [{'build_id': 1}]}
+        assert not koji_tag.tag_changed_since(session, 'ceph-5.0-rhel-8',
+                                              1000)
+
+    def test_changed_history(self, session, fingerprint_file, settings):
+        self.ensure(session, fingerprint_file, settings)
+        session.event_id = 1010
+        session.history = {'tag_packages': [{'package.name': 'ceph'}]}
+        session.packageListRemove('ceph-5.0-rhel-8', 'ceph')
+        result = self.ensure(session, fingerprint_file, settings)
+        assert result['changed'] is True
+        assert result['stdout_lines'] == ['added pkg ceph']
+        state = koji_tag.common_koji.load_state(fingerprint_file)
+        saved = state['testkoji']['ceph-5.0-rhel-8']
+        assert saved['event_id'] == 1010
+
+    def test_changed_settings(self, session, fingerprint_file, settings):
+        self.ensure(session, fingerprint_file, settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        result = self.ensure(session, fingerprint_file, settings)
+        assert result['changed'] is True
+        assert result['stdout_lines'] == ['added pkg rpm-build']
+
+    def test_check_mode(self, session, fingerprint_file, settings):
+        self.ensure(session, fingerprint_file, settings, check_mode=True)
+        assert koji_tag.common_koji.load_state(fingerprint_file) == {}
+
+    def test_parent_history_ignored(self, session, fingerprint_file,
+                                    settings, monkeypatch):
+        self.ensure(session, fingerprint_file, settings)
+        session.tag_history = {1: {'tag_packages': [{'package.name': 'ceph'}]}}
+        monkeypatch.setattr(session, 'getTag', None)
+        del session.requests[:]
+        result = self.ensure(session, fingerprint_file, settings)
+        # Without prune_inherited, parents' packages do not matter.
+        assert result['changed'] is False
+        assert session.requests == [['queryHistory']]
+
+    def test_parent_history(self, session, fingerprint_file, settings):
+        session.tags['my-centos-7-parent']['packages'] = []
+        settings['prune_inherited'] = True
+        self.ensure(session, fingerprint_file, settings)
+        session.packageListAdd('my-centos-7-parent', 'ceph', 'kdreyer')
+        session.tag_history = {1: {'tag_packages': [{'package.name': 'ceph'}]}}
+        del session.requests[:]
+        result = self.ensure(session, fingerprint_file, settings)
+        # The parent now offers ceph, so the tag no longer needs it.
+        assert 'remove pkg ceph' in result['stdout_lines']
+        assert session.requests[0] == ['queryHistory', 'queryHistory']
+
+
+class TestEnsureTagPruneInherited(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session.tags = {'my-centos-7-parent': {'id': 1, 'packages': []}}
+        session.packageListAdd('my-centos-7-parent', 'ceph', 'kdreyer')
+        session.packageListAdd('my-centos-7-parent', 'bash', 'kdreyer')
+        session.packageListAdd('my-centos-7-parent', 'python', 'kdreyer')
+        return session
+
+    @pytest.fixture
+    def settings(self):
+        return dict(inheritance=[{'parent': 'my-centos-7-parent',
+                                  'priority': 0}],
+                    external_repos=None,
+                    packages={'kdreyer': ['ceph', 'rpm-build'],
+                              'hongliu': ['bash']},
+                    groups=None,
+                    blocked_packages=['python', 'ansible'],
+                    prune_inherited=True)
+
+    def package_entries(self, session, name):
+        tag_id = session.tags[name]['id']
+        return sorted((pkg['package_name'], pkg['owner_name'], pkg['blocked'])
+                      for pkg in session.listPackages(tag_id))
+
+    def test_create(self, session, settings):
+        result = koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False,
+                                     **settings)
+        assert 'skipped 1 packages inherited from parents' \
+            in result['stdout_lines']
+        assert 'skipped 1 blocks of packages that no parent offers' \
+            in result['stdout_lines']
+        assert result['avoided_rows'] == 2
+        assert self.package_entries(session, 'ceph-5.0-rhel-8') == [
+            ('bash', 'hongliu', False),
+            ('python', None, True),
+            ('rpm-build', 'kdreyer', False),
+        ]
+
+    def test_prune_existing(self, session, settings):
+        settings['prune_inherited'] = False
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['prune_inherited'] = True
+        result = koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False,
+                                     **settings)
+        assert 'remove pkg ceph' in result['stdout_lines']
+        assert 'remove pkg ansible' in result['stdout_lines']
+        assert [entry[0] for entry in
+                self.package_entries(session, 'ceph-5.0-rhel-8')] \
+            == ['bash', 'python', 'rpm-build']
+
+    @pytest.fixture
+    def grandparents(self, session):
+        # The parent inherits ceph from a base tag, and rpm-build through
+        # an intransitive link.
+        session.tags['my-centos-7-parent']['packages'] = []
+        session.tags['my-centos-7-base'] = {'id': 2, 'packages': []}
+        session.tags['my-centos-7-extras'] = {'id': 3, 'packages': []}
+        session.packageListAdd('my-centos-7-base', 'ceph', 'kdreyer')
+        session.packageListAdd('my-centos-7-extras', 'rpm-build', 'kdreyer')
+        session.inheritance['my-centos-7-parent'] = [
+            {'parent_id': 2, 'name': 'my-centos-7-base', 'priority': 0,
+             'maxdepth': None, 'intransitive': False, 'pkg_filter': ''},
+            {'parent_id': 3, 'name': 'my-centos-7-extras', 'priority': 10,
+             'maxdepth': None, 'intransitive': True, 'pkg_filter': ''},
+        ]
+        return session
+
+    def test_maxdepth(self, grandparents, settings):
+        session = grandparents
+        settings['inheritance'][0]['maxdepth'] = 0
+        settings['blocked_packages'] = None
+        result = koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False,
+                                     **settings)
+        assert result['avoided_rows'] == 0
+        assert ('ceph', 'kdreyer', False) in \
+            self.package_entries(session, 'ceph-5.0-rhel-8')
+
+    def test_intransitive(self, grandparents, settings):
+        session = grandparents
+        settings['blocked_packages'] = None
+        result = koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False,
+                                     **settings)
+        # The child inherits ceph from the base tag, but not rpm-build.
+        assert result['avoided_rows'] == 1
+        assert self.package_entries(session, 'ceph-5.0-rhel-8') == [
+            ('bash', 'hongliu', False),
+            ('rpm-build', 'kdreyer', False),
+        ]
+
+    def test_remove_unneeded_blocks(self, session, settings):
+        settings['packages'] = None
+        settings['prune_inherited'] = False
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['prune_inherited'] = True
+        result = koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False,
+                                     **settings)
+        # No parent offers ansible, so we remove the block instead of
+        # unblocking it, which would list ansible on the tag.
+        assert 'remove pkg ansible' in result['stdout_lines']
+        assert self.package_entries(session, 'ceph-5.0-rhel-8') == [
+            ('python', None, True),
+        ]
+
+
+class TestTagPlan(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session.tags = {'my-centos-7-parent': {'id': 1}}
+        return session
+
+    @pytest.fixture
+    def plan_file(self, tmpdir):
+        return str(tmpdir.join('plans.json'))
+
+    @pytest.fixture
+    def settings(self):
+        return dict(inheritance=[{'parent': 'my-centos-7-parent',
+                                  'priority': 0}],
+                    external_repos=None,
+                    packages={'kdreyer': ['ceph']},
+                    groups=None,
+                    blocked_packages=None)
+
+    def plan(self, session, plan_file, settings):
+        return koji_tag.plan_tag(session, 'testkoji', 'ceph-5.0-rhel-8',
+                                 plan_file, **settings)
+
+    def apply(self, session, plan_file, settings, check_mode=False):
+        return koji_tag.apply_tag_plan(session, 'testkoji', 'ceph-5.0-rhel-8',
+                                       check_mode, plan_file, **settings)
+
+    def get_plan(self, plan_file):
+        state = koji_tag.common_koji.load_state(plan_file)
+        return state.get('testkoji', {}).get('ceph-5.0-rhel-8')
+
+    def package_names(self, session):
+        tag_id = session.tags['ceph-5.0-rhel-8']['id']
+        return sorted(pkg['package_name']
+                      for pkg in session.listPackages(tag_id))
+
+    def test_plan_new_tag(self, session, plan_file, settings):
+        result = self.plan(session, plan_file, settings)
+        assert result['stdout_lines'] == ['would create tag ceph-5.0-rhel-8']
+        assert 'ceph-5.0-rhel-8' not in session.tags
+        plan = self.get_plan(plan_file)
+        assert plan['create'] is True
+        assert plan['calls'] == []
+        assert plan['event_id'] == 1000
+
+    def test_apply_new_tag(self, session, plan_file, settings):
+        self.plan(session, plan_file, settings)
+        result = self.apply(session, plan_file, settings)
+        assert result['changed'] is True
+        assert self.package_names(session) == ['ceph']
+        assert self.get_plan(plan_file) is None
+
+    def test_plan_existing_tag(self, session, plan_file, settings):
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        result = self.plan(session, plan_file, settings)
+        assert result['stdout_lines'] == ['added pkg rpm-build']
+        assert self.package_names(session) == ['ceph']
+        plan = self.get_plan(plan_file)
+        assert plan['create'] is False
+        assert plan['calls'] == [
+            ['packageListAdd', ['ceph-5.0-rhel-8', 'rpm-build', 'kdreyer'],
+             {}],
+        ]
+
+    def test_apply_existing_tag(self, session, plan_file, settings,
+                                monkeypatch):
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        self.plan(session, plan_file, settings)
+        # Applying the plan must not read the package list again.
+        monkeypatch.setattr(session, 'listPackages', None)
+        result = self.apply(session, plan_file, settings)
+        assert result == {'changed': True,
+                          'stdout_lines': ['added pkg rpm-build']}
+        monkeypatch.undo()
+        assert self.package_names(session) == ['ceph', 'rpm-build']
+        assert self.get_plan(plan_file) is None
+
+    def test_apply_check_mode(self, session, plan_file, settings):
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        self.plan(session, plan_file, settings)
+        result = self.apply(session, plan_file, settings, check_mode=True)
+        assert result['changed'] is True
+        assert self.package_names(session) == ['ceph']
+        assert self.get_plan(plan_file) is not None
+
+    def test_apply_changed_history(self, session, plan_file, settings):
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        self.plan(session, plan_file, settings)
+        session.history = {'tag_packages': [{'package.name': 'ceph'}]}
+        with pytest.raises(koji_tag.PlanError) as e:
+            self.apply(session, plan_file, settings)
+        assert str(e.value) == 'tag ceph-5.0-rhel-8 changed after event 1000'
+        assert self.package_names(session) == ['ceph']
+
+    def test_apply_changed_parent(self, session, plan_file, settings):
+        session.tags['my-centos-7-parent']['packages'] = []
+        settings['prune_inherited'] = True
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        self.plan(session, plan_file, settings)
+        # The parent now offers rpm-build, so the plan is stale.
+        session.tag_history = {1: {'tag_packages': [
+            {'package.name': 'rpm-build'}]}}
+        with pytest.raises(koji_tag.PlanError) as e:
+            self.apply(session, plan_file, settings)
+        assert str(e.value) == \
+            'tag ceph-5.0-rhel-8 or its parents changed after event 1000'
+
+    def test_plan_missing_parent(self, session, plan_file, settings):
+        koji_tag.ensure_tag(session, 'ceph-5.0-rhel-8', False, **settings)
+        self.plan(session, plan_file, settings)
+        settings['inheritance'] = [{'parent': 'no-such-parent',
+                                    'priority': 0}]
+        result = self.plan(session, plan_file, settings)
+        assert "parent tag 'no-such-parent' not found" in \
+            result['stdout_lines']
+        assert self.get_plan(plan_file) is None
+
+    def test_apply_created_tag(self, session, plan_file, settings):
+        self.plan(session, plan_file, settings)
+        session.createTag('ceph-5.0-rhel-8')
+        with pytest.raises(koji_tag.PlanError) as e:
+            self.apply(session, plan_file, settings)
+        expected = 'tag ceph-5.0-rhel-8 was created after event 1000'
+        assert str(e.value) == expected
+
+    def test_apply_changed_settings(self, session, plan_file, settings):
+        self.plan(session, plan_file, settings)
+        settings['packages']['kdreyer'].append('rpm-build')
+        with pytest.raises(koji_tag.PlanError) as e:
+            self.apply(session, plan_file, settings)
+        assert 'differ from the plan' in str(e.value)
+
+    def test_apply_no_plan(self, session, plan_file, settings):
+        with pytest.raises(koji_tag.PlanError) as e:
+            self.apply(session, plan_file, settings)
+        assert str(e.value).startswith('no plan for tag ceph-5.0-rhel-8')
+
+
+class TestEnsureTags(object):
+
+    @pytest.fixture
+    def tags(self):
+        return [
+            {'name': 'foo-el7-candidate',
+             'inheritance': [{'parent': 'foo-el7', 'priority': 0}]},
+            {'name': 'foo-el7-build',
+             'inheritance': [{'parent': 'foo-el7', 'priority': 0},
+                             {'parent': 'centos-7', 'priority': 10}]},
+            {'name': 'foo-el7', 'arches': 'x86_64'},
+        ]
+
+    @pytest.fixture
+    def session(self, session, monkeypatch):
+        session.tags = {'centos-7': {'id': 1, 'packages': []}}
+        monkeypatch.setattr(koji_tag.common_koji, 'get_session',
+                            lambda profile: session)
+        return session
+
+    def test_waves(self, tags):
+        waves = koji_tag.get_tag_waves(koji_tag.normalize_tags(tags))
+        assert waves == [['foo-el7'], ['foo-el7-build', 'foo-el7-candidate']]
+
+    def test_cycle(self, tags):
+        tags[2]['inheritance'] = [{'parent': 'foo-el7-build', 'priority': 0}]
+        with pytest.raises(ValueError) as e:
+            koji_tag.get_tag_waves(koji_tag.normalize_tags(tags))
+        assert str(e.value) == ('inheritance cycle among tags: foo-el7, '
+                                'foo-el7-build, foo-el7-candidate')
+
+    def test_unknown_setting(self, tags):
+        tags[0]['parnet'] = 'foo-el7'
+        with pytest.raises(ValueError) as e:
+            koji_tag.normalize_tags(tags)
+        assert 'parnet' in str(e.value)
+
+    def test_duplicate_name(self, tags):
+        tags.append({'name': 'foo-el7'})
+        with pytest.raises(ValueError):
+            koji_tag.normalize_tags(tags)
+
+    def test_setting_types(self, tags):
+        tags[2].update(locked='yes', blocked_packages='bash,python',
+                       perm=1)
+        settings = koji_tag.normalize_tags(tags)['foo-el7']
+        assert settings['locked'] is True
+        assert settings['blocked_packages'] == ['bash', 'python']
+        assert settings['perm'] == '1'
+
+    @pytest.mark.parametrize(('key', 'value', 'message'), [
+        ('locked', 'maybe', 'tag foo-el7: locked must be a bool'),
+        ('extra', 'mock.package_manager', 'tag foo-el7: extra must be a dict'),
+        ('arches', ['x86_64'], 'tag foo-el7: arches must be a str'),
+    ])
+    def test_invalid_setting_type(self, tags, key, value, message):
+        tags[2][key] = value
+        with pytest.raises(ValueError) as e:
+            koji_tag.normalize_tags(tags)
+        assert str(e.value) == message
+
+    def test_main_single_tag_option(self, session, tags, monkeypatch):
+        monkeypatch.setattr(koji_tag.AnsibleModule, 'fail_json', fail_json)
+        set_module_args({'tags': tags, 'packages': {'kdreyer': ['ceph']}})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_tag.main()
+        result = exit.value.args[0]
+        assert result['msg'] == \
+            'parameters are mutually exclusive: tags|packages'
+        assert session.tags == {'centos-7': {'id': 1, 'packages': []}}
+
+    def test_main_setting_types(self, session, tags, monkeypatch):
+        monkeypatch.setattr(koji_tag.AnsibleModule, 'exit_json', exit_json)
+        tags[2]['locked'] = 'yes'
+        set_module_args({'tags': tags, 'koji': 'koji'})
+        with pytest.raises(AnsibleExitJson):
+            koji_tag.main()
+        assert session.tags['foo-el7']['locked'] is True
+
+    def test_ensure_tags(self, session, tags):
+        result = koji_tag.ensure_tags('koji', False, tags, 1)
+        assert result['changed'] is True
+        assert result['waves'] == [['foo-el7'],
+                                   ['foo-el7-build', 'foo-el7-candidate']]
+        assert result['stdout_lines'][0] == 'foo-el7: created tag id 100'
+        parent_id = session.tags['foo-el7']['id']
+        rules = session.getInheritanceData('foo-el7-build')
+        assert [rule['parent_id'] for rule in rules] == [parent_id, 1]
+        assert len(result['diff']) == 3
+
+    def test_ensure_tags_unchanged(self, session, tags):
+        koji_tag.ensure_tags('koji', False, tags, 1)
+        result = koji_tag.ensure_tags('koji', False, tags, 1)
+        assert result['changed'] is False
+        assert result['stdout_lines'] == []
+
+
+class TestEnsureTagSingleEvent(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session.tags = {'my-centos-7-parent': {'id': 1, 'packages': []}}
+        return session
+
+    @pytest.fixture
+    def settings(self):
+        return dict(inheritance=[{'parent': 'my-centos-7-parent',
+                                  'priority': 0}],
+                    external_repos=None,
+                    packages={'kdreyer': ['ceph', 'ansible']},
+                    groups=None,
+                    blocked_packages=['bash'],
+                    arches='x86_64')
+
+    def ensure(self, session, settings, check_mode=False):
+        return koji_tag.ensure_tag_single_event(
+            session, 'ceph-5.0-rhel-8', check_mode, **settings)
+
+    def package_entries(self, session):
+        tag_id = session.tags['ceph-5.0-rhel-8']['id']
+        return sorted((pkg['package_name'], pkg['blocked'])
+                      for pkg in session.listPackages(tag_id))
+
+    def test_new_tag(self, session, settings):
+        result = self.ensure(session, settings)
+        assert result['changed'] is True
+        assert result['requests'] == 2
+        assert result['stdout_lines'] == [
+            'created tag id 100',
+            'added pkg ceph',
+            'added pkg ansible',
+            'blocked pkg bash',
+        ]
+        # One read of the parents' inheritance, and one write.
+        assert len(session.requests) == 2
+        assert self.package_entries(session) == [
+            ('ansible', False), ('bash', True), ('ceph', False)]
+        rules = session.getInheritanceData('ceph-5.0-rhel-8')
+        assert [rule['parent_id'] for rule in rules] == [1]
+
+    def test_new_tag_check_mode(self, session, settings):
+        result = self.ensure(session, settings, check_mode=True)
+        assert result['stdout_lines'] == ['would create tag ceph-5.0-rhel-8']
+        assert result['requests'] == 1
+        assert 'ceph-5.0-rhel-8' not in session.tags
+
+    def test_missing_parent_check_mode(self, session, settings):
+        self.ensure(session, settings)
+        settings['inheritance'] = [{'parent': 'no-such-parent',
+                                    'priority': 0}]
+        result = self.ensure(session, settings, check_mode=True)
+        assert result['changed'] is True
+        assert "parent tag 'no-such-parent' not found" in \
+            result['stdout_lines']
+        rules = session.getInheritanceData('ceph-5.0-rhel-8')
+        assert [rule['parent_id'] for rule in rules] == [1]
+
+    def test_missing_parent(self, session, settings):
+        self.ensure(session, settings)
+        settings['inheritance'] = [{'parent': 'no-such-parent',
+                                    'priority': 0}]
+        with pytest.raises(ValueError):
+            self.ensure(session, settings)
+
+    def test_unchanged(self, session, settings):
+        self.ensure(session, settings)
+        del session.requests[:]
+        result = self.ensure(session, settings)
+        assert result == {'changed': False, 'stdout_lines': [], 'requests': 0}
+        assert session.requests == []
+
+    def test_edit(self, session, settings):
+        self.ensure(session, settings)
+        del session.requests[:]
+        settings['arches'] = 'x86_64 aarch64'
+        settings['packages'] = {'kdreyer': ['ceph']}
+        settings['blocked_packages'] = []
+        result = self.ensure(session, settings)
+        assert result['requests'] == 1
+        assert result['stdout_lines'] == [
+            'ceph-5.0-rhel-8: changed arches from "x86_64" to '
+            '"x86_64 aarch64"',
+            'remove pkg ansible',
+            'remove pkg bash',
+        ]
+        assert session.tags['ceph-5.0-rhel-8']['arches'] == 'x86_64 aarch64'
+        assert self.package_entries(session) == [('ceph', False)]
+
+    def test_edit_check_mode(self, session, settings):
+        self.ensure(session, settings)
+        settings['packages'] = {'kdreyer': ['ceph']}
+        result = self.ensure(session, settings, check_mode=True)
+        assert result['requests'] == 1
+        assert result['stdout_lines'] == ['remove pkg ansible']
+        assert ('ansible', False) in self.package_entries(session)
+
+
+class TestDeleteTags(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session.tags = {
+            'foo-el7': {'id': 1, 'packages': []},
+            'foo-el7-build': {'id': 2, 'packages': []},
+            'foo-el7-candidate': {'id': 3, 'packages': []},
+        }
+        session.inheritance = {
+            'foo-el7-build': [{'parent_id': 1, 'name': 'foo-el7',
+                               'priority': 0}],
+            'foo-el7-candidate': [{'parent_id': 2, 'name': 'foo-el7-build',
+                                   'priority': 0}],
+        }
+        return session
+
+    def test_leaf_first(self, session):
+        names = ['foo-el7', 'foo-el7-build', 'foo-el7-candidate', 'foo-el7']
+        result = koji_tag.delete_tags(session, False, names)
+        assert result['changed'] is True
+        assert result['waves'] == [['foo-el7-candidate'], ['foo-el7-build'],
+                                   ['foo-el7']]
+        assert result['stdout_lines'] == ['deleted tag foo-el7-candidate',
+                                          'deleted tag foo-el7-build',
+                                          'deleted tag foo-el7']
+        assert session.tags == {}
+        assert session.requests == [['getTag'] * 3,
+                                    ['getFullInheritance'] * 3,
+                                    ['deleteTag'], ['deleteTag'],
+                                    ['deleteTag']]
+
+    def test_dicts(self, session):
+        tags = [{'name': 'foo-el7-candidate'}]
+        result = koji_tag.delete_tags(session, False, tags)
+        assert result['waves'] == [['foo-el7-candidate']]
+        assert 'foo-el7-candidate' not in session.tags
+
+    def test_unchanged(self, session):
+        result = koji_tag.delete_tags(session, False, ['bar-el7'])
+        assert result['changed'] is False
+
+    def test_check_mode(self, session):
+        result = koji_tag.delete_tags(session, True, ['foo-el7-candidate'])
+        assert result['changed'] is True
+        assert 'foo-el7-candidate' in session.tags
+
+    def test_child_outside_list(self, session):
+        with pytest.raises(ValueError) as e:
+            koji_tag.delete_tags(session, False, ['foo-el7'])
+        assert str(e.value) == ('cannot delete tags: tag foo-el7-build '
+                                'inherits from foo-el7')
+        assert 'foo-el7' in session.tags
+
+    def test_target(self, session):
+        session.targets = [{'name': 'foo-el7-candidate',
+                            'build_tag_name': 'foo-el7-build',
+                            'dest_tag_name': 'foo-el7-candidate'}]
+        with pytest.raises(ValueError) as e:
+            koji_tag.delete_tags(session, False, ['foo-el7-candidate'])
+        assert str(e.value) == ('cannot delete tags: build target '
+                                'foo-el7-candidate uses foo-el7-candidate')
+        assert 'foo-el7-candidate' in session.tags
+
+    def test_bad_item(self, session):
+        with pytest.raises(ValueError):
+            koji_tag.delete_tags(session, False, [{'arches': 'x86_64'}])
+
+
+class TestDescendantCounts(object):
+
+    @pytest.fixture
+    def session(self, session):
+        for name in ('foo-el7', 'foo-el7-build', 'foo-el7-candidate',
+                     'foo-el7-override'):
+            session.createTag(name)
+        session.tags['foo-el7']['id'] = 1
+        build_id = session.tags['foo-el7-build']['id']
+        session.inheritance = {
+            'foo-el7-build': [{'parent_id': 1, 'name': 'foo-el7',
+                               'priority': 0}],
+            'foo-el7-candidate': [{'parent_id': 1, 'name': 'foo-el7',
+                                   'priority': 0}],
+            # Two paths to foo-el7.
+            'foo-el7-override': [{'parent_id': build_id,
+                                  'name': 'foo-el7-build', 'priority': 0},
+                                 {'parent_id': 1, 'name': 'foo-el7',
+                                  'priority': 10}],
+        }
+        return session
+
+    def count_reads(self, session, monkeypatch):
+        """ Count the inheritance RPCs outside of multicalls. """
+        reads = []
+
+        def counted(method):
+            original = getattr(session, method)
+
+            def wrapper(*args, **kwargs):
+                reads.append(method)
+                return original(*args, **kwargs)
+            return wrapper
+        for method in ('queryHistory', 'getFullInheritance'):
+            monkeypatch.setattr(session, method, counted(method),
+                                raising=False)
+        return reads
+
+    def test_reverse_inheritance(self, session, monkeypatch):
+        reads = self.count_reads(session, monkeypatch)
+        names = ['foo-el7', 'foo-el7-build', 'bar-el7']
+        counts = koji_tag.get_descendant_counts(session, names)
+        assert counts == {'foo-el7': 3, 'foo-el7-build': 1, 'bar-el7': 0}
+        # One read of every link, whatever the number of tags.
+        assert reads == ['queryHistory']
+        assert not any('getFullInheritance' in request
+                       for request in session.requests)
+
+    def test_graph(self, session, monkeypatch):
+        graph = koji_tag.common_koji.InheritanceGraph.from_hub(session)
+        reads = self.count_reads(session, monkeypatch)
+        counts = koji_tag.get_descendant_counts(
+            session, ['foo-el7', 'foo-el7-build'], graph)
+        assert counts == {'foo-el7': 3, 'foo-el7-build': 1}
+        assert reads == []
+
+    def test_maxdepth(self, session):
+        # foo-el7-override stops at foo-el7-build.
+        build_id = session.tags['foo-el7-build']['id']
+        session.inheritance['foo-el7-override'] = [
+            {'parent_id': build_id, 'name': 'foo-el7-build', 'priority': 0,
+             'maxdepth': 0}]
+        counts = koji_tag.get_descendant_counts(session, ['foo-el7'])
+        assert counts == {'foo-el7': 2}
+
+    def test_ensure_tags_check_mode(self, session, monkeypatch):
+        monkeypatch.setattr(koji_tag.common_koji, 'get_session',
+                            lambda profile: session)
+        tags = [{'name': 'foo-el7', 'arches': 'x86_64'},
+                {'name': 'foo-el7-build', 'arches': 'x86_64'},
+                {'name': 'foo-el7-candidate', 'arches': 'x86_64'},
+                {'name': 'foo-el7-override', 'arches': None}]
+        reads = self.count_reads(session, monkeypatch)
+        del session.requests[:]
+        result = koji_tag.ensure_tags('koji', True, tags, 1)
+        assert result['descendants'] == {'foo-el7': 3, 'foo-el7-build': 1,
+                                         'foo-el7-candidate': 0}
+        # Three changed tags cost one inheritance read.
+        assert reads.count('queryHistory') == 1
+        assert 'getFullInheritance' not in reads
+        assert not any('getFullInheritance' in request
+                       for request in session.requests)
+
+    def test_single_tag_check_mode(self, session, monkeypatch):
+        monkeypatch.setattr(koji_tag.common_koji, 'get_session',
+                            lambda profile: session)
+        monkeypatch.setattr(koji_tag.AnsibleModule, 'exit_json', exit_json)
+        set_module_args({'name': 'foo-el7', 'arches': 'x86_64',
+                         '_ansible_check_mode': True})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag.main()
+        result = exit.value.args[0]
+        assert result['changed'] is True
+        assert result['descendants'] == {'foo-el7': 3}
@@ -0,0 +1,190 @@
+import pytest
+import koji_tag_info
+from utils import exit_json
+from utils import fail_json
+from utils import set_module_args
+from utils import AnsibleExitJson
+from utils import AnsibleFailJson
+from utils import FakeMulticallSession
+
+
+class FakeKojiSession(FakeMulticallSession):
+
+    def __init__(self):
+        self.tags = {}
+        # tag ID -> list of inheritance rules
+        self.inheritance = {}
+        # tag ID -> package name -> (owner name, blocked)
+        self.packages = {}
+
+    def add_tag(self, name, packages=None):
+        tag_id = len(self.tags) + 1
+        self.tags[name] = {'id': tag_id, 'name': name}
+        self.inheritance[tag_id] = []
+        self.packages[tag_id] = packages or {}
+        return tag_id
+
+    def add_link(self, child, parent, priority, **settings):
+        rule = {'child_id': self.tags[child]['id'],
+                'parent_id': self.tags[parent]['id'],
+                'name': parent,
+                'priority': priority,
+                'maxdepth': None,
+                'intransitive': False,
+                'noconfig': False,
+                'pkg_filter': ''}
+        rule.update(settings)
+        self.inheritance[rule['child_id']].append(rule)
+
+    def getTag(self, tagInfo, **kwargs):
+        return self.tags.get(tagInfo)
+
+    def getInheritanceData(self, tag):
+        return self.inheritance[tag]
+
+    def listPackages(self, tagID):
+        return [{'package_name': name, 'owner_name': owner,
+                 'blocked': blocked}
+                for name, (owner, blocked) in self.packages[tagID].items()]
+
+
+@pytest.fixture
+def session():
+    session = FakeKojiSession()
+    session.add_tag('base', {'ceph': ('alice', False),
+                             'bash': ('bob', False),
+                             'koji': ('alice', False)})
+    session.add_tag('ceph', {'ceph-ansible': ('carol', False),
+                             'koji': ('carol', True)})
+    session.add_tag('other', {'bash': ('carol', False),
+                              'rpm': ('carol', False)})
+    session.add_tag('ceph-build', {'ceph': ('dave', False)})
+    session.add_tag('ceph-test')
+    session.add_link('ceph', 'base', 0, pkg_filter='^(ceph|koji)')
+    session.add_link('ceph-build', 'ceph', 0)
+    session.add_link('ceph-build', 'other', 10)
+    session.add_link('ceph-test', 'ceph', 0)
+    return session
+
+
+class TestGetTagsInfo(object):
+
+    def test_effective_packages(self, session):
+        result = koji_tag_info.get_tags_info(session, ['ceph-build'])
+        assert result['changed'] is False
+        info = result['tags']['ceph-build']
+        # The tag's own entry wins, "bash" from "base" does not match the
+        # pkg_filter, and "ceph" blocks "koji" before "base" offers it.
+        assert info == {
+            'packages': {'ceph': 'dave', 'ceph-ansible': 'carol',
+                         'bash': 'carol', 'rpm': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_pkg_filter(self, session):
+        result = koji_tag_info.get_tags_info(session, ['ceph'])
+        assert result['tags']['ceph'] == {
+            'packages': {'ceph': 'alice', 'ceph-ansible': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_maxdepth(self, session):
+        session.inheritance[5][0]['maxdepth'] = 0
+        result = koji_tag_info.get_tags_info(session, ['ceph-test'])
+        # "base" is two hops away.
+        assert result['tags']['ceph-test'] == {
+            'packages': {'ceph-ansible': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_intransitive(self, session):
+        session.inheritance[2][0]['intransitive'] = True
+        result = koji_tag_info.get_tags_info(session, ['ceph', 'ceph-test'])
+        assert result['tags']['ceph']['packages']['ceph'] == 'alice'
+        assert result['tags']['ceph-test'] == {
+            'packages': {'ceph-ansible': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_nested_maxdepth(self, session):
+        session.add_tag('top', {'ceph-deploy': ('erin', False)})
+        session.add_link('base', 'top', 0)
+        session.inheritance[2][0]['maxdepth'] = 1
+        session.inheritance[5][0]['maxdepth'] = 3
+        result = koji_tag_info.get_tags_info(session, ['ceph', 'ceph-test'])
+        # ceph reaches "top" through "base", but ceph-test's link passes
+        # on min(1, 3) - 1 = 0 hops from "base", like the hub does.
+        assert result['tags']['ceph']['packages']['ceph-deploy'] == 'erin'
+        assert result['tags']['ceph-test'] == {
+            'packages': {'ceph': 'alice', 'ceph-ansible': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_prune(self, session):
+        session.add_link('ceph-test', 'base', -1)
+        result = koji_tag_info.get_tags_info(session, ['ceph-test'])
+        assert result['tags']['ceph-test'] == {
+            'packages': {'ceph-ansible': 'carol'},
+            'blocked': ['koji'],
+        }
+
+    def test_nested_pkg_filter(self, session):
+        session.add_link('ceph-test', 'ceph', 0, pkg_filter='^koji')
+        del session.inheritance[5][0]
+        result = koji_tag_info.get_tags_info(session, ['ceph-test'])
+        # "ceph" from "base" matches base's filter but not ceph-test's.
+        assert result['tags']['ceph-test'] == {
+            'packages': {},
+            'blocked': ['koji'],
+        }
+
+    def test_shared_parents(self, session, monkeypatch):
+        walks = []
+        offered = koji_tag_info.EffectivePackages._offered
+
+        def counting_offered(self, tag_id, filters):
+            if (tag_id, tuple(filters)) not in self._offers:
+                walks.append(tag_id)
+            return offered(self, tag_id, filters)
+        monkeypatch.setattr(koji_tag_info.EffectivePackages, '_offered',
+                            counting_offered)
+        koji_tag_info.get_tags_info(session, ['ceph-build', 'ceph-test'])
+        # Each tag's package list is read once, in one multicall.
+        assert session.requests[-1] == ['listPackages'] * 5
+        assert sorted(walks) == [1, 2, 3]
+
+    def test_unknown_tag(self, session):
+        with pytest.raises(ValueError) as e:
+            koji_tag_info.get_tags_info(session, ['ceph', 'nope'])
+        assert str(e.value) == 'tag nope does not exist'
+
+
+class TestMain(object):
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(koji_tag_info.AnsibleModule,
+                            'exit_json', exit_json)
+        monkeypatch.setattr(koji_tag_info.AnsibleModule,
+                            'fail_json', fail_json)
+
+    @pytest.fixture(autouse=True)
+    def fake_session(self, monkeypatch, session):
+        monkeypatch.setattr(koji_tag_info.common_koji,
+                            'get_session',
+                            lambda x: session)
+
+    def test_info(self, session):
+        set_module_args({'tags': ['ceph-test']})
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_info.main()
+        result = exit.value.args[0]
+        assert result['changed'] is False
+        assert result['tags']['ceph-test']['blocked'] == ['koji']
+
+    def test_unknown_tag(self, session):
+        set_module_args({'tags': ['nope']})
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_tag_info.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'tag nope does not exist'
@@ -1,3 +1,4 @@
+import copy
 import pytest
 import koji_tag_inheritance
 from koji_tag_inheritance import add_tag_inheritance
@@ -7,9 +8,15 @@ from utils import fail_json
 from utils import set_module_args
 from utils import AnsibleExitJson
 from utils import AnsibleFailJson
+from utils import FakeMulticallSession
 
 
-class FakeKojiSession(object):
+class GenericError(Exception):
+    def __str__(self):
+        return str(self.args[0])
+
+
+class FakeKojiSession(FakeMulticallSession):
 
     tags = {
         'parent-tag-a': {'id': 1},
@@ -25,6 +32,8 @@ class FakeKojiSession(object):
     def getInheritanceData(self, tag_id):
         if not isinstance(tag_id, int):
             taginfo = self.getTag(tag_id)
+            if not taginfo:
+                raise GenericError('No such tagInfo: %r' % tag_id)
             tag_id = taginfo['id']
         return self._inheritance.get(tag_id, [])
 
@@ -43,6 +52,11 @@ class FakeKojiSession(object):
             pass
         else:
             self._inheritance[tag] = data
+        self.writes.append((tag, data))
+
+    @property
+    def writes(self):
+        return self.__dict__.setdefault('_writes', [])
 
     def ensure_logged_in(self, session):
         return session
@@ -118,6 +132,37 @@ class TestEnsureInheritance(object):
         assert result['stdout_lines'] == ['remove inheritance link:', '  10   .... parent-tag-a']
 
 
+class TestGetIdsAndInheritance(object):
+
+    def test_one_request(self, session):
+        session._inheritance = FAKE_INHERITANCE_DATA
+        data = koji_tag_inheritance.get_ids_and_inheritance(
+            session, 'my-child-tag', 'parent-tag-a')
+        assert data == (100, 1, FAKE_INHERITANCE_DATA[100])
+        assert session.requests == [['getTag', 'getTag', 'getInheritanceData']]
+
+    def test_cached_ids(self, session):
+        session._inheritance = FAKE_INHERITANCE_DATA
+        koji_tag_inheritance.common_koji.tag_id_cache.update(
+            {'my-child-tag': 100, 'parent-tag-a': 1})
+        data = koji_tag_inheritance.get_ids_and_inheritance(
+            session, 'my-child-tag', 'parent-tag-a')
+        assert data == (100, 1, FAKE_INHERITANCE_DATA[100])
+        assert session.requests == [['getInheritanceData']]
+
+    def test_no_child(self, session):
+        session._inheritance = FAKE_INHERITANCE_DATA
+        data = koji_tag_inheritance.get_ids_and_inheritance(
+            session, 'bogus-tag', 'parent-tag-a')
+        assert data == (None, 1, [])
+
+    def test_remove_no_child(self, session):
+        session._inheritance = FAKE_INHERITANCE_DATA
+        result = remove_tag_inheritance(session, 'bogus-tag', 'parent-tag-a',
+                                        False)
+        assert result['changed'] is False
+
+
 class TestEnsureInheritanceUnchanged(object):
 
     def test_ensure_unchanged(self):
@@ -209,3 +254,116 @@ class TestMain(object):
         assert result['changed'] is True
         assert result['stdout_lines'] == [
             'remove inheritance link:', '  10   .... parent-tag-a']
+
+
+class TestEnsureLinks(object):
+
+    @pytest.fixture
+    def session(self, session):
+        session._inheritance = copy.deepcopy(FAKE_INHERITANCE_DATA)
+        session.tags = dict(session.tags, **{'other-child-tag': {'id': 101}})
+        return session
+
+    def test_grouped_by_child(self, session):
+        links = [
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-a',
+             'priority': 10},
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-b',
+             'state': 'absent'},
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c',
+             'priority': 30},
+            {'child_tag': 'other-child-tag', 'parent_tag': 'parent-tag-a',
+             'priority': 5},
+        ]
+        result = koji_tag_inheritance.ensure_links(session, False, links)
+        assert result['changed'] is True
+        assert result['stdout_lines'] == [
+            'my-child-tag: remove inheritance link:',
+            'my-child-tag:   20   .... parent-tag-b',
+            'my-child-tag: add inheritance link:',
+            'my-child-tag:   30   .... parent-tag-c',
+            'other-child-tag: add inheritance link:',
+            'other-child-tag:    5   .... parent-tag-a',
+        ]
+        assert session.requests == [
+            ['getTag'] * 4,
+            ['getInheritanceData'] * 2,
+            # The parents' links, to check for loops.
+            ['getInheritanceData'] * 2,
+            ['setInheritanceData'] * 2,
+        ]
+        (child_id, changes), (other_id, other_changes) = session.writes
+        assert child_id == 100
+        assert [rule['parent_id'] for rule in changes] == [2, 3]
+        assert changes[0]['delete link'] is True
+        assert other_id == 101
+        assert other_changes[0]['priority'] == 5
+
+    def test_unchanged(self, session):
+        links = [
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-a',
+             'priority': 10},
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c',
+             'state': 'absent'},
+        ]
+        result = koji_tag_inheritance.ensure_links(session, False, links)
+        assert result['changed'] is False
+        assert session.writes == []
+
+    def test_unchanged_strings(self, session):
+        # Values from YAML or templates compare equal to the hub's.
+        links = [
+            {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-a',
+             'priority': '10', 'intransitive': 'no', 'noconfig': 'false'},
+        ]
+        result = koji_tag_inheritance.ensure_links(session, False, links)
+        assert result['changed'] is False
+        assert session.writes == []
+
+    def test_bad_priority(self, session):
+        links = [{'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c',
+                  'priority': 'high'}]
+        with pytest.raises(ValueError) as e:
+            koji_tag_inheritance.ensure_links(session, False, links)
+        assert str(e.value) == ('link from my-child-tag to parent-tag-c: '
+                                'priority must be an int')
+
+    def test_check_mode(self, session):
+        links = [{'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c',
+                  'priority': 30}]
+        result = koji_tag_inheritance.ensure_links(session, True, links)
+        assert result['changed'] is True
+        assert session.writes == []
+
+    def test_missing_parent(self, session):
+        links = [{'child_tag': 'my-child-tag', 'parent_tag': 'bogus-tag',
+                  'priority': 30}]
+        with pytest.raises(koji_tag_inheritance.NoSuchTagError) as e:
+            koji_tag_inheritance.ensure_links(session, False, links)
+        assert str(e.value) == 'parent tag bogus-tag not found'
+        assert session.writes == []
+
+    def test_loop(self, session):
+        # parent-tag-a already inherits from my-child-tag.
+        session._inheritance[1] = [{'parent_id': 100, 'priority': 0,
+                                    'name': 'my-child-tag'}]
+        links = [{'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-a',
+                  'priority': 5}]
+        with pytest.raises(ValueError) as e:
+            koji_tag_inheritance.ensure_links(session, False, links)
+        assert str(e.value) == ('inheritance loop: parent-tag-a -> '
+                                'my-child-tag -> parent-tag-a')
+        assert session.writes == []
+
+    def test_missing_priority(self, session):
+        links = [{'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c'}]
+        with pytest.raises(ValueError) as e:
+            koji_tag_inheritance.ensure_links(session, False, links)
+        assert str(e.value) == ('link from my-child-tag to parent-tag-c '
+                                'needs a priority')
+
+    def test_duplicate_link(self, session):
+        link = {'child_tag': 'my-child-tag', 'parent_tag': 'parent-tag-c',
+                'priority': 30}
+        with pytest.raises(ValueError):
+            koji_tag_inheritance.ensure_links(session, False, [link, link])
@@ -5,11 +5,13 @@ from utils import fail_json
 from utils import set_module_args
 from utils import AnsibleExitJson
 from utils import AnsibleFailJson
+from utils import apply_query_opts
+from utils import FakeMulticallSession
 
-from mock import Mock, call
+from mock import MagicMock, Mock, call
 
 
-class FakeKojiSession(object):
+class FakeKojiSession(FakeMulticallSession):
 
     tags = {}
 
@@ -21,9 +23,13 @@ class FakeKojiSession(object):
             return None
         return self.tags.get(tagInfo)
 
-    def listPackages(self, tagID, with_owners=True):
+    def getLastEvent(self):
+        return {'id': 1000}
+
+    def listPackages(self, tagID, with_owners=True, queryOpts=None,
+                     event=None):
         tag = self.getTag(tagID)
-        return tag['packages']
+        return apply_query_opts(tag['packages'], queryOpts)
 
     def packageListAdd(self, taginfo, pkginfo, owner):
         tag = self.getTag(taginfo)
@@ -42,6 +48,17 @@ class FakeKojiSession(object):
         if found is not None:
             del tag['packages'][found]
 
+    def packageListBlock(self, taginfo, pkginfo, force=False):
+        tag = self.getTag(taginfo)
+        for package in tag['packages']:
+            if package['package_name'] == pkginfo:
+                package['blocked'] = True
+                return
+        tag['packages'].append({'package_id': '0',
+                                'package_name': pkginfo,
+                                'owner_name': None,
+                                'blocked': True})
+
     def ensure_logged_in(self, session):
         return session
 
@@ -61,8 +78,14 @@ class TestKojiTagPackages(object):
             "user1": ['ceph', 'curl'],
             "user2": ['coreutils'],
         }
+        current_packages = [
+            {"package_name": "ceph", "blocked": False},
+            {"package_name": "curl", "blocked": False},
+            {"package_name": "coreutils", "blocked": False},
+        ]
         check_mode = False
-        session = Mock()
+        session = MagicMock()
+        session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.remove_packages(
             session, "epel8", check_mode, packages)
         assert result['changed']
@@ -83,7 +106,7 @@ class TestKojiTagPackages(object):
             {"package_name": "coreutils", "owner_name": "user2"},
         ]
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.ensure_packages(
             session, "epel8", "5", check_mode, packages)
@@ -101,7 +124,7 @@ class TestKojiTagPackages(object):
             {"package_name": "coreutils", "owner_name": "user2"},
         ]
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.ensure_packages(
             session, "epel8", "5", check_mode, packages)
@@ -117,7 +140,7 @@ class TestKojiTagPackages(object):
             {"package_name": "curl", "blocked": True},
         ]
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.remove_package_blocks(
             session, "epel8", check_mode, packages)
@@ -139,7 +162,7 @@ class TestKojiTagPackages(object):
         ]
 
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.ensure_blocked_packages(
             session, "epel8", "5", check_mode, packages)
@@ -155,7 +178,7 @@ class TestKojiTagPackages(object):
         ]
 
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.ensure_blocked_packages(
             session, "epel8", "5", check_mode, packages)
@@ -172,7 +195,7 @@ class TestKojiTagPackages(object):
             {"package_name": "coreutils", "owner_name": "user1"},
         ]
         check_mode = False
-        session = Mock()
+        session = MagicMock()
         session.listPackages = Mock(return_value=current_packages)
         result = koji_tag_packages.ensure_packages(
             session, "epel8", "5", check_mode, packages)
@@ -180,6 +203,54 @@ class TestKojiTagPackages(object):
         session.packageListSetOwner.assert_called_with(
             "epel8", "coreutils", "user2")
 
+    def test_remove_redundant_packages(self):
+        packages = {"user1": ['curl']}
+        current_packages = [
+            {"package_name": "ceph", "owner_name": "user1"},
+            {"package_name": "curl", "owner_name": "user1"},
+        ]
+        session = MagicMock()
+        session.listPackages = Mock(return_value=current_packages)
+        result = koji_tag_packages.ensure_packages(
+            session, "epel8", "5", False, packages,
+            redundant={'ceph', 'coreutils'})
+        assert result['stdout_lines'] == ['remove pkg ceph']
+        session.packageListRemove.assert_called_once_with("epel8", "ceph")
+
+    def test_remove_unneeded_blocks(self):
+        current_packages = [
+            {"package_name": "ceph", "blocked": True},
+        ]
+        session = MagicMock()
+        session.listPackages = Mock(return_value=current_packages)
+        result = koji_tag_packages.ensure_blocked_packages(
+            session, "epel8", "5", False, [],
+            unneeded={'ceph', 'curl'})
+        assert result == ['remove pkg ceph']
+        session.packageListRemove.assert_called_once_with("epel8", "ceph")
+        session.packageListUnblock.assert_not_called()
+
+    def test_remove_packages_already_gone(self):
+        packages = {"user1": ['ceph', 'curl']}
+        current_packages = [
+            {"package_name": "curl", "blocked": False},
+        ]
+        session = MagicMock()
+        session.listPackages = Mock(return_value=current_packages)
+        result = koji_tag_packages.remove_packages(
+            session, "epel8", False, packages)
+        assert result['stdout_lines'] == ['remove pkg curl']
+        session.packageListRemove.assert_called_once_with("epel8", "curl")
+
+    def test_remove_packages_none_present(self):
+        packages = {"user1": ['ceph', 'curl']}
+        session = MagicMock()
+        session.listPackages = Mock(return_value=[])
+        result = koji_tag_packages.remove_packages(
+            session, "epel8", False, packages)
+        assert result == {'changed': False, 'stdout_lines': []}
+        session.packageListRemove.assert_not_called()
+
 
 class TestMain(object):
 
@@ -239,3 +310,102 @@ class TestMain(object):
         result = exit.value.args[0]
         assert result['changed'] is True
         assert result['stdout_lines'] == ['remove pkg ceph']
+
+    def test_packages_data(self, session):
+        session.tags = {'ceph-5.0-rhel-8': {'id': 1, 'packages': []}}
+        data = 'eNqrVspOKUqtTC1SsopWSk4tyFCKrQUASv8HCQ=='
+        set_module_args({
+            'tag': 'ceph-5.0-rhel-8',
+            'packages_data': data,
+        })
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['stdout_lines'] == ['added pkg ceph']
+
+    def test_packages_file_without_action_plugin(self, session):
+        session.tags = {'ceph-5.0-rhel-8': {'id': 1, 'packages': []}}
+        set_module_args({
+            'tag': 'ceph-5.0-rhel-8',
+            'packages_file': 'packages.yml',
+        })
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['msg'] == \
+            'packages_file requires the koji-ansible action plugins'
+
+    def test_packages_and_blocks(self, session, monkeypatch):
+        session.tags = {'ceph-5.0-rhel-8': {'id': 1, 'packages': []}}
+        session.packageListAdd('ceph-5.0-rhel-8', 'bash', 'kdreyer')
+        reads = []
+        listPackages = session.listPackages
+
+        def counting_listPackages(*args, **kwargs):
+            reads.append(kwargs)
+            return listPackages(*args, **kwargs)
+        monkeypatch.setattr(session, 'listPackages', counting_listPackages)
+        set_module_args({
+            'tag': 'ceph-5.0-rhel-8',
+            'packages': {'kdreyer': ['ceph']},
+            'blocked_packages': ['bash'],
+        })
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['stdout_lines'] == ['added pkg ceph', 'block pkg bash']
+        assert len(reads) == 1
+        assert session.requests == [['packageListAdd', 'packageListBlock']]
+
+    def test_remove_package_twice(self, session):
+        session.tags = {'ceph-5.0-rhel-8': {'id': 1, 'packages': []}}
+        session.packageListAdd('ceph-5.0-rhel-8', 'ceph', 'kdreyer')
+        set_module_args({
+            'tag': 'ceph-5.0-rhel-8',
+            'packages': {'kdreyer': ['ceph', 'bash']},
+            'state': 'absent',
+        })
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['stdout_lines'] == ['remove pkg ceph']
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['changed'] is False
+
+    def test_many_tags(self, session):
+        session.tags = {
+            'ceph-5.0-rhel-8-x86_64': {'id': 1, 'packages': []},
+            'ceph-5.0-rhel-8-s390x': {'id': 2, 'packages': []},
+        }
+        session.packageListAdd('ceph-5.0-rhel-8-s390x', 'ceph', 'kdreyer')
+        set_module_args({
+            'tag': ['ceph-5.0-rhel-8-x86_64', 'ceph-5.0-rhel-8-s390x'],
+            'packages': {'kdreyer': ['ceph', 'bash']},
+        })
+        with pytest.raises(AnsibleExitJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['changed'] is True
+        assert result['stdout_lines'] == [
+            'ceph-5.0-rhel-8-x86_64: added pkg ceph',
+            'ceph-5.0-rhel-8-x86_64: added pkg bash',
+            'ceph-5.0-rhel-8-s390x: added pkg bash',
+        ]
+        assert session.requests == [
+            ['getTag', 'getTag'],
+            ['listPackages', 'listPackages'],
+            ['packageListAdd', 'packageListAdd', 'packageListAdd'],
+        ]
+
+    def test_many_tags_missing(self, session):
+        session.tags = {'ceph-5.0-rhel-8-x86_64': {'id': 1, 'packages': []}}
+        set_module_args({
+            'tag': ['ceph-5.0-rhel-8-x86_64', 'ceph-5.0-rhel-8-s390x'],
+            'packages': {'kdreyer': ['ceph']},
+        })
+        with pytest.raises(AnsibleFailJson) as exit:
+            koji_tag_packages.main()
+        result = exit.value.args[0]
+        assert result['msg'] == 'tag ceph-5.0-rhel-8-s390x does not exist'
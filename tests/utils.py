@@ -35,3 +35,87 @@ def exit_json(*args, **kwargs):
 def fail_json(*args, **kwargs):
     kwargs['failed'] = True
     raise AnsibleFailJson(kwargs)
+
+
+class FakeMulticallSession(object):
+    """
+    Emulate koji.ClientSession's legacy multicall API and the
+    system.listMethods() RPC for our fake sessions.
+
+    When "multicall" is True, every public method call is queued instead of
+    executed. multiCall() then runs the queued calls in order and returns
+    their results the same way the hub does.
+
+    Each multiCall() round trip is recorded in "requests", as a list of the
+    method names in that request, so tests can count round trips.
+    """
+    multicall = False
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if name.startswith('_') or name in ('multiCall', 'system'):
+            return attr
+        multicall = object.__getattribute__(self, 'multicall')
+        if not callable(attr) or not multicall:
+            return attr
+
+        def queue(*args, **kwargs):
+            self._calls.append((attr, args, kwargs))
+        return queue
+
+    @property
+    def _calls(self):
+        if '_queued_calls' not in self.__dict__:
+            self.__dict__['_queued_calls'] = []
+        return self.__dict__['_queued_calls']
+
+    @property
+    def requests(self):
+        if '_requests' not in self.__dict__:
+            self.__dict__['_requests'] = []
+        return self.__dict__['_requests']
+
+    def multiCall(self, strict=False, batch=None):
+        if not self.multicall:
+            raise RuntimeError('multicall must be set before multiCall()')
+        self.multicall = False
+        calls = list(self._calls)
+        del self._calls[:]
+        self.requests.append([method.__name__ for method, _, _ in calls])
+        results = []
+        for method, args, kwargs in calls:
+            try:
+                results.append([method(*args, **kwargs)])
+            except Exception as e:
+                if strict:
+                    raise
+                results.append({'faultCode': 1000, 'faultString': str(e)})
+        return results
+
+    @property
+    def system(self):
+        session = self
+
+        class FakeSystem(object):
+            def listMethods(self):
+                return [name for name in dir(session)
+                        if not name.startswith('_')
+                        and name not in ('multicall', 'system')
+                        and callable(getattr(session, name))]
+        return FakeSystem()
+
+
+def apply_query_opts(results, queryOpts):
+    """
+    Emulate the hub's "queryOpts" (order, offset and limit) for a list of
+    dicts.
+    """
+    if not queryOpts:
+        return results
+    if 'order' in queryOpts:
+        results = sorted(results, key=lambda r: r[queryOpts['order']])
+    offset = queryOpts.get('offset', 0)
+    limit = queryOpts.get('limit')
+    if limit is None:
+        return results[offset:]
+    return results[offset:offset + limit]